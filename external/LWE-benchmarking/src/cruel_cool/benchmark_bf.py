@@ -0,0 +1,103 @@
+""""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Microbenchmark of the brute force kernels on random reduced data: the dense
+scatter + matmul kernel against the sparse gather-sum kernel, in float16, float32
+and (sparse only) int32. Also checks that the kernels keep the same top candidate.
+
+python3 src/cruel_cool/benchmark_bf.py --bf_dim 20,40 --hw 2,3 --secret_type binary,ternary
+"""
+
+import argparse
+import itertools
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append("./")
+from single_worker_attack import brute_force_one_batch, brute_force_one_batch_sparse
+
+POSSIBLE_VALUES = {
+    "binary": (1,),
+    "ternary": (-1, 1),
+    "binomial": (-2, -1, 1, 2),
+    "gaussian": (-6, -5, -4, -3, -2, -1, 1, 2, 3, 4, 5, 6),
+}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument("--bf_dim", type=str, default="20,40")
+    parser.add_argument("--hw", type=str, default="2,3")
+    parser.add_argument("--secret_type", type=str, default="binary,ternary,binomial")
+    parser.add_argument("--Q", type=int, default=842779)
+    parser.add_argument("--n_data", type=int, default=2000)
+    parser.add_argument("--batch_size", type=int, default=2000)
+    parser.add_argument("--keep_n_tops", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--kernels", type=str, default="dense:float16,dense:float32,sparse:float32,sparse:int32")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def timeit(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main(params):
+    rng = np.random.default_rng(params.seed)
+    kernels = [k.split(":") for k in params.kernels.split(",")]
+    fns = {"dense": brute_force_one_batch, "sparse": brute_force_one_batch_sparse}
+    print(f"{'type':>9} {'bf_dim':>6} {'hw':>3} {'cands':>9} " + " ".join(f"{n + ':' + d:>15}" for n, d in kernels))
+    for secret_type in params.secret_type.split(","):
+        values = POSSIBLE_VALUES[secret_type]
+        for bf_dim in [int(d) for d in params.bf_dim.split(",")]:
+            RA = rng.integers(0, params.Q, size=(params.n_data, bf_dim))
+            RB = rng.integers(0, params.Q, size=params.n_data)
+            for hw in [int(h) for h in params.hw.split(",")]:
+                combs = list(itertools.islice(itertools.combinations(range(bf_dim), hw), params.batch_size))
+                combs = torch.tensor(combs, device=params.device)
+                n_cands = len(combs) * len(values) ** hw
+                if n_cands * params.n_data > 2**28:
+                    print(f"skipping {secret_type} bf_dim={bf_dim} hw={hw}: {n_cands} candidates is too many")
+                    continue
+
+                times, tops = [], []
+                for name, dtype in kernels:
+                    dtype = getattr(torch, dtype)
+                    if dtype == torch.int32:
+                        RAs, RBs, Q = torch.tensor(RA), torch.tensor(RB), params.Q
+                    else:
+                        RAs, RBs, Q = torch.tensor(RA / params.Q * 10), torch.tensor(RB / params.Q * 10), 10
+                    RAs, RBs = RAs.to(params.device, dtype), RBs.to(params.device, dtype)
+                    stat_dtype = dtype if dtype.is_floating_point else torch.float32
+                    top_n = [
+                        torch.zeros(params.keep_n_tops, device=params.device, dtype=stat_dtype),
+                        torch.zeros((params.keep_n_tops, bf_dim), device=params.device, dtype=dtype),
+                    ]
+                    t, out = timeit(
+                        lambda: fns[name](combs, RAs, RBs, top_n, Q, bf_dim, possible_values=values),
+                        params.repeats,
+                    )
+                    times.append(t)
+                    tops.append(out[1][0].to(torch.int64).cpu())
+                # float16 rounding can reorder near-ties, only compare the exact-ish kernels.
+                exact = [top for (_, d), top in zip(kernels, tops) if d != "float16"]
+                assert all(torch.equal(exact[0], top) for top in exact), "kernels disagree on the best candidate"
+                print(f"{secret_type:>9} {bf_dim:>6} {hw:>3} {n_cands:>9} " + " ".join(f"{t:>15.5f}" for t in times))
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
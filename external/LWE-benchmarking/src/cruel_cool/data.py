@@ -14,6 +14,7 @@ import pickle
 import os
 
 from reduction import make_n_reduced_samples
+from src.utils import mod_mult_batched
 
 logger = getLogger()
 
@@ -158,8 +159,11 @@ class Data:
 
     @staticmethod
     def _make_RAs_RBs(origA, origB, Rs, subsets, Q):
-        RAs = np.vstack([R_i @ origA[subset] for R_i, subset in zip(Rs, subsets)])
-        RBs = np.hstack([R_i @ origB[subset] for R_i, subset in zip(Rs, subsets)])
+        # R_i @ [A | b] for every reduction at once, exact mod Q.
+        origAB = np.column_stack([origA, np.asarray(origB).round().astype(np.int64)])
+        RABs = mod_mult_batched(Rs, origAB, subsets, Q)
+        RABs = np.concatenate(RABs) if isinstance(RABs, list) else RABs.reshape(-1, origAB.shape[1])
+        RAs, RBs = RABs[:, :-1], RABs[:, -1]
         sel = (RAs != 0).any(1)
         logger.info(sel.mean())
         RAs = (RAs[sel] + Q // 2) % Q - Q // 2
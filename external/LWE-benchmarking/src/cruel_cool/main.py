@@ -8,12 +8,16 @@ LICENSE file in the root directory of this source tree.
 
 import argparse
 import getpass
+import json
+import os
 from single_worker_attack import Attacker
 import math
-from multiprocessing import Pool
 from data import Data, MLWEData
+from scheduler import WorkCheckpoint, run_work_queue
 from time import time
+import torch
 
+from src.logger import create_logger
 from src.utils import initialize_exp
 
 
@@ -84,12 +88,57 @@ def parse_args(default_args=None):
         help="If RLWE/MLWE, which window to bruteforce",
         default=0,
     )
+    parser.add_argument(
+        "--bf_kernel",
+        type=str,
+        help="dense: scatter candidates and matmul, sparse: gather-sum the hw columns",
+        default="sparse",
+        choices=["dense", "sparse"],
+    )
+    parser.add_argument(
+        "--bf_dtype",
+        type=str,
+        help="brute force dtype, auto: float16 on accelerators, float32 on CPU",
+        default="auto",
+        choices=["auto", "float16", "float32", "int32"],
+    )
+    parser.add_argument(
+        "--completion",
+        type=str,
+        help="how to complete the brute forced candidates (anneal: binary secrets only)",
+        default="linear",
+        choices=["linear", "greedy", "anneal"],
+    )
+    parser.add_argument(
+        "--anneal_chains", type=int, help="annealing chains per candidate", default=256
+    )
+    parser.add_argument(
+        "--anneal_steps", type=int, help="annealing steps per candidate", default=2000
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        help="number of worker processes, assigned to --device round robin (0: one per device)",
+        default=0,
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        help="number of ranks handed to a worker at a time",
+        default=1_000_000,
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        help="file recording completed ranks, to resume a run (default: in dump_path)",
+        default="",
+    )
     # You can use src/salsa/compute_optimal_mlwe_shift.py or use a random window in [0,n-1].
     args = parser.parse_args(default_args)
     return args
 
 
-def worker(args, device, start, stop):
+def load_attacker(args):
     if args.mlwe_k:
         data = MLWEData.from_files(
             path=args.path,
@@ -111,7 +160,7 @@ def worker(args, device, start, stop):
     if args.greedy_max_data is None:
         args.greedy_max_data = data.RA.shape[0]
 
-    attacker = Attacker(
+    return Attacker(
         data,
         args.bf_dim,
         args.bf_max_data,
@@ -124,18 +173,29 @@ def worker(args, device, start, stop):
         secret_type=args.secret_type,
         mlwe_k=args.mlwe_k,
         secret_window=args.secret_window,
+        bf_kernel=args.bf_kernel,
+        bf_dtype=args.bf_dtype,
+        completion=args.completion,
+        full_hw=args.full_hw,
+        anneal_chains=args.anneal_chains,
+        anneal_steps=args.anneal_steps,
     )
 
-    found_secret = attacker.brute_force_worker(
-        args.min_bf_hw, args.max_bf_hw, start, stop, device
-    )
-    if found_secret:
-        # write a file
-        with open("found_secret.txt", "w") as f:
-            import json
 
-            f.write(json.dumps(vars(args)))
-    return found_secret
+def worker_setup(args, device, worker_id):
+    """Runs in each worker process: loads the data once, returns the chunk runner."""
+    create_logger(os.path.join(args.dump_path, "train.log"), rank=worker_id + 1)
+    if device == "cpu":
+        # Share the cores between the CPU workers instead of oversubscribing them.
+        torch.set_num_threads(max(1, os.cpu_count() // args.n_workers))
+    attacker = load_attacker(args)
+
+    def run(start, stop, stop_event):
+        return attacker.brute_force_worker(
+            args.min_bf_hw, args.max_bf_hw, start, stop, device, stop_event
+        )
+
+    return run
 
 
 def calculate_work_idxs(args):
@@ -146,27 +206,24 @@ def calculate_work_idxs(args):
     assert args.which_worker_am_i < args.work_split_into
     start = args.which_worker_am_i * n_work_per_worker
     stop = min(start + n_work_per_worker, n_work_full)
-    total_in_this_process = stop - start
 
-    # split this work into devices
+    # one worker process per device, or n_workers spread over the devices
     devices = args.device.split(",")
-    thresholds = [
-        start + total_in_this_process * i // len(devices)
-        for i in range(len(devices) + 1)
-    ]
-    return devices, thresholds, start, stop
+    n_workers = args.n_workers if args.n_workers > 0 else len(devices)
+    devices = [devices[i % len(devices)] for i in range(n_workers)]
+    return devices, start, stop
 
 
 def main(args):
-    devices, thresholds, start, stop = calculate_work_idxs(args)
+    devices, start, stop = calculate_work_idxs(args)
+    args.n_workers = len(devices)
     logger = initialize_exp(args)
     logger.info(
         f"It's me, worker {args.which_worker_am_i} out of {args.work_split_into} total workers"
     )
     logger.info(
-        f"I have to do work from {start} to {stop}, split into {len(devices)} devices"
+        f"I have to do work from {start} to {stop}, split among {len(devices)} processes on {devices}"
     )
-    logger.info(f"Thresholds are {thresholds}")
 
     if "binary" in args.path:
         assert args.secret_type == "binary"
@@ -177,19 +234,24 @@ def main(args):
     elif "gaussian" in args.path:
         assert args.secret_type == "gaussian"
 
+    checkpoint_path = args.checkpoint or os.path.join(args.dump_path, "bf_checkpoint.json")
+    checkpoint = WorkCheckpoint(
+        checkpoint_path,
+        {
+            k: getattr(args, k)
+            for k in ["path", "secret_type", "full_hw", "seed", "bf_dim", "min_bf_hw", "max_bf_hw", "mlwe_k", "secret_window"]
+        }
+        | {"start": start, "stop": stop},
+    )
+
     start_time = time()
-    success = False
-    if len(devices) == 1:
-        success = worker(args, devices[0], thresholds[0], thresholds[1])
-    else:
-        with Pool(len(devices)) as p:
-            p.starmap(
-                worker,
-                [
-                    (args, device, thresholds[i], thresholds[i + 1])
-                    for i, device in enumerate(devices)
-                ],
-            )
+    success = run_work_queue(
+        worker_setup, args, devices, checkpoint, start, stop, args.chunk_size
+    )
+    if success:
+        # write a file
+        with open("found_secret.txt", "w") as f:
+            f.write(json.dumps(vars(args)))
     end_time = time()
     logger.info(f"Attack took {end_time - start_time} seconds")
     return success, end_time - start_time
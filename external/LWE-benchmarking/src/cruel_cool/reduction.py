@@ -9,11 +9,10 @@ LICENSE file in the root directory of this source tree.
 from logging import getLogger
 import os
 import numpy as np
-from subprocess import Popen, PIPE
 import sys
 
 sys.path.append("./")
-from src.generate.lllbkz import encode_intmat, decode_intmat
+from src.generate.flatter_io import run_intmat_command
 
 logger = getLogger()
 
@@ -32,21 +31,16 @@ def reduce_with_BKZ(mat):
 
 
 def reduce_with_flatter(Ap, alpha=0.025):
-    from fpylll import BKZ, GSO, IntegerMatrix
-
     """
     Runs a single loop of flatter.
     """
-    fplll_Ap = IntegerMatrix.from_matrix(Ap.tolist())
-    fplll_Ap_encoded = encode_intmat(fplll_Ap)
     env = os.environ.copy()
     env["OMP_NUM_THREADS"] = "1"
     try:
-        p = Popen(["flatter", "-alpha", str(alpha)], stdin=PIPE, stdout=PIPE, env=env)
+        Ap = run_intmat_command(["flatter", "-alpha", str(alpha)], Ap, env=env)  # output from the flatter run.
     except Exception as e:
         logger.error(f"flatter failed with error {e}")
-    out, _ = p.communicate(input=fplll_Ap_encoded)  # output from the flatter run.
-    Ap = decode_intmat(out)
+        raise
     return Ap
 
 
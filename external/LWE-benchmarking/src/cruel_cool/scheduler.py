@@ -0,0 +1,193 @@
+""""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Local work queue for the brute force: the coordinator (the main process) splits
+the rank range into small chunks and hands them to worker processes one at a
+time over multiprocessing queues (local pipes, no network). Completed chunks are
+recorded in a JSON checkpoint so an interrupted run resumes where it stopped, and
+all workers stop as soon as one of them verifies the secret.
+"""
+
+from collections import deque
+from logging import getLogger
+import json
+import multiprocessing
+import os
+import queue
+
+logger = getLogger()
+
+
+class WorkCheckpoint:
+    """
+    Completed [start, stop) rank ranges of a brute force run, kept merged and sorted,
+    and whether the secret was found. Saved atomically after every update.
+    config identifies the run; resuming with a different config is an error.
+    """
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.done = []
+        self.found = False
+        if os.path.exists(path):
+            with open(path) as fd:
+                state = json.load(fd)
+            assert (
+                state["config"] == config
+            ), f"checkpoint {path} was written for another run: {state['config']}"
+            self.done = [tuple(r) for r in state["done"]]
+            self.found = state["found"]
+            logger.info(f"Resuming from {path}: {self.n_done()} ranks done")
+
+    def n_done(self):
+        return sum(stop - start for start, stop in self.done)
+
+    def pending(self, start, stop, chunk_size):
+        """Chunks of at most chunk_size ranks of [start, stop) not done yet."""
+        chunks = []
+        for gap_start, gap_stop in self._gaps(start, stop):
+            for a in range(gap_start, gap_stop, chunk_size):
+                chunks.append((a, min(a + chunk_size, gap_stop)))
+        return chunks
+
+    def _gaps(self, start, stop):
+        for done_start, done_stop in self.done:
+            if done_start > start:
+                yield start, min(done_start, stop)
+            start = max(start, done_stop)
+            if start >= stop:
+                return
+        if start < stop:
+            yield start, stop
+
+    def mark_done(self, start, stop):
+        merged = []
+        for r in sorted(self.done + [(start, stop)]):
+            if merged and r[0] <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], r[1]))
+            else:
+                merged.append(r)
+        self.done = merged
+        self.save()
+
+    def mark_found(self):
+        self.found = True
+        self.save()
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump({"config": self.config, "done": self.done, "found": self.found}, fd)
+        os.replace(tmp_path, self.path)
+
+
+def _worker_loop(setup, args, device, worker_id, tasks, results, stop_event):
+    """
+    setup(args, device, worker_id) returns run(start, stop, stop_event) -> bool,
+    built once per process so data loading is not repeated for every chunk.
+    """
+    run = setup(args, device, worker_id)
+    results.put(("ready", worker_id, None, False))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        found = run(task[0], task[1], stop_event)
+        if found:
+            stop_event.set()
+        results.put(("done", worker_id, task, found))
+
+
+def run_work_queue(setup, args, devices, checkpoint, start, stop, chunk_size):
+    """
+    Runs the chunks of [start, stop) still pending in checkpoint on len(devices)
+    worker processes (one per entry, devices may repeat) and returns True if the
+    secret was found. Chunks of a worker that dies are handed to the others; chunks
+    interrupted because another worker found the secret are not marked done. Idle
+    workers are only retired once no chunk is pending or in flight, so that they can
+    take over the chunk of a worker that dies.
+    """
+    if checkpoint.found:
+        logger.info("Checkpoint says the secret was already found.")
+        return True
+    pending = deque(checkpoint.pending(start, stop, chunk_size))
+    logger.info(f"{len(pending)} chunks of up to {chunk_size} ranks to run")
+    if not pending:
+        return False
+
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    stop_event = ctx.Event()
+    task_queues = [ctx.Queue() for _ in devices]
+    procs = [
+        ctx.Process(
+            target=_worker_loop,
+            args=(setup, args, device, i, task_queues[i], results, stop_event),
+        )
+        for i, device in enumerate(devices)
+    ]
+    for p in procs:
+        p.start()
+
+    active = set(range(len(procs)))
+    idle = set()
+    in_flight = {}
+    found = False
+    while active:
+        for worker_id in list(active):
+            if not procs[worker_id].is_alive():
+                active.discard(worker_id)
+                idle.discard(worker_id)
+                if worker_id in in_flight:
+                    pending.appendleft(in_flight.pop(worker_id))
+                logger.warning(
+                    f"worker {worker_id} died (exit code {procs[worker_id].exitcode})"
+                )
+
+        while idle and pending and not found:
+            worker_id = idle.pop()
+            in_flight[worker_id] = pending.popleft()
+            task_queues[worker_id].put(in_flight[worker_id])
+        if found or not (pending or in_flight):
+            for worker_id in idle:
+                task_queues[worker_id].put(None)
+                active.discard(worker_id)
+            idle.clear()
+        if not active:
+            break
+
+        try:
+            kind, worker_id, task, hit = results.get(timeout=1)
+        except queue.Empty:
+            continue
+        if worker_id not in active:
+            # Its chunk was already handed back when it was found dead.
+            if kind == "done" and hit:
+                found = True
+                checkpoint.mark_found()
+            continue
+
+        if kind == "done":
+            del in_flight[worker_id]
+            if hit:
+                found = True
+                checkpoint.mark_done(*task)
+                checkpoint.mark_found()
+                logger.info(f"worker {worker_id} found the secret in ranks {task}")
+            elif not stop_event.is_set():
+                checkpoint.mark_done(*task)
+                logger.info(
+                    f"ranks {task} done, {checkpoint.n_done()} / {stop - start} in total"
+                )
+        idle.add(worker_id)
+
+    for p in procs:
+        p.join()
+    if pending and not found:
+        logger.error(f"all workers died with {len(pending)} chunks left")
+    return found
@@ -13,9 +13,10 @@ import numpy as np
 import math
 import time
 import itertools
-from sklearn.linear_model import LinearRegression
 import sys
 
+from src.utils import SecretVerifier
+
 logger = getLogger()
 
 
@@ -42,14 +43,14 @@ def brute_force_one_batch(
     batch_size = secret_combs.shape[0]
     total_batch_size = batch_size * n_multipliers
     secret_cands = torch.zeros(
-        total_batch_size, brute_force_dim, device=RAs.device, dtype=torch.float16
+        total_batch_size, brute_force_dim, device=RAs.device, dtype=RAs.dtype
     )
     # secret_combs tell us where non-zero entries are.
     # multipliers tell us what the possible entries are, (-1, 1) for ternary and so on
     multipliers = torch.tensor(
         list(itertools.product(possible_values, repeat=hw)),
         device=RAs.device,
-        dtype=torch.float16,
+        dtype=RAs.dtype,
     )
 
     # expand them to use for scatter
@@ -77,7 +78,136 @@ def brute_force_one_batch(
     return top_n
 
 
+def row_std(x):
+    """
+    Unbiased std of each row from the row sum and sum of squares (accumulated in
+    float32), several times faster than Tensor.std on CPU.
+    """
+    x = x if x.is_floating_point() else x.to(torch.float32)
+    n = x.shape[1]
+    total = x.sum(1, dtype=torch.float32)
+    squares = torch.linalg.vector_norm(x, dim=1, dtype=torch.float32) ** 2
+    return ((squares - total * total / n) / (n - 1)).clamp_min(0).sqrt()
+
+
+def brute_force_one_batch_sparse(
+    secret_combs: torch.Tensor,
+    RAs: torch.Tensor,
+    RBs: torch.Tensor,
+    top_n,
+    Q,
+    brute_force_dim,
+    possible_values=(1,),  # (-1, 1) for ternary
+    chunk_elems=2**20,
+):
+    """
+    Same as brute_force_one_batch, but each candidate's dot products are the sum of
+    its hw selected (signed) columns of RAs instead of a dense matmul. The index
+    tuples are walked as a prefix tree: partial sums are computed once per distinct
+    prefix of consecutive rows (lexicographic batches share most prefixes) and per
+    prefix of the multipliers. The last level, which holds one row per candidate, is
+    reduced to test statistics chunk by chunk in a reused buffer.
+    Works with float RAs or with integer RAs (then Q is the integer modulus).
+    """
+    keep_n_tops = top_n[0].shape[0]
+    batch_size, hw = secret_combs.shape
+    n_data = RAs.shape[0]
+    n_values = len(possible_values)
+    columns = RAs.T.contiguous()
+    values = torch.tensor(possible_values, device=RAs.device, dtype=RAs.dtype)
+    values = values.view(1, -1, 1)
+
+    # sums[p, m]: RAs @ cand - RBs for index prefix p and multiplier prefix m.
+    sums = -RBs.view(1, 1, -1)
+    parents = torch.zeros(batch_size, dtype=torch.int64, device=RAs.device)
+    for j in range(hw - 1):
+        prefixes, inverse, counts = torch.unique_consecutive(
+            secret_combs[:, : j + 1], dim=0, return_inverse=True, return_counts=True
+        )
+        firsts = torch.cumsum(counts, 0) - counts
+        steps = values * columns[prefixes[:, j]].unsqueeze(1)
+        sums = (sums[parents[firsts]].unsqueeze(2) + steps.unsqueeze(1)).flatten(1, 2)
+        parents = inverse
+
+    # Last level: (candidate rows, multipliers of the prefix, last multiplier, data).
+    n_multipliers = sums.shape[1] * n_values
+    rows_per_chunk = max(1, chunk_elems // (n_multipliers * n_data))
+    buffer = torch.empty(
+        (min(rows_per_chunk, batch_size), sums.shape[1], n_values, n_data),
+        device=RAs.device,
+        dtype=RAs.dtype,
+    )
+    test_stat = torch.empty(
+        batch_size * n_multipliers, device=RAs.device, dtype=top_n[0].dtype
+    )
+    for start in range(0, batch_size, rows_per_chunk):
+        stop = min(start + rows_per_chunk, batch_size)
+        steps = values * columns[secret_combs[start:stop, -1]].unsqueeze(1)
+        dot = buffer[: stop - start]
+        torch.add(sums[parents[start:stop]].unsqueeze(2), steps.unsqueeze(1), out=dot)
+        dot %= Q
+        test_stat[start * n_multipliers : stop * n_multipliers] = row_std(
+            dot.view(-1, n_data)
+        )
+    biggest_stds = test_stat.topk(min(keep_n_tops, len(test_stat)))
+
+    # Only materialize the candidates that made it to the top.
+    rows = biggest_stds.indices // n_multipliers
+    multipliers = torch.tensor(
+        list(itertools.product(possible_values, repeat=hw)),
+        device=RAs.device,
+        dtype=top_n[1].dtype,
+    )[biggest_stds.indices % n_multipliers]
+    best_cands = torch.zeros(
+        len(rows), brute_force_dim, device=RAs.device, dtype=top_n[1].dtype
+    )
+    best_cands.scatter_(1, secret_combs[rows], multipliers)
+
+    top_2n = torch.cat([top_n[0], biggest_stds.values])
+    top_2n_secrets = torch.cat([top_n[1], best_cands])
+    new_topn = top_2n.topk(keep_n_tops)
+    return [new_topn.values, top_2n_secrets[new_topn.indices]]
+
+
+def unrank_combinations(n, k, ranks):
+    """
+    Lexicographic unranking (same order as itertools.combinations(range(n), k)) of a
+    tensor of ranks, with the combinatorial number system: rank r of the combination
+    c is C(n, k) - 1 - sum_i C(n - 1 - c_i, k - i). Each position is one searchsorted
+    in a table of binomials, so any rank costs the same. Returns a (len(ranks), k)
+    int64 tensor on the device of ranks.
+    """
+    assert math.comb(n, k) < 2**63, "ranks don't fit in int64"
+    table = torch.tensor(
+        [[math.comb(a, j) for a in range(n)] for j in range(k + 1)],
+        dtype=torch.int64,
+        device=ranks.device,
+    )
+    dual = math.comb(n, k) - 1 - ranks
+    combs = torch.empty((len(ranks), k), dtype=torch.int64, device=ranks.device)
+    for i in range(k):
+        # Largest a with C(a, k - i) <= dual, strictly decreasing along i.
+        a = torch.searchsorted(table[k - i], dual, right=True) - 1
+        dual = dual - table[k - i][a]
+        combs[:, i] = n - 1 - a
+    return combs
+
+
+BF_KERNELS = {"dense": brute_force_one_batch, "sparse": brute_force_one_batch_sparse}
+
+
 class Annealer:
+    """
+    Population annealer for binary secrets: n_chains chains advance together as one
+    tensor, each at its own temperature (a geometric ladder from 1 down to
+    min_temp_ratio, all cooled from 1 -> 1e-2 over max_steps), with swap moves
+    between neighbouring temperatures every swap_every steps (parallel tempering).
+    The first brute_force_dim bits of secret_cand are fixed; a move swaps one active
+    and one inactive bit of the rest, keeping the hamming weight at total_hw. The
+    residuals RA @ secret - RB are updated with the two changed columns only and
+    recomputed every resync_every steps to stop rounding drift.
+    """
+
     def __init__(
         self,
         RA,
@@ -88,73 +218,121 @@ class Annealer:
         brute_force_dim,
         max_steps=None,
         accept_scaling=1.0,
+        n_chains=256,
+        swap_every=10,
+        min_temp_ratio=1e-2,
+        resync_every=100,
     ):
         # cooling: go down from 1 -> 1e-2 exponentially
         self.cooling = (1e-2) ** (1.0 / max_steps)
+        self.max_steps = max_steps
         self.device = RA.device
         self.q = Q
-        self.RA = RA
-        self.RB = Rb
+        self.RA = RA.to(torch.float32)
+        self.RB = Rb.to(torch.float32)
         self.dim = secret_cand.shape[0]
         self.bf_dim = brute_force_dim
         self.bf_hw = int(secret_cand[: self.bf_dim].sum().item())
         self.other_hw = total_hw - self.bf_hw
         self.hamming_weight = total_hw
-        self.secret_cand = secret_cand
-        # assume i know the target hamming weight
-        self.secret_cand[self.bf_dim : self.bf_dim + self.other_hw] = 1
-        self.secret_cand[self.bf_dim + self.other_hw :] = 0
-        self.temp = 1.0
-        self.loss = 1e9
         self.accept_scaling = accept_scaling
-        self.step_up_prob = 0
-        self.best_secret = self.secret_cand
-        self.best_loss = 1e9
-
-    def generate_new_secret_with_hw(self):
-        n_changes = 1
-        # now we move `n_changes` bits to something new
-        # first, we choose which bits to change
-        secret_cand_new = self.secret_cand[self.bf_dim :].clone()
-        # we choose `n_changes` bits to change
-        # random choice from the currently active bits
-        make_this_0 = self.secret_cand[self.bf_dim :].multinomial(n_changes)
-        # take another one from the inactive bits
-        make_this_1 = (1 - self.secret_cand[self.bf_dim :]).multinomial(n_changes)
-        secret_cand_new[make_this_0] = 0
-        secret_cand_new[make_this_1] = 1
-        return torch.cat([self.secret_cand[: self.bf_dim], secret_cand_new])
+        self.n_chains = n_chains
+        self.swap_every = swap_every
+        self.resync_every = resync_every
+        self.n_steps = 0
+
+        # Columns of the free bits, (n_free, m), and the fixed part of the residual.
+        self.columns = self.RA[:, self.bf_dim :].T.contiguous()
+        self.fixed = secret_cand[: self.bf_dim].to(self.RA)
+        n_free = self.dim - self.bf_dim
+        assert 0 <= self.other_hw <= n_free
+
+        # Random initial placement of the other_hw active bits in each chain.
+        ranks = torch.rand(n_chains, n_free, device=self.device).argsort(dim=1)
+        self.secrets = (ranks < self.other_hw).to(self.RA.dtype)
+        self.resync()
+
+        self.temps = min_temp_ratio ** torch.linspace(
+            0, 1, n_chains, device=self.device
+        )
+        self.best_loss = self.loss.min()
+        self.best_secret = self.full_secret(self.loss.argmin())
+
+    def full_secret(self, chain):
+        return torch.cat([self.fixed, self.secrets[chain]])
+
+    def resync(self):
+        self.residual = (
+            self.RA[:, : self.bf_dim] @ self.fixed
+            + self.secrets @ self.columns
+            - self.RB
+        )
+        self.loss = -row_std(self.residual % self.q)
 
     def accept_step(self, loss_new):
-        # self.temp goes from 1 -> 0.
-        # at self.temp = 0, step_up_prob should be 0
+        # self.temps go from 1 -> 0.
+        # at temp = 0, step_up_prob should be 0
         # in between it should be dependent on the loss difference
         loss_diff = self.loss - loss_new
-        if loss_diff > 0:
-            return True
-        else:
-            step_up_prob = torch.exp(loss_diff / (self.temp * self.accept_scaling))
-            self.step_up_prob = step_up_prob
-            return torch.rand(1, device=self.device) < step_up_prob
+        step_up_prob = torch.exp(loss_diff / (self.temps * self.accept_scaling))
+        rand = torch.rand(self.n_chains, device=self.device)
+        return (loss_diff > 0) | (rand < step_up_prob)
+
+    def swap_step(self):
+        """Metropolis swaps between neighbouring temperatures, even or odd pairs."""
+        first = torch.arange(
+            (self.n_steps // self.swap_every) % 2, self.n_chains - 1, 2, device=self.device
+        )
+        second = first + 1
+        log_prob = (self.loss[first] - self.loss[second]) * (
+            1 / self.temps[first] - 1 / self.temps[second]
+        ) / self.accept_scaling
+        swap = torch.rand(len(first), device=self.device).log() < log_prob
+        perm = torch.arange(self.n_chains, device=self.device)
+        perm[first[swap]], perm[second[swap]] = second[swap], first[swap]
+        self.secrets = self.secrets[perm]
+        self.residual = self.residual[perm]
+        self.loss = self.loss[perm]
 
     def step(self):
-        # 1. generate new binary secret (hamming dist depends on temp)
-        secret_new = self.generate_new_secret_with_hw()
-        # 2. compute loss
-        loss_new = -((self.RA @ secret_new - self.RB) % self.q).std()
-        # accept with probability
-        if self.accept_step(loss_new):
-            self.loss = loss_new
-            self.secret_cand = secret_new
-        self.temp *= self.cooling  # cooling
-
-        if self.loss < self.best_loss:
-            self.best_loss = self.loss
-            self.best_secret = self.secret_cand
+        chains = torch.arange(self.n_chains, device=self.device)
+        if 0 < self.other_hw < len(self.columns):
+            # 1. in every chain, move one active bit to an inactive position
+            make_this_0 = self.secrets.multinomial(1).squeeze(1)
+            make_this_1 = (1 - self.secrets).multinomial(1).squeeze(1)
+            # 2. loss from the two changed columns only
+            residual_new = (
+                self.residual - self.columns[make_this_0] + self.columns[make_this_1]
+            )
+            loss_new = -row_std(residual_new % self.q)
+            # accept with probability
+            accept = self.accept_step(loss_new)
+            self.residual[accept] = residual_new[accept]
+            self.loss[accept] = loss_new[accept]
+            self.secrets[chains[accept], make_this_0[accept]] = 0
+            self.secrets[chains[accept], make_this_1[accept]] = 1
+        self.n_steps += 1
+        if self.n_steps % self.swap_every == 0:
+            self.swap_step()
+        if self.n_steps % self.resync_every == 0:
+            self.resync()
+        self.temps *= self.cooling  # cooling
+
+        best_chain = self.loss.argmin()
+        if self.loss[best_chain] < self.best_loss:
+            self.best_loss = self.loss[best_chain]
+            self.best_secret = self.full_secret(best_chain)
+
+    def run(self):
+        for _ in range(self.max_steps):
+            self.step()
+        return self.best_secret
 
 
 class Attacker:
     MAX_GPU_MEM = 16 * 1024**3
+    MAX_CPU_MEM = 4 * 1024**3
+    MAX_COMPLETION_ELEMS = 2**26
 
     def __init__(
         self,
@@ -170,6 +348,12 @@ class Attacker:
         compile_bf=True,
         mlwe_k=False,
         secret_window=0,
+        bf_kernel="sparse",
+        bf_dtype="auto",
+        completion="linear",
+        full_hw=None,
+        anneal_chains=256,
+        anneal_steps=2000,
     ):
         RAs = data.RA
         RBs = data.RB
@@ -177,15 +361,13 @@ class Attacker:
         self.origB = data.origB
         self.origQ = data.params.Q
         self.sigma = data.params.sigma
+        self.verifier = SecretVerifier(self.origA, self.origB, self.origQ, self.sigma)
       
         self.Q = 10
         RAs = RAs / self.origQ * self.Q
         RBs = RBs / self.origQ * self.Q
    
 
-        self.RAs = torch.tensor(RAs, dtype=torch.float16)
-        self.RBs = torch.tensor(RBs, dtype=torch.float16)
-
         selection_for_bf = torch.randperm(len(RAs))[:n_data_for_brute_force]
         selection_for_G = torch.randperm(len(RAs))[:n_data_for_greedy]
 
@@ -202,13 +384,19 @@ class Attacker:
             self.secret_dim, mlwe_k, brute_force_dim, window_start
         )
 
+        # Kept in float32 here, cast to the brute force dtype once the device is known.
         self.RAs_BF = torch.tensor(
-            RAs[selection_for_bf][:, self.dim_selection_for_bf], dtype=torch.float16
+            RAs[selection_for_bf][:, self.dim_selection_for_bf], dtype=torch.float32
+        )
+        self.RBs_BF = torch.tensor(RBs[selection_for_bf], dtype=torch.float32)
+        # Exact residues for the int32 kernel, which works mod origQ directly.
+        self.RAs_BF_int = torch.from_numpy(
+            data.RA[selection_for_bf][:, self.dim_selection_for_bf] % self.origQ
         )
-        self.RBs_BF = torch.tensor(RBs[selection_for_bf], dtype=torch.float16)
+        self.RBs_BF_int = torch.from_numpy(data.RB[selection_for_bf] % self.origQ)
 
-        self.RAs_G = torch.tensor(RAs[selection_for_G], dtype=torch.float16)
-        self.RBs_G = torch.tensor(RBs[selection_for_G], dtype=torch.float16)
+        self.RAs_G = torch.tensor(RAs[selection_for_G], dtype=torch.float32)
+        self.RBs_G = torch.tensor(RBs[selection_for_G], dtype=torch.float32)
 
         self.brute_force_dim = brute_force_dim
     
@@ -218,6 +406,20 @@ class Attacker:
         self.use_tqdm = use_tqdm
         self.compile_bf = compile_bf
         self.secret_type = secret_type
+        self._completion_pinv = None
+        assert bf_kernel in BF_KERNELS, bf_kernel
+        assert bf_dtype in ("auto", "float16", "float32", "int32"), bf_dtype
+        assert not (bf_kernel == "dense" and bf_dtype == "int32")
+        self.bf_kernel = bf_kernel
+        self.bf_dtype = bf_dtype
+        assert completion in ("linear", "greedy", "anneal"), completion
+        if completion == "anneal":
+            assert secret_type == "binary", "annealing completion is for binary secrets"
+            assert full_hw is not None, "annealing completion needs the full hamming weight"
+        self.completion = completion
+        self.full_hw = full_hw
+        self.anneal_chains = anneal_chains
+        self.anneal_steps = anneal_steps
 
     def get_partitions(self, N, k, u, secret_window_start):
         if k == 0:
@@ -237,106 +439,148 @@ class Attacker:
         return dim_selection_for_bf, complementary_partition
 
     def secret_found(self, cand):
-        cand = cand.cpu().numpy()
-        err_pred = (self.origA @ cand - self.origB) % self.origQ
-        err_pred[err_pred > self.origQ // 2] -= self.origQ
-        return (np.std(err_pred) < 2 * self.sigma).item()
-    
+        return bool(self.verifier(cand)[0])
+
     def check_partial_candidates(
-        self, cands, RAs_G, RBs_G, which="linear", possible_values=[1, 2, 3]
+        self, cands, RAs_G, RBs_G, which=None, possible_values=[1, 2, 3]
     ):
-        for cand in cands:
-            if which == "greedy":
-                full_cand = self.greedy_secret_completion(cand, RAs_G, RBs_G)
-            elif which == "linear":
-                full_cand = self.linear_secret_completion(
-                    cand, RAs_G, RBs_G, possible_values
-                )
-            else:
-                raise ValueError(f'unknown method for secret completion "{which}"')
-            found = self.secret_found(full_cand)
-            
-            if found:
-                logger.info(f"SUCCESS! secret non zeros {full_cand.cpu().numpy().nonzero()}")
-                return True
-           
+        which = which or self.completion
+        if len(cands) == 0:
+            return False
+        if which == "anneal":
+            full_cands = torch.stack(
+                [self.anneal_secret_completion(cand, RAs_G, RBs_G) for cand in cands]
+            )
+        elif which == "greedy":
+            full_cands = torch.stack(
+                [self.greedy_secret_completion(cand, RAs_G, RBs_G) for cand in cands]
+            )
+        elif which == "linear":
+            full_cands = self.linear_secret_completion_batch(
+                cands, RAs_G, RBs_G, possible_values
+            )
+        else:
+            raise ValueError(f'unknown method for secret completion "{which}"')
+        full_cands = full_cands.cpu().to(torch.int64)
+
+        found = self.verifier.first_match(full_cands)
+        if found is not None:
+            logger.info(
+                f"SUCCESS! secret non zeros {full_cands[found].numpy().nonzero()}"
+            )
+            return True
+
         return False
 
+    def completion_pinv(self, RAs_G):
+        """
+        Pseudo-inverse of the centered design matrix of the linear completion. It only
+        depends on RAs_G, so it is computed once per attack and reused across flushes.
+        """
+        if self._completion_pinv is None or self._completion_pinv.device != RAs_G.device:
+            x = center(RAs_G[:, self.reduced_dims].to(torch.float64), self.Q)
+            self._completion_pinv = torch.linalg.pinv(x - x.mean(dim=0))
+        return self._completion_pinv
+
     @torch.inference_mode()
     def linear_secret_completion(self, cand, RAs_G, RBs_G, possible_values):
-        model = LinearRegression()
-        partial_cand = torch.zeros(
-            size=(self.secret_dim,), dtype=RAs_G.dtype, device=cand.device
+        return self.linear_secret_completion_batch(
+            cand.unsqueeze(0), RAs_G, RBs_G, possible_values
+        )[0]
+
+    @torch.inference_mode()
+    def linear_secret_completion_batch(self, cands, RAs_G, RBs_G, possible_values):
+        """
+        Completes (K, brute_force_dim) candidates on the reduced dims by least squares
+        (with intercept) on the greedy data, solved for all K right-hand sides at once.
+        Each candidate's coefficients are normalized, rounded at every possible scale,
+        and the (candidate, scale) pair with the smallest residual std is kept.
+        """
+        RAs_G = RAs_G.to(torch.float32)
+        RBs_G = RBs_G.to(torch.float32)
+        n_cands = len(cands)
+
+        partial_cands = torch.zeros(
+            (n_cands, self.secret_dim), dtype=RAs_G.dtype, device=RAs_G.device
         )
-        partial_cand[self.dim_selection_for_bf] = cand
-        y_ = (
-            center((RBs_G - RAs_G @ partial_cand) % self.Q, self.Q)
-            .cpu()
-            .numpy()
-            .astype(np.float32)
+        partial_cands[:, self.dim_selection_for_bf] = cands.to(partial_cands)
+        y = center((RBs_G - partial_cands @ RAs_G.T) % self.Q, self.Q).to(torch.float64)
+        coefs = (y - y.mean(dim=1, keepdim=True)) @ self.completion_pinv(RAs_G).T
+
+        # Candidates with all-zero coefficients stay as they are.
+        max_coefs = coefs.abs().amax(dim=1, keepdim=True)
+        coefs = coefs / torch.where(max_coefs == 0, 1.0, max_coefs)
+
+        scales = sorted(set(np.abs(possible_values)))
+        scales = torch.tensor(scales, dtype=coefs.dtype, device=coefs.device)
+        full_cands = partial_cands.unsqueeze(1).repeat(1, len(scales), 1)
+        full_cands[:, :, self.reduced_dims] = (
+            (coefs.unsqueeze(1) * scales[:, None]).round().to(full_cands.dtype)
         )
-        x_ = (
-            center(RAs_G[:, self.reduced_dims], self.Q).cpu().numpy().astype(np.float32)
+
+        rows_per_chunk = max(1, self.MAX_COMPLETION_ELEMS // len(RBs_G))
+        stds = torch.cat(
+            [
+                center((RBs_G - chunk @ RAs_G.T) % self.Q, self.Q).std(dim=1)
+                for chunk in full_cands.view(-1, self.secret_dim).split(rows_per_chunk)
+            ]
         )
-        sigma = x_.flatten().std()
-        x = x_ / sigma
-        y = y_ / sigma
-        model.fit(x, y)
-
-        coefs = model.coef_
-        max_coef = np.abs(model.coef_).max()
-
-        if max_coef == 0:
-            return partial_cand
-
-        coefs /= max_coef
-
-        stds = []
-        candidates = []
-        scales = list(set(np.abs(possible_values)))
-
-        coefs = torch.from_numpy(coefs).to(cand.dtype).to(cand.device)
-        for scale in scales:
-            full_cand = partial_cand.clone()
-            full_cand[self.reduced_dims] = (coefs * scale).round()
-            candidates.append(full_cand)
-            stds.append(
-                center((RBs_G - RAs_G @ full_cand.to(RAs_G.device)) % self.Q, self.Q)
-                .to(torch.float32)
-                .std()
-                .cpu()
-                .numpy()
-            )
+        best = stds.view(n_cands, len(scales)).argmin(dim=1)
+        return full_cands[torch.arange(n_cands), best].to(int)
 
-        return candidates[np.argmin(stds)].to(int)
+    @torch.inference_mode()
+    def anneal_secret_completion(self, cand, RAs_G, RBs_G):
+        """
+        Completes a binary candidate with the population annealer, at the full
+        hamming weight. The annealer expects the brute forced bits first.
+        """
+        order = np.concatenate([self.dim_selection_for_bf, self.reduced_dims])
+        secret = torch.zeros(self.secret_dim, dtype=torch.float32, device=RAs_G.device)
+        secret[: self.brute_force_dim] = cand.to(secret)
+        if secret.sum() > self.full_hw:
+            return secret[np.argsort(order)]
+        annealer = Annealer(
+            RAs_G[:, order],
+            RBs_G,
+            secret,
+            self.full_hw,
+            self.Q,
+            self.brute_force_dim,
+            max_steps=self.anneal_steps,
+            n_chains=self.anneal_chains,
+        )
+        return annealer.run()[np.argsort(order)]
 
     @torch.inference_mode()
     def greedy_secret_completion(self, secret_cand, RAs_G, RBs_G):
-        secret = torch.zeros(self.secret_dim, dtype=torch.float16)
-        secret[self.dim_selection_for_bf] = secret_cand.cpu()
+        secret = torch.zeros(self.secret_dim, dtype=torch.float32)
+        secret[self.dim_selection_for_bf] = secret_cand.cpu().to(secret.dtype)
         secret_cand = secret.to(secret_cand.device)
 
-        current_std = ((RAs_G @ secret_cand - RBs_G) % self.Q).std()
-        for current_idx in self.reduced_dims:
-            secret_cand[current_idx] = 1
-            new_std = ((RAs_G @ secret_cand - RBs_G) % self.Q).std()
+        # Keep the residual up to date instead of recomputing RAs_G @ secret_cand.
+        RAs_G = RAs_G.to(torch.float32)
+        residual = RAs_G @ secret_cand - RBs_G.to(torch.float32)
+        columns = RAs_G[:, self.reduced_dims].T.contiguous()
+        current_std = (residual % self.Q).std()
+        for current_idx, column in zip(self.reduced_dims, columns):
+            new_residual = residual + column
+            new_std = (new_residual % self.Q).std()
             if new_std > current_std:
                 current_std = new_std
-            else:
-                secret_cand[current_idx] = 0
+                residual = new_residual
+                secret_cand[current_idx] = 1
         return secret_cand
 
-    @staticmethod
-    def _generate_in_batches(generator, batch_size):
-        while True:
-            batch = tuple(itertools.islice(generator, batch_size))
-            if not batch:
-                break
-            yield batch
-
-    def generate_from_to_in_batches(self, n, k, start, end, batch_size):
-        combinations = itertools.islice(itertools.combinations(range(n), k), start, end)
-        yield from self._generate_in_batches(combinations, batch_size)
+    def generate_from_to_in_batches(self, n, k, start, end, batch_size, device="cpu"):
+        """
+        Yields the combinations of rank [start, end) of itertools.combinations(range(n), k)
+        as (batch_size, k) int64 tensors on device, unranked directly from start.
+        """
+        for batch_start in range(start, end, batch_size):
+            ranks = torch.arange(
+                batch_start, min(batch_start + batch_size, end), device=device
+            )
+            yield unrank_combinations(n, k, ranks)
 
     def num_secrets_with_hw(self, hw):
         return math.comb(self.brute_force_dim, hw)
@@ -375,25 +619,15 @@ class Attacker:
         start_idx,
         stop_idx,
         device="cpu",
+        stop_event=None,
     ):
+        """
+        Brute forces the global ranks [start_idx, stop_idx) of the hamming weights
+        min_HW..max_HW. Returns early (False) once stop_event, if given, is set.
+        """
         hw_idxs = self.calculate_idxs_for_each_hw(min_HW, max_HW, start_idx, stop_idx)
         logger.info(hw_idxs)
 
-        top_n = [
-            torch.zeros(self.keep_n_tops, device=device, dtype=torch.float16),
-            torch.zeros(
-                (self.keep_n_tops, self.brute_force_dim),
-                device=device,
-                dtype=torch.float16,
-            ),
-        ]
-
-        RAs = self.RAs_BF.to(device)
-        RBs = self.RBs_BF.to(device)
-
-        RAs_G = self.RAs_G.to(device)
-        RBs_G = self.RBs_G.to(device)
-
         if self.secret_type == "binary":
             possible_values = (1,)
         elif self.secret_type == "ternary":
@@ -403,21 +637,39 @@ class Attacker:
         elif self.secret_type == "gaussian":
             possible_values = (-6, -5, -4, -3, -2, -1, 1, 2, 3, 4, 5, 6)
 
+        dtype = self.get_bf_dtype(device, max_HW, possible_values)
+        logger.info(f"brute force kernel: {self.bf_kernel}, dtype: {dtype}")
+        RAs, RBs, Q = self.get_bf_data(device, dtype)
+        top_n = self.empty_top_n(device, dtype)
+
+        RAs_G = self.RAs_G.to(device)
+        RBs_G = self.RBs_G.to(device)
+
         if self.compile_bf:
             logger.info("compiling brute force function")
-            brute_force_fn = torch.compile(brute_force_one_batch)
+            brute_force_fn = torch.compile(BF_KERNELS[self.bf_kernel])
         else:
-            brute_force_fn = brute_force_one_batch
+            brute_force_fn = BF_KERNELS[self.bf_kernel]
 
         for hamming_weight, (start, stop) in hw_idxs.items():
             logger.info(
                 f"hamming weight: {hamming_weight}, start: {start}, stop: {stop}"
             )
             optimal_batch_size = self.get_batch_size(
-                self.batch_size, hamming_weight, len(possible_values), len(RBs)
+                self.batch_size,
+                hamming_weight,
+                len(possible_values),
+                len(RBs),
+                device,
+                dtype,
             )
             generator = self.generate_from_to_in_batches(
-                self.brute_force_dim, hamming_weight, start, stop, optimal_batch_size
+                self.brute_force_dim,
+                hamming_weight,
+                start,
+                stop,
+                optimal_batch_size,
+                device,
             )
             length = math.ceil((stop - start) / optimal_batch_size)
 
@@ -428,16 +680,16 @@ class Attacker:
 
             batch_counter = 0
             for secret_combs in bar:
+                if stop_event is not None and stop_event.is_set():
+                    logger.info("stopping, another worker found the secret")
+                    return False
                 batch_counter += 1
-                secret_combs = torch.tensor(
-                    secret_combs, device=device, dtype=torch.int64
-                )
                 top_n = brute_force_fn(
                     secret_combs,
                     RAs,
                     RBs,
                     top_n,
-                    self.Q,
+                    Q,
                     self.brute_force_dim,
                     possible_values=possible_values,
                 )
@@ -449,16 +701,7 @@ class Attacker:
                         top_n[1], RAs_G, RBs_G, possible_values=possible_values
                     ):
                         return True
-                    top_n = [
-                        torch.zeros(
-                            self.keep_n_tops, device=device, dtype=torch.float16
-                        ),
-                        torch.zeros(
-                            (self.keep_n_tops, self.brute_force_dim),
-                            device=device,
-                            dtype=torch.float16,
-                        ),
-                    ]
+                    top_n = self.empty_top_n(device, dtype)
 
             logger.info(
                 f"finalizing HW {hamming_weight}, last check here, ran through {batch_counter} batches"
@@ -470,12 +713,48 @@ class Attacker:
         logger.info("done, secret not found")
         return False
 
-    def get_batch_size(self, batch_size, hw, possible_values, len_data):
+    def get_bf_dtype(self, device, max_HW, possible_values):
+        """
+        auto: float16 on accelerators, float32 on CPU where float16 arithmetic is slow.
+        int32 (sparse kernel only) works on exact residues mod origQ, as long as hw
+        columns can't overflow.
+        """
+        if self.bf_dtype == "int32":
+            max_sum = (max_HW * max(np.abs(possible_values)) + 1) * self.origQ
+            assert max_sum < 2**31, "int32 brute force would overflow for this Q"
+        if self.bf_dtype != "auto":
+            return getattr(torch, self.bf_dtype)
+        if torch.device(device).type == "cpu":
+            return torch.float32
+        return torch.float16
+
+    def get_bf_data(self, device, dtype):
+        """RAs, RBs and modulus for the brute force kernel in the given dtype."""
+        if dtype == torch.int32:
+            RAs = self.RAs_BF_int.to(torch.float64).round().to(dtype)
+            RBs = self.RBs_BF_int.to(torch.float64).round().to(dtype)
+            return RAs.to(device), RBs.to(device), self.origQ
+        return self.RAs_BF.to(device, dtype), self.RBs_BF.to(device, dtype), self.Q
+
+    def empty_top_n(self, device, dtype):
+        """[test statistics, candidates]; statistics are floats even for int32 data."""
+        stat_dtype = dtype if dtype.is_floating_point else torch.float32
+        return [
+            torch.zeros(self.keep_n_tops, device=device, dtype=stat_dtype),
+            torch.zeros(
+                (self.keep_n_tops, self.brute_force_dim), device=device, dtype=dtype
+            ),
+        ]
+
+    def get_batch_size(
+        self, batch_size, hw, possible_values, len_data, device="cuda", dtype=torch.float16
+    ):
         """Get max batch size given the bottleneck (secret_cands @ RAs.T) of
         size (len_data x batch_size*possible_values^hw)"""
-        fp16_size = 2
-        max_batch_size = self.MAX_GPU_MEM / (
-            fp16_size * possible_values**hw * len_data
+        elem_size = torch.empty(0, dtype=dtype).element_size()
+        on_cpu = torch.device(device).type == "cpu"
+        max_batch_size = (self.MAX_CPU_MEM if on_cpu else self.MAX_GPU_MEM) / (
+            elem_size * possible_values**hw * len_data
         )
         max_batch_size = int(max_batch_size)
         logger.info(f"Max batch size: {max_batch_size}, batch size: {batch_size}")
@@ -35,6 +35,8 @@ def get_parser():
                         help="Experiment dump path")
     parser.add_argument("--resume_path", type=str, default="",
                         help="Path to load the checkpoints")
+    parser.add_argument("--checkpoint_compress", type=bool_flag, default=False,
+                        help="Save the worker matrix checkpoints as compressed .npz files")
     parser.add_argument("--exp_name", type=str, default="debug",
                         help="Experiment name")
     parser.add_argument("--exp_id", type=str, default="",
@@ -79,6 +81,8 @@ def get_parser():
     parser.add_argument("--hamming", type=int, default=-1, 
                         help="hamming weight of secret")
     parser.add_argument("--num_bits_in_table", type=int, default=-1, help="Number of bits we assume are in table. Default is hamming // 2.")
+    parser.add_argument("--mitm_batch_size", type=int, default=8192, help="Number of half secret guesses hashed or looked up at once.")
+    parser.add_argument("--max_boundary_bits", type=int, default=20, help="Skip MITM queries with more boundary bits than this (2^bits lookups each).")
     parser.add_argument("--secret_type", type=str, default='binary', help="what secret distribution")
     parser.add_argument('--mlwe_k', type=int, default=0) # LWE = 0, RLWE=1, MLWE = k > 1 (k is the number of modules). 
 
@@ -129,6 +133,7 @@ def get_data_one_worker(i, params):
         gen_more = True
         while gen_more:
             gen_more = sampleGen.generate()
+        sampleGen.checkpoint.flush()
     else:
         mitm = MITM(params, logger, i)
         mitm.run()
@@ -207,6 +212,9 @@ if __name__ == '__main__':
         if params.bound > 0: 
             dual_params.bound = params.bound
 
+        dual_params.mitm_batch_size = params.mitm_batch_size
+        dual_params.max_boundary_bits = params.max_boundary_bits
+
         params = dual_params # just use the same params as before.
         params.local_rank = -1
         params.step = 'mitm' # Set the right flag.
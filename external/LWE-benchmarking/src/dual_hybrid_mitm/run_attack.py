@@ -8,7 +8,6 @@ LICENSE file in the root directory of this source tree.
 
 import os
 import numpy as np
-import io
 import glob
 import sys
 import pickle as pkl
@@ -16,11 +15,18 @@ from time import time
 from tqdm import tqdm
 sys.path.append('.')
 from src.generate.genSamples import InterleavedReduction
-from utils import calc_std_mitm, mitm_params, polish
-from src.generate.lllbkz import get_mlwe_circ, centered, centered_int
+from utils import calc_std_mitm, mitm_params
+from src.generate.lllbkz import get_mlwe_circ, centered, centered_int, polish
+from src.generate.records import RecordWriter, SHARD_EXT, find_shards, read_shard
+from src.generate.checkpoint import MatrixCheckpoint, load_matrix
 import subprocess
 import itertools
 
+# Number of coordinates packed into the uint64 MITM keys, how many keys are looked up at once,
+# and how many key collisions are verified on the full vectors at once.
+KEY_BITS = 64
+LOOKUP_CHUNK = 2**20
+VERIFY_CHUNK = 2**14
 
 FLOAT_UPGRADE = {
     'double': 'long double',
@@ -43,7 +49,8 @@ class DualHybrid(InterleavedReduction):
         self.seed = [params.global_rank, params.env_base_seed, thread]
         # env_base_seed: different jobs will generate different data
         # thread: different workers will not generate same data
-        self.export_path_prefix = os.path.join(params.dump_path, f"data_{thread}.prefix")
+        self.export_path = os.path.join(params.dump_path, f"data_{thread}{SHARD_EXT}")
+        self.writer = None
 
         # If interleaving, set up interleaving params:
         self.stdev_tracker = []
@@ -58,9 +65,10 @@ class DualHybrid(InterleavedReduction):
         # Filenames for saving/loading
         self.matrix_filename = os.path.join(params.dump_path, f"matrix_{thread}.npy")
         self.resume_filename = os.path.join(params.resume_path, f"matrix_{thread}.npy")
-        if os.path.isfile(self.resume_filename):
-            mat_to_save = np.load(self.resume_filename)
-            np.save(self.matrix_filename, mat_to_save)
+        self.checkpoint = MatrixCheckpoint(self.matrix_filename, params.checkpoint_compress)
+        mat_to_save = load_matrix(self.resume_filename)
+        if mat_to_save is not None:
+            self.checkpoint.save(mat_to_save)
             self.logger.info(f"Resuming from {self.resume_filename}.")
         self.logger.info(f"Random generator seed: {self.seed}.")
 
@@ -213,17 +221,13 @@ class DualHybrid(InterleavedReduction):
             int_el = [int(1000*x) for x in el] # Turn into ints so you can store in numpy array.
             mat_to_save[-1, 2:min(2+len(self.stdev_tracker), 2+self.lookback)] = int_el if len(int_el) < self.lookback else int_el[-self.lookback:]
         mat_to_save[:, self.m:] = Y
-        np.save(self.matrix_filename, mat_to_save)
+        self.checkpoint.save(mat_to_save)
 
     def write(self, idxs, shortY):
-        # Write the length of the short vector because we need it to compute b. 
-        #assert X.shape[0] == Y.shape[0]
-        file_handler_prefix = io.open(self.export_path_prefix, mode="a", encoding="utf-8")
-        prefix0_str = str(self.thread)
-        prefix1_str = " ".join(idxs.astype(str)) # indexes of tinyA
-        prefix2_str = " ".join(shortY.astype(str)) # short vector from lattice reduction
-        file_handler_prefix.write(f"{prefix0_str} ; {prefix1_str} ; {prefix2_str}\n")#; {prefix3_str}\n")
-        file_handler_prefix.flush()
+        # Record: [thread, indexes of tinyA], with the short vector from lattice reduction as R.
+        if self.writer is None:
+            self.writer = RecordWriter(self.export_path, len(idxs) + 1, len(shortY))
+        self.writer.write(np.concatenate([[self.thread], idxs]), shortY[None, :])
         self.num_short += 1
 
     def compute_bound_from_cheon_code(self, shortvec):
@@ -274,8 +278,8 @@ class DualHybrid(InterleavedReduction):
         return None # if you return None, you didn't meet criteria; keep going 
 
     def generate(self):
-        if os.path.isfile(self.matrix_filename):
-            A_Ap = np.load(self.matrix_filename)
+        A_Ap = self.checkpoint.load()
+        if A_Ap is not None:
             UT, Ap = A_Ap[:, :self.num_tinyA_per_lattice], A_Ap[:, self.m:]
             algo_indicator = A_Ap[-1,0]
             if algo_indicator != 0:
@@ -334,6 +338,8 @@ class MITM(object):
         self.gamma = params.gamma
         if self.tau < 0: # Didn't set a limit. 
             self.tau = self.k
+        self.batch_size = params.mitm_batch_size
+        self.max_boundary_bits = params.max_boundary_bits
 
         assert self.k > 0 and self.tau > 0, "Must have k and tau > 0."
 
@@ -421,10 +427,16 @@ class MITM(object):
             lines.append(f"{s_str};{i_str};{sv_str};{path_str}\n") # Adds path to A vectors, since we need these. 
         return lines
 
+    def read_shards(self, paths):
+        for path in paths:
+            for idx, sv in read_shard(path):
+                yield idx[0], idx[1:], sv[0].astype(np.float64), os.path.dirname(path)
+
     def load_short_vectors_and_computeAb(self):
-        # Find the data.prefix file
+        # Record shards written by the workers, else the legacy data.prefix text files.
+        shard_paths = find_shards(self.short_vectors_path)
         data_prefix_path = os.path.join(self.short_vectors_path, "data.prefix")
-        if not os.path.isfile(data_prefix_path):
+        if not shard_paths and not os.path.isfile(data_prefix_path):
             # If you're not using slurm, don't need the extra *.
             if self.short_vectors_path[-1] == "/":
                 self.short_vectors_path = self.short_vectors_path[:-1]
@@ -437,9 +449,6 @@ class MITM(object):
                     for line in self.remove_redundant_rows(path):
                         outfile.write(line)
         
-        # Now load in the data
-        self.logger.info("Loading data from %s", data_prefix_path)
-
         length = 0
         redA, redB, lens = [], [], []
 
@@ -453,8 +462,15 @@ class MITM(object):
             Rb = centered_int((shortvec @ b) % self.Q, self.Q) # Now this becomes error
             return Ra2, Rb
 
+        if shard_paths:
+            self.logger.info("Loading data from %d record shards", len(shard_paths))
+            short_vectors = self.read_shards(shard_paths)
+        else:
+            self.logger.info("Loading data from %s", data_prefix_path)
+            short_vectors = self.read(data_prefix_path)
+
         # Compute short vectors from results in data.prefix
-        for seed, i, sv, A_path in self.read(data_prefix_path):
+        for seed, i, sv, A_path in short_vectors:
 
             origA = np.load(os.path.join(A_path, f"Avecs_{int(seed)}.npy"))
             if not os.path.exists(os.path.join(A_path, f"Bvecs_{int(seed)}_{self.secret_type}_h_{self.hamming}_seed_{self.params.secret_seed}.npy")):
@@ -508,65 +524,98 @@ class MITM(object):
 
         return redA, redB
     
-    def lsh(self, x):
-        m = len(x)
-        pow2 = np.array([2**i for i in range(m)])
-        return ((x % self.Q)  < self.Q//2).dot(pow2)
-
-    def get_boundary_elements(self, query):
-        # Given a vector a, list of a elements that are close to 0 or q.
-        # Query is in (-q/2, q/2)
-        absq = np.abs(query)
-        sgnvec = np.zeros(len(query))
-        sgnvec[query > 0] = 1
-        sgnvec[np.where(absq < self.bound)[0]] = -1
-        sgnvec[np.where(absq > self.Q//2 - self.bound)[0]] = -1
-        return sgnvec, np.where((absq < self.bound) | (absq > self.Q//2 - self.bound))[0]
-
-    def check_collision(self, query, A, sgnvec, Table, boundary_idx, index_num, orig_s):
+    def lsh(self, X):
+        """
+        Keys of a batch of vectors (n, tau) centered mod Q: bit j is set when X[:, j] lies in
+        [0, Q/2), for the first KEY_BITS coordinates, packed into one uint64 per row.
+        """
+        bits = (X[:, :KEY_BITS] % self.Q) < self.Q // 2
+        packed = np.packbits(bits, axis=1, bitorder="little")
+        packed = np.pad(packed, ((0, 0), (0, 8 - packed.shape[1])))
+        return np.ascontiguousarray(packed).view("<u8")[:, 0]
+
+    def get_boundary_elements(self, queries):
+        # Given a batch of queries in (-q/2, q/2), mask of the key coordinates close to 0 or q.
+        absq = np.abs(queries[:, :KEY_BITS])
+        return (absq < self.bound) | (absq > self.Q // 2 - self.bound)
+
+    def half_secrets(self, h, width):
+        """
+        All weight-h guesses on the k secret bits: (idx, sgn) with idx the nonzero positions
+        and sgn their nonzero values, padded to width columns with idx -1 and sgn 0.
+        """
+        combs = np.array(list(itertools.combinations(range(self.k), h)), dtype=np.int16)
+        values = [v for v in self.get_possible_bit_values() if v != 0]
+        sgns = np.array(list(itertools.product(values, repeat=h)), dtype=np.int8)
+        idx = np.full((len(combs) * len(sgns), width), -1, dtype=np.int16)
+        sgn = np.zeros((len(combs) * len(sgns), width), dtype=np.int8)
+        idx[:, :h] = np.repeat(combs, len(sgns), axis=0)
+        sgn[:, :h] = np.tile(sgns, (len(combs), 1))
+        return idx, sgn
+
+    def project(self, AT, idx, sgn):
+        # sum(AT[i] * s for i, s in zip(idx, sgn)) for each row, centered mod Q. Padding adds 0.
+        out = np.zeros((len(idx), AT.shape[1]), dtype=np.int64)
+        for j in range(idx.shape[1]):
+            out += AT[idx[:, j]] * sgn[:, j, None]
+        return centered(out % self.Q, self.Q)
+
+    def noisy_search(self, queries, q_idx, AT, keys, table_idx, table_sgn):
         '''
-        Recursive function to flip -1 bits in sgnvec and see if element represented by this in table. 
-
-        :param sgnvec: ternary vector to check
-
+        Using the bound B, search for all matches of a batch of queries in the table, which is
+        sorted by key. The bits of a query key that are on the boundary could go either way, so
+        all 2^|boundary| keys are enumerated (one doubling per boundary bit) and looked up at
+        once. Hits are checked on the full vectors and must not share a position with the query
+        guess q_idx. Returns the (query, table entry) index pairs that pass.
         '''
-        if index_num == len(boundary_idx):
-            lsh_vec = sum(el*2**i for i,el in enumerate(sgnvec))
-            if lsh_vec in Table:
-                self.logger.info("found possible match")
-                for s in Table[lsh_vec]:
-                    sgnbits = list(itertools.product(self.get_possible_bit_values(), repeat=len(s)))
-                    for sgn in sgnbits:
-                        vec = centered(sum(A[i]*_sgn for i, _sgn in zip(s, sgn)) % self.Q, self.Q)
-                        diff = centered((query - vec) % self.Q, self.Q)
-                        self.logger.info(f"diff: {diff}")
-                        self.logger.info(f"bound = {self.bound}, metrics on diff - norm: {np.linalg.norm(diff, np.inf)}, mean: {np.mean(np.abs(diff))}, std: {np.std(np.abs(diff))}, median: {np.median(np.abs(diff))}")
-                        if self.params.debug == True:
-                            self.logger.info(f"guess = {s}, {sgn}; other half = {orig_s}; true = {np.nonzero(self.s[-self.k:])}, {self.s[-self.k:][np.nonzero(self.s[-self.k:])[0]]}")
-                        # NOTE: using the linalg norm lets outliers dominate, which is bad, so we use median value instead. 
-                        if np.median(np.abs(diff)) < self.bound:
-                            return (s, sgn)
-        else:
-            for i in [0,1]:
-                sgnvec[boundary_idx[index_num]] = i
-                res = self.check_collision(query, A, sgnvec, Table, boundary_idx, index_num + 1, orig_s)
-                if res is not None:
-                    return res
-            
-    def noisy_search(self, query, A, Table, orig_s=None):
+        base = self.lsh(queries)
+        boundary = self.get_boundary_elements(queries)
+        n_boundary = boundary.sum(axis=1)
+        too_many = n_boundary > self.max_boundary_bits
+        self.n_skipped += int(too_many.sum())
+
+        hit_q, hit_t = [], []
+        for nb in np.unique(n_boundary[~too_many]):
+            rows = np.flatnonzero(n_boundary == nb)
+            # Boundary positions of each query, as bit masks.
+            pos = np.nonzero(boundary[rows])[1].reshape(len(rows), nb).astype(np.uint64)
+            flips = np.left_shift(np.uint64(1), pos)
+            chunk = max(1, LOOKUP_CHUNK >> int(nb))
+            for start in range(0, len(rows), chunk):
+                sub = rows[start : start + chunk]
+                cand = (base[sub] & ~np.bitwise_or.reduce(flips[start : start + chunk], axis=1))[:, None]
+                for j in range(nb):
+                    cand = np.concatenate([cand, cand | flips[start : start + chunk, j, None]], axis=1)
+                lo = np.searchsorted(keys, cand.ravel(), side="left")
+                hi = np.searchsorted(keys, cand.ravel(), side="right")
+                counts = hi - lo
+                if not counts.any():
+                    continue
+                # Expand the [lo, hi) ranges into table entries.
+                q = np.repeat(np.repeat(sub, cand.shape[1]), counts)
+                t = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+                self.n_collisions += len(q)
+                # The number of collisions is unbounded: verify them a slice at a time.
+                for v in range(0, len(q), VERIFY_CHUNK):
+                    keep = self.verify_hits(queries, q_idx, AT, table_idx, table_sgn, q[v : v + VERIFY_CHUNK], t[v : v + VERIFY_CHUNK])
+                    hit_q.append(q[v : v + VERIFY_CHUNK][keep])
+                    hit_t.append(t[v : v + VERIFY_CHUNK][keep])
+
+        if not hit_q:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        return np.concatenate(hit_q), np.concatenate(hit_t)
+
+    def verify_hits(self, queries, q_idx, AT, table_idx, table_sgn, q, t):
         '''
-        Using the bound B, search for all possible matches in Table.
+        Mask of the key collisions (query q, table entry t) that are close on the full vectors
+        and do not share a position with the query guess.
         '''
-        # Find v in S within distance 'bound' from query
-        # Input T is a hash table from S
-        # If no such v, return None
-        sgnvec, boundary_idx = self.get_boundary_elements(query)
-    
-        if len(boundary_idx) == len(sgnvec):
-            return [0] * len(query) # Everything is on the boundary, bad news :(
-
-        v = self.check_collision(query, A, sgnvec, Table, boundary_idx, index_num = 0, orig_s=orig_s)
-        return v
+        # NOTE: using the linalg norm lets outliers dominate, which is bad, so we use median value instead.
+        diff = centered((queries[q] - self.project(AT, table_idx[t], table_sgn[t])) % self.Q, self.Q)
+        close = np.median(np.abs(diff), axis=1) < self.bound
+        t_idx = table_idx[t]
+        overlap = ((q_idx[q][:, :, None] == t_idx[:, None, :]) & (t_idx[:, None, :] >= 0)).any(axis=(1, 2))
+        return close & ~overlap
 
     def get_possible_bit_values(self):
         if self.secret_type == 'binary':
@@ -574,22 +623,62 @@ class MITM(object):
         elif self.secret_type == 'ternary':
             return [-1, 0, 1]
         elif self.secret_type == 'binomial':
-            return list(np.range(-self.gamma, self.gamma+1))
+            return list(np.arange(-self.gamma, self.gamma+1))
         elif self.secret_type == 'gaussian':
-            return list(np.range(-self.sigma*2, self.sigma*2)) # Guesstimate
+            return list(np.arange(-self.sigma*2, self.sigma*2)) # Guesstimate
         else:
             raise ValueError(f"Unknown secret type: {self.secret_type}")
-        
 
-    def build_and_search(self, shortA, shortb, half):
+    def check_secret(self, shortA, shortb, idx, sgn):
         '''
-        Faster way to do this: build the table and search in one go. 
+        Checks a full guess (positions idx with values sgn) of the k secret bits. Returns True
+        if the search is over.
         '''
-        T = {}
         AT = shortA.T
-        count = 0
-        bits = self.get_possible_bit_values()
-   
+        A_s = sum(AT[i]*s for i, s in zip(idx, sgn)) % self.Q
+        resid = np.abs(centered((shortb - A_s) % self.Q, self.Q))
+        self.logger.info(f"residuals:{resid}")
+        self.logger.info(f"metrics on resid - norm: {np.linalg.norm(resid, np.inf)}, mean: {np.mean(resid)}, std: {np.std(resid)}, median: {np.median(resid)}")
+        if np.median(resid) >= self.bound:
+            return False
+
+        self.logger.info("Found a secret match!")
+        s = np.zeros(self.k)
+        for i, sval in zip(idx, sgn):
+            s[i] = sval
+        self.logger.info(f"Guessed secret is: {s.astype(int)}")
+
+        if self.params.debug == True: # If debugging, use the real secret to guess.
+            self.logger.info(f"Real secret is: {self.s[-self.k:]}")
+            if np.all(s == self.s[-self.k:]):
+                return True
+            self.logger.info("Close but not quite.")
+            return False
+
+        # Use LA method from Cheon to confirm guess: shortb without the error is A_s.
+        error = centered((shortb - A_s) % self.Q, self.Q)
+        _shortb = (shortb - error) % self.Q
+        # Save off, including q, for sage computation
+        qvec = np.zeros((shortA.shape[1]+1))
+        qvec[0] = self.Q
+        _Ab_save = np.hstack((shortA, _shortb[:,np.newaxis]))
+        _Abq_save = np.vstack((_Ab_save, qvec))
+        np.save(os.path.join(self.params.dump_path, f"tempAbq.npy"), _Abq_save)
+
+        # Subprocess runs sage
+        from sage_scripts.recover_secret import main
+        main(os.path.join(self.params.dump_path, f"tempAbq.npy"))
+        return True
+
+    def build_and_search(self, shortA, shortb, half):
+        '''
+        Build the table and search in one go. For h = 1..half, all weight-h guesses s1 are
+        added to the table, sorted by LSH key, and then looked up as queries b - A s1, so
+        every split of the secret into two halves of weight <= half is tried.
+        '''
+        AT = (shortA.T % self.Q).astype(np.int64)
+        shortb = np.asarray(shortb, dtype=np.int64)
+        self.n_skipped, self.n_collisions = 0, 0
 
         if self.params.debug==True:
             # Just get a sense of where secret bits are. We don't use this info to recover secret. 
@@ -610,84 +699,36 @@ class MITM(object):
             self.logger.info(bad1)
             input()
 
-        for h in range(1, half):
-            signbits = list(itertools.product(bits, repeat=h)) # Get the different permutations of secret bit values for this h guess. 
-            secret_combs = list(itertools.combinations(range(self.k), h))
-            for s1 in secret_combs:  # Loop over possible combs of hamming weight h
-                for sgn in signbits: # Loop over possible combs of different sign bits
-                    b1 = centered(sum(AT[i]*s for i, s in zip(s1, sgn)) % self.Q, self.Q)
-                    sgnvec = self.lsh(b1)
-                    if sgnvec in T:
-                        if s1 not in T[sgnvec]:
-                            T[sgnvec].append(s1) # Not storing sign values to save space, trades off for more compute at last step. 
-                    else:
-                        T[sgnvec] = [s1]
-
-                    # Now check and see if the inverse is in this. 
-                    query = centered((shortb - b1) % self.Q, self.Q)
-                    if self.params.debug == True:
-                        sys.stdout.write("\033[F")
-                        sys.stdout.write("\033[K")
-                        print('Number of noisy searches = %d' % count)
-                    count += 1
-
-                    if count > (len(signbits)): # Skip querying on first element. 
-                        guess_s2 = self.noisy_search(query, AT, T, orig_s=s1)
-                    else:
-                        # First element put in, don't do a noisy search
-                        guess_s2 = None
-                    
-                    if guess_s2 is not None and guess_s2[0] != s1: 
-                        # Check full secret, returned value from noisy search has 2 parts.
-                        s2 = guess_s2[0]
-                        _s1 = list(s1).copy()
-                        # Concat secret vectors
-                        _s1.extend(list(s2))
-
-                        # Concat sign vectors if needed
-                        if len(bits) > 1:
-                            s2_sign = guess_s2[1]
-                            s1_sign = list(sgn)
-                            s1_sign.extend(list(s2_sign)) 
-                        else: 
-                            s1_sign = [1]*len(_s1)
-
-                        # Check for correctness
-                        A_s = sum(AT[i]*s for i, s in zip(_s1, s1_sign)) % self.Q
-                        resid  = np.abs(centered((shortb - A_s) % self.Q, self.Q))
-                        self.logger.info(f"residuals:{resid}")
-                        self.logger.info(f"metrics on resid - norm: {np.linalg.norm(resid, np.inf)}, mean: {np.mean(resid)}, std: {np.std(resid)}, median: {np.median(resid)}")
-                        if np.median(resid) < self.bound: 
-                            self.logger.info("Found a secret match!")
-                            s = np.zeros(self.k) 
-                            for i, sval in zip(_s1, s1_sign):
-                                s[i] = sval
-                            self.logger.info(f"Guessed secret is: {s.astype(int)}")
-
-                            if self.params.debug == True: # If debugging, use the real secret to guess.
-                                self.logger.info(f"Real secret is: {self.s[-self.k:]}")
-                                if np.all(s == self.s[-self.k:]):
-                                    return
-                                else:
-                                    self.logger.info("Close but not quite.")
-                            else: #  use LA method from Cheon to confirm guess. 
-                                # A, c, query, A_s == vec from Cheon, q
-                                error = query - A_s
-                                _shortb = (shortb - error) % self.Q
-                                # Save off, including q, for sage computation
-                                qvec = np.zeros((shortA.shape[1]+1))
-                                qvec[0] = self.Q
-                                _Ab_save = np.hstack((shortA, _shortb[:,np.newaxis])) #, qvec))
-                                _Abq_save = np.vstack((_Ab_save, qvec))
-                                np.save(os.path.join(self.params.dump_path, f"tempAbq.npy"), _Abq_save) 
-
-                                # Subprocess runs sage
-                                from sage_scripts.recover_secret import main
-                                main(os.path.join(self.params.dump_path, f"tempAbq.npy"))
-                                return
-                                                            
-                                    
-                                    
+        keys = np.zeros(0, dtype=np.uint64)
+        table_idx = np.zeros((0, half), dtype=np.int16)
+        table_sgn = np.zeros((0, half), dtype=np.int8)
+        for h in range(1, half + 1):
+            idx, sgn = self.half_secrets(h, half)
+            new_keys = [
+                self.lsh(self.project(AT, idx[i : i + self.batch_size], sgn[i : i + self.batch_size]))
+                for i in range(0, len(idx), self.batch_size)
+            ]
+            keys = np.concatenate([keys] + new_keys)
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+            table_idx = np.concatenate([table_idx, idx])[order]
+            table_sgn = np.concatenate([table_sgn, sgn])[order]
+            self.logger.info(f"Table holds {len(keys)} guesses of weight <= {h}")
+
+            # Now check and see if the inverse of each weight h guess is in the table.
+            for start in tqdm(range(0, len(idx), self.batch_size), disable=not self.params.debug):
+                q_idx, q_sgn = idx[start : start + self.batch_size], sgn[start : start + self.batch_size]
+                queries = centered((shortb - self.project(AT, q_idx, q_sgn)) % self.Q, self.Q)
+                for q, t in zip(*self.noisy_search(queries, q_idx, AT, keys, table_idx, table_sgn)):
+                    # Concat the two halves of the guess.
+                    guess_idx = np.concatenate([q_idx[q], table_idx[t]])
+                    guess_sgn = np.concatenate([q_sgn[q], table_sgn[t]])
+                    if self.check_secret(shortA, shortb, guess_idx[guess_idx >= 0], guess_sgn[guess_idx >= 0]):
+                        return
+            self.logger.info(
+                f"Searched weight {h}: {self.n_collisions} key collisions, "
+                f"{self.n_skipped} queries skipped with more than {self.max_boundary_bits} boundary bits"
+            )
 
     def run_mitm(self, shortA, shortb):
         # First, generate the table.
@@ -12,24 +12,6 @@ import subprocess
 
 
 ##### ATTACK UTILS ##### 
-def polish(X, longtype=False):
-    if longtype:
-        X = X.astype(np.longdouble)
-    g, old = np.inner(X, X), np.inf # Initialize the Gram matrix
-    while np.std(X) < old:
-        old = np.std(X)
-        # Calculate the projection coefficients
-        c = np.round(g / np.diag(g)).T.astype(int)
-        c[np.diag_indices(len(X))] = 0
-        c[np.diag(g)==0] = 0
-
-        sq = np.diag(g) + c*((c.T*np.diag(g)).T - 2*g) # doing l2 norm here
-        s = np.sum(sq, axis=1) # Sum the squares. Can do other powers of norms
-        it = np.argmin(s) # Determine which index minimizes the sum
-        X -= np.outer(c[it], X[it]) # Project off the it-th vector
-        g += np.outer(c[it], g[it][it] * c[it] - g[it]) - np.outer(g[:,it], c[it]) # Update the Gram matrix
-    return X
-
 def compute_curr_mitm_params(params, threadnum, logger):
     ''' Runs sage subprocess to determine if B (based on short vector norm) is small enough to be useful. '''
     try:
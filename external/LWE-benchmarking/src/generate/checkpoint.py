@@ -0,0 +1,163 @@
+""""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Checkpoints and result logs for the reduction workers.
+
+MatrixCheckpoint saves a worker's reduction state (the matrix_{thread}.npy files)
+from a background thread, so reduction continues while the previous round is
+written. Only the latest matrix is kept pending: if a round finishes before the
+previous one is on disk, the older one is dropped. Files are written to a
+temporary name and renamed, so a preempted job finds either the previous or the
+new checkpoint, never a partial one, and a matrix identical to the last one
+written is not written again. With compress=True, snapshots go to a compressed
+.npz next to the .npy.
+
+ResultLog replaces the shared results.pkl: each worker appends one JSON line per
+result to its own results_{thread}.jsonl, and read_results merges them.
+"""
+
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+
+def _digest(mat):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((mat.shape, mat.dtype.str)).encode())
+    h.update(np.ascontiguousarray(mat).data)
+    return h.digest()
+
+
+def atomic_save(path, mat, compress=False):
+    """np.save (or np.savez_compressed) to a temporary file, fsync it, and rename it to path."""
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as fd:
+        if compress:
+            np.savez_compressed(fd, mat=mat)
+        else:
+            np.save(fd, mat)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp, path)
+
+
+class MatrixCheckpoint:
+    """
+    Asynchronous checkpoint of one worker matrix. path is the .npy path; with compress,
+    snapshots are written to the .npz with the same stem instead.
+    """
+
+    def __init__(self, path, compress=False):
+        self.npy_path = path
+        self.npz_path = os.path.splitext(path)[0] + ".npz"
+        self.compress = compress
+        self.path = self.npz_path if compress else self.npy_path
+        self.last_digest = None
+        self.pending = None
+        self.writing = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                mat, self.pending = self.pending, None
+                self.writing = True
+            try:
+                digest = _digest(mat)
+                if digest != self.last_digest:
+                    atomic_save(self.path, mat, self.compress)
+                    # Do not leave a stale snapshot in the other format behind.
+                    other = self.npy_path if self.compress else self.npz_path
+                    if os.path.isfile(other):
+                        os.remove(other)
+                    self.last_digest = digest
+            except Exception as e:
+                self.error = e
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+
+    def _check_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, mat):
+        """Queues mat for writing. mat must not be modified afterwards."""
+        self._check_error()
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.pending = mat
+            self.cond.notify_all()
+
+    def flush(self):
+        """Waits until the last saved matrix is on disk."""
+        with self.cond:
+            while self.pending is not None or self.writing:
+                self.cond.wait()
+        self._check_error()
+
+    def exists(self):
+        self.flush()
+        return os.path.isfile(self.npy_path) or os.path.isfile(self.npz_path)
+
+    def load(self):
+        """Returns the last checkpoint on disk (from either format), or None."""
+        self.flush()
+        return load_matrix(self.npy_path)
+
+
+def load_matrix(path):
+    """Loads a matrix checkpoint from path (.npy) or from the compressed .npz next to it, or None."""
+    npz_path = os.path.splitext(path)[0] + ".npz"
+    paths = [p for p in (path, npz_path) if os.path.isfile(p)]
+    if len(paths) == 0:
+        return None
+    latest = max(paths, key=os.path.getmtime)
+    if latest == npz_path:
+        with np.load(latest) as data:
+            return data["mat"]
+    return np.load(latest)
+
+
+class ResultLog:
+    """Append-only JSON lines log of one worker's results."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, **result):
+        line = (json.dumps(result) + "\n").encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def read_results(path, pattern="results_*.jsonl"):
+    """Yields the results logged in path, worker log by worker log. A line cut short by a crash is skipped."""
+    for log_path in sorted(glob.glob(os.path.join(path, pattern))):
+        with open(log_path) as fd:
+            for line in fd:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
@@ -0,0 +1,139 @@
+""""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Reads and writes integer matrices in the fplll text format used by flatter:
+
+[[a b c]
+[d e f]
+]
+
+Matrices are written to and read from subprocess pipes in chunks, without
+building the whole text in memory and without going through NumPy's print
+options (which summarize large arrays with "..."). Values round-trip exactly
+over the whole int64 range.
+
+Self-check against a stand-in for flatter that echoes its input:
+python3 src/generate/flatter_io.py
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+_BRACKETS = bytes.maketrans(b"[]", b"  ")
+
+
+def write_intmat(fd, mat, chunk_rows=256):
+    """Writes an integer matrix in fplll format to a binary file object, chunk_rows rows at a time."""
+    mat = np.asarray(mat)
+    assert mat.ndim == 2 and np.issubdtype(mat.dtype, np.integer), (mat.shape, mat.dtype)
+    fd.write(b"[")
+    for start in range(0, len(mat), chunk_rows):
+        rows = mat[start : start + chunk_rows].tolist()
+        fd.write("".join(["[" + " ".join(map(str, row)) + "]\n" for row in rows]).encode())
+    fd.write(b"]\n")
+
+
+def _parse(data):
+    if not data.strip():  # fromstring reads a lone 0 from blank input
+        return np.zeros(0, dtype=np.int64)
+    return np.fromstring(data.translate(_BRACKETS), dtype=np.int64, sep=" ")
+
+
+def read_intmat(fd, chunk_size=1 << 20):
+    """
+    Reads an fplll-format integer matrix from a binary file object as int64, chunk_size
+    bytes at a time. The number of columns is the length of the first row.
+    """
+    parts, n_parsed, n_cols, tail = [], 0, None, b""
+    while True:
+        chunk = fd.read(chunk_size)
+        data = tail + chunk
+        if chunk:
+            # A number may be cut at the end of the chunk: keep it for the next one.
+            cut = max(data.rfind(sep) for sep in (b" ", b"\n", b"[", b"]"))
+            data, tail = data[: cut + 1], data[cut + 1 :]
+        if n_cols is None:
+            end = data.find(b"]")
+            if end >= 0:
+                n_cols = n_parsed + len(_parse(data[:end]))
+        values = _parse(data)
+        parts.append(values)
+        n_parsed += len(values)
+        if not chunk:
+            break
+
+    values = np.concatenate(parts)
+    if not n_cols:
+        return values.reshape(0, 0)
+    assert len(values) % n_cols == 0, f"{len(values)} values do not fill rows of {n_cols}"
+    return values.reshape(-1, n_cols)
+
+
+def run_intmat_command(cmd, mat, env=None):
+    """
+    Runs cmd (e.g. ["flatter", "-alpha", "0.04"]) with mat on its stdin and returns the
+    matrix it prints. The input is written from a thread while the output is read, so
+    a command that answers before reading all of its input cannot deadlock the pipes.
+    """
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+    errors = []
+
+    def feed():
+        try:
+            write_intmat(p.stdin, mat)
+        except BrokenPipeError as e:
+            errors.append(e)
+        finally:
+            p.stdin.close()
+
+    writer = threading.Thread(target=feed, daemon=True)
+    writer.start()
+    out = read_intmat(p.stdout)
+    writer.join()
+    p.stdout.close()
+    if p.wait() != 0 or errors:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    return out
+
+
+# Stand-in for flatter: copies stdin to stdout in small pieces.
+_ECHO_SCRIPT = """
+import sys
+while True:
+    chunk = sys.stdin.buffer.read(4096)
+    if not chunk:
+        break
+    sys.stdout.buffer.write(chunk)
+"""
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        echo = os.path.join(tmpdir, "echo_flatter.py")
+        with open(echo, "w") as fd:
+            fd.write(_ECHO_SCRIPT)
+
+        info = np.iinfo(np.int64)
+        mats = [
+            np.zeros((1, 1), dtype=np.int64),
+            rng.integers(-(2**20), 2**20, size=(5, 7)),
+            rng.integers(info.min + 1, info.max, size=(64, 64), endpoint=True),
+            np.array([[info.min + 1, info.max], [-1, 0]]),
+            # Large enough for NumPy to summarize it with "..." when printed.
+            rng.integers(-(2**40), 2**40, size=(1200, 1200)),
+        ]
+        for mat in mats:
+            out = run_intmat_command([sys.executable, echo], mat)
+            assert out.dtype == np.int64 and out.shape == mat.shape, (out.shape, mat.shape)
+            assert (out == mat).all()
+            print(f"{mat.shape}: round trip ok")
@@ -6,15 +6,16 @@ This source code is licensed under the license found in the
 LICENSE file in the root directory of this source tree.
 """
 
-import io
 import os
 import numpy as np
 from time import time
 from glob import glob
 from fpylll import FPLLL, LLL, BKZ, GSO, IntegerMatrix
 from fpylll.algorithms.bkz2 import BKZReduction as BKZ2
-from src.generate.lllbkz import calc_std, polish, encode_intmat, decode_intmat
-from subprocess import Popen, PIPE
+from src.generate.lllbkz import calc_std, polish
+from src.generate.flatter_io import run_intmat_command
+from src.generate.records import RecordWriter, SHARD_EXT
+from src.generate.checkpoint import MatrixCheckpoint, load_matrix
 from scipy.linalg import circulant
 
 
@@ -52,9 +53,8 @@ class Generator(object):
         self.seed = [params.global_rank, params.env_base_seed, thread]
         # env_base_seed: different jobs will generate different data
         # thread: different workers will not generate same data
-        self.export_path_prefix = os.path.join(
-            params.dump_path, f"data_{thread}.prefix"
-        )
+        self.export_path = os.path.join(params.dump_path, f"data_{thread}{SHARD_EXT}")
+        self.writer = None
 
         self.prev_std = 10000  # Condition to only save off matrix if things improve.
 
@@ -71,9 +71,10 @@ class Generator(object):
         self.matrix_filename = os.path.join(params.dump_path, f"matrix_{thread}.npy")
         self.resume_filename = os.path.join(params.resume_path, f"matrix_{thread}.npy")
         self.temp_ap_filename = os.path.join(params.dump_path, f"ap_temp_{thread}.out")
-        if os.path.isfile(self.resume_filename):
-            mat_to_save = np.load(self.resume_filename)
-            np.save(self.matrix_filename, mat_to_save)
+        self.checkpoint = MatrixCheckpoint(self.matrix_filename, params.checkpoint_compress)
+        mat_to_save = load_matrix(self.resume_filename)
+        if mat_to_save is not None:
+            self.checkpoint.save(mat_to_save)
             self.logger.info(f"Resuming from {self.resume_filename}.")
         self.logger.info(f"Random generator seed: {self.seed}.")
 
@@ -86,21 +87,17 @@ class Generator(object):
             FPLLL.set_precision(int(precision))
 
     def write(self, X, Y):
+        """Appends a record: X the (m, 1) tiny A indices, Y = R.T of shape (m, m+N)."""
         assert X.shape[0] == Y.shape[0]
-        file_handler_prefix = io.open(
-            self.export_path_prefix, mode="a", encoding="utf-8"
-        )
-        for i in range(X.shape[0]):
-            prefix1_str = " ".join(X[i].astype(str))
-            prefix2_str = " ".join(Y[i].astype(str))
-            file_handler_prefix.write(f"{prefix1_str} ; {prefix2_str}\n")
-        file_handler_prefix.flush()
+        if self.writer is None:
+            self.writer = RecordWriter(self.export_path, X.shape[0], Y.shape[0])
+        self.writer.write(X[:, 0], Y.T)
 
     def save_mat(self, X, Y):
         mat_to_save = np.zeros((len(Y), len(Y) + self.m)).astype(int)
         mat_to_save[: len(X), : self.m] = X
         mat_to_save[:, self.m :] = Y
-        np.save(self.matrix_filename, mat_to_save)
+        self.checkpoint.save(mat_to_save)
 
     def rlwe_circ(self, a):
         A = circulant(a)
@@ -133,17 +130,14 @@ class Generator(object):
         Runs a single loop of flatter.
         """
         self.logger.info(f"Worker {self.thread} starting new flatter run.")
-        fplll_Ap = IntegerMatrix.from_matrix(Ap.tolist())
-        fplll_Ap_encoded = encode_intmat(fplll_Ap)
+        env = {**os.environ, "OMP_NUM_THREADS": "1"}
         try:
-            env = {**os.environ, "OMP_NUM_THREADS": "1"}
-            p = Popen(
-                ["/private/home/ewenger/usr/bin/flatter", "-alpha", str(self.alpha)], stdin=PIPE, stdout=PIPE, env=env
-            )
+            Ap = run_intmat_command(
+                ["/private/home/ewenger/usr/bin/flatter", "-alpha", str(self.alpha)], Ap, env=env
+            )  # output from the flatter run.
         except Exception as e:
             self.logger.info(f"flatter failed with error {e}")
-        out, _ = p.communicate(input=fplll_Ap_encoded)  # output from the flatter run.
-        Ap = decode_intmat(out)
+            raise
         if self.params.rand_rows:
             Ap = np.random.permutation(Ap)  # permute the rows.
         return Ap
@@ -327,8 +321,8 @@ class InterleavedReduction(Generator):
                     return Ap, check
 
     def generate(self):
-        if os.path.isfile(self.matrix_filename):
-            A_Ap = np.load(self.matrix_filename)
+        A_Ap = self.checkpoint.load()
+        if A_Ap is not None:
             UT, Ap = A_Ap[:, : self.m], A_Ap[:, self.m :]
         else:
             U, Ap = self.get_A_Ap()
@@ -9,7 +9,7 @@ Very simple script for generating secret datasets. It only supports LWE (no ring
 
 The main arguments:
 
---processed_dump_path: the directory with data_*.prefix files, or the parent of that directory. See the NOTE in the comments.
+--processed_dump_path: the directory with data_*.rec record shards (or legacy data_*.prefix files), or the parent of that directory. See the NOTE in the comments.
 --secret_path: path to an existing secret.npy file. If not provided, the script will generate a new secret.
 --secret_type: binary, ternary, gaussian, binomial. Look at the SecretFactory classes.
 --actions: one or more of "secrets", "only_secrets", "plot", "describe"
@@ -39,7 +39,11 @@ You want to make sure that
 * Centered reduction is similar to the write threshold of the preprocessing job
 * BKZ block sizes don't surprise you (read from the original params file)
 
-While reading from the data.prefix file, if there are issues in it (likely from concurrent writing to data.prefix), the logs will complain:
+With --streaming true, RA and Rb are written batch by batch into memory-mapped .npy
+files instead of being held in memory, using the narrowest integer dtype that fits Q.
+Use it when max_samples x N does not fit in RAM.
+
+While reading the record shards, if there are issues in them, the logs will complain:
 
 It might complain that the err std is too close to random. This means that (RA @ secret - Rb) is very close to a uniform error distribution, which is bad news.
 
@@ -47,6 +51,7 @@ It might also complain that the reduction is not below the original write thresh
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import getpass
 import glob
 import itertools
@@ -62,7 +67,18 @@ import numpy as np
 from tqdm import tqdm
 sys.path.append(".")
 from src.generate.lllbkz import get_mlwe_circ, centered
-from src.utils import create_this_logger, human, init_rng, mod_mult_torch, read, remove_redundant_rows, shift_negate, shuffled
+from src.generate.records import SHARD_EXT, convert_prefix, find_shards, read_records
+from src.utils import (
+    bool_flag,
+    create_this_logger,
+    human,
+    init_rng,
+    mod_mult_batched,
+    narrowest_int_dtype,
+    shift_negate,
+    shuffled,
+    truncate_npy,
+)
 
 
 def get_params():
@@ -125,6 +141,12 @@ def get_params():
         default=4_010_000,
         help="Maximum number of training samples. The number of training samples might be less than this number.",
     )
+    parser.add_argument(
+        "--streaming",
+        type=bool_flag,
+        default=False,
+        help="Write RA and Rb straight to memory-mapped .npy files instead of holding them in memory.",
+    )
     parser.add_argument(
         "--std_threshold",
         default=1.0,
@@ -265,6 +287,89 @@ def data_check(batch_RA, batch_Rb, secret, rlwe=0):
     return True
 
 
+class StreamingOutputs:
+    """
+    Writes batches of RA and Rb straight into pre-sized memory-mapped .npy files:
+    test_A and train_A, and for each secret test_b, train_b and reduced_b, each
+    holding that secret's column of Rb contiguously. Files are sized for
+    max_samples rows and truncated to the rows actually written by close().
+    Writes run on a background thread, overlapping with the modular
+    multiplication of the next batch.
+    """
+
+    def __init__(self, dump_path, secret_dir, secret_names, max_samples, test_size, A_shape, b_shape, Q):
+        self.dtype = narrowest_int_dtype(Q)
+        test_size = min(test_size, max_samples)
+        splits = [("test", 0, test_size), ("train", test_size, max_samples)]
+
+        # (path, memmap, first row, end row, secret column or None for A)
+        self.targets = [
+            self._open(f"{dump_path}/{split}_A.npy", lo, hi, A_shape, None)
+            for split, lo, hi in splits
+        ]
+        for col, name in enumerate(secret_names):
+            for split, lo, hi in splits + [("reduced", 0, max_samples)]:
+                path = f"{secret_dir}/{split}_b_{name}.npy"
+                self.targets.append(self._open(path, lo, hi, b_shape, col))
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def _open(self, path, lo, hi, shape, col):
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(hi - lo,) + shape)
+        return path, out, lo, hi, col
+
+    def _write(self, start, batch_RA, batch_Rb):
+        end = start + len(batch_RA)
+        for _, out, lo, hi, col in self.targets:
+            a, b = max(start, lo), min(end, hi)
+            if a < b:
+                src = batch_RA if col is None else batch_Rb[..., col]
+                out[a - lo : b - lo] = src[a - start : b - start]
+
+    def write(self, start, batch_RA, batch_Rb):
+        """Queues rows [start, start + len(batch_RA)), waiting for the previous batch first."""
+        if self.pending is not None:
+            self.pending.result()
+        self.pending = self.executor.submit(self._write, start, batch_RA, batch_Rb)
+
+    def close(self, n_rows):
+        if self.pending is not None:
+            self.pending.result()
+        self.executor.shutdown()
+        targets, self.targets = self.targets, []
+        for path, out, lo, hi, _ in targets:
+            out.flush()
+            del out
+            truncate_npy(path, min(max(n_rows - lo, 0), hi - lo))
+        logger.info("Wrote %d samples as %s to %d files", n_rows, self.dtype, len(targets))
+
+
+def reduce_records(records, tiny_A, tiny_b, Q, m, batch_size=256, chunk_size=64, n_threads=None):
+    """
+    Yields (RA, Rb) = (R @ A, R @ b) % Q for each (A indices, R) record, where A
+    holds the m rows of tiny_A the record was reduced from. Both products of
+    batch_size records are computed in one exact batched call, in chunks of
+    chunk_size records on a thread pool shared by all batches.
+    """
+    # One product per record: R @ [A | b] gives RA and Rb for every secret at once.
+    tiny_Ab = np.concatenate([tiny_A, tiny_b.reshape(len(tiny_b), -1)], axis=1)
+    N = tiny_A.shape[1]
+    n_workers = min(math.ceil(batch_size / chunk_size), n_threads or os.cpu_count())
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                return
+            # Remove any rows of R that are all zeros
+            # https://stackoverflow.com/a/11188955
+            Rs = [R[~np.all(R == 0, axis=1)] for _, R in batch]
+            idxs = [A.flatten() for A, _ in batch]
+            for idx in idxs:
+                assert len(idx) == m, f"record reduced from {len(idx)} rows of A, expected {m}"
+            for batch_RAb in mod_mult_batched(Rs, tiny_Ab, idxs, Q, chunk_size=chunk_size, executor=pool):
+                yield batch_RAb[:, :N], batch_RAb[:, N:].reshape((-1,) + tiny_b.shape[1:])
+
+
 def init_tiny_A(nu=0, k=0):
     logger.info(f"Loading from {params.orig_A_path}")
     A = np.load(params.orig_A_path, allow_pickle=True)
@@ -325,70 +430,82 @@ def generate(test_size=10000):
     # Will be used by Rb in so that the distribution and dependence of vars are correct
     tiny_b = (A_dot_s + tiny_e) % params.Q
 
-    # full_RA (params.max_samples, N) is the entire set (~4M) of inputs to the transformer
-    full_RA = np.zeros((params.max_samples, params.N), dtype=np.int64)
+    if params.rlwe:
+        # Need at least N samples for RLWE in order to have a full circulant.
+        test_size = max(test_size//n, params.N + 1)
+
+    hamming_secret_pairs = list(itertools.product(h_range, range(params.num_secret_seeds)))
 
-    # full_Rb (NUM_SAMPLES, num_secrets) is a matrix of outputs to the transformer.
-    # There are num_secrets columns in Rb; one for each secret.
     # Shape is different for RLWE setting because of the circulant.
-    b_shape = (
-        (params.max_samples, params.N//params.rlwe, num_secrets)
-        if params.rlwe
-        else (params.max_samples, num_secrets)
-    )
-    full_Rb = np.zeros(b_shape, dtype=np.int64)
+    b_shape = (params.N//params.rlwe,) if params.rlwe else ()
+
+    if params.streaming:
+        outputs = StreamingOutputs(
+            params.dump_path,
+            params.secret_dir,
+            [f"{h}_{seed_i}" for h, seed_i in hamming_secret_pairs],
+            params.max_samples,
+            test_size,
+            (params.N,),
+            b_shape,
+            params.Q,
+        )
+    else:
+        # full_RA (params.max_samples, N) is the entire set (~4M) of inputs to the transformer
+        full_RA = np.zeros((params.max_samples, params.N), dtype=np.int64)
 
-    # Find the data.prefix file
-    data_prefix_path = os.path.join(params.processed_dump_path, "data.prefix")
-    if not os.path.isfile(data_prefix_path):
-        logger.warning("Copying all data_*.prefix to %s", data_prefix_path)
+        # full_Rb (NUM_SAMPLES, num_secrets) is a matrix of outputs to the transformer.
+        # There are num_secrets columns in Rb; one for each secret.
+        full_Rb = np.zeros((params.max_samples,) + b_shape + (num_secrets,), dtype=np.int64)
+
+    # Find the record shards written by the preprocessing workers
+    shard_paths = find_shards(params.processed_dump_path)
+    if not shard_paths:
+        # Older runs wrote text data_*.prefix files: convert them once to shards.
         # NOTE: you might have to change this glob if you're using threadsafe or not.
         # If you're going after some slurm jobs, then you probably want:
         #
         #    f"{params.processed_dump_path}/*/data_*.prefix"
         #
         # Note the /*/ to match the slurm jobs
-        paths = glob.glob(f"{params.processed_dump_path}/*/data_*.prefix")
-        with open(data_prefix_path, "w") as outfile:
-            for path in tqdm(paths, desc="Copying data.prefix"):
-                for line in remove_redundant_rows(path, params.m):
-                    outfile.write(line)
+        data_prefix_path = os.path.join(params.processed_dump_path, "data.prefix")
+        if os.path.isfile(data_prefix_path):
+            paths = [data_prefix_path]
+        else:
+            paths = glob.glob(f"{params.processed_dump_path}/*/data_*.prefix")
+        for path in tqdm(paths, desc="Converting data_*.prefix"):
+            logger.warning("Converting %s to a record shard", path)
+            convert_prefix(path, os.path.splitext(path)[0] + SHARD_EXT, params.m)
+        shard_paths = find_shards(params.processed_dump_path)
 
-    logger.info("Loading data from %s", data_prefix_path)
+    logger.info("Loading data from %d record shards", len(shard_paths))
 
     n_matrices, n_pairs = 0, 0
 
-    for A, R in read(data_prefix_path, params.m):
-        # Remove any rows of R that are all zeros
-        # https://stackoverflow.com/a/11188955
-        R = R[~np.all(R == 0, axis=1)]
-
-        idxs = list(A.flatten())
-        A = tiny_A[idxs]
-        assert A.shape == (params.m, params.N)
-
-        b = tiny_b[idxs]
-
-        if params.rlwe:
-            assert b.shape == (params.m, params.N//params.rlwe, num_secrets)
-        else:
-            assert b.shape == (params.m, num_secrets)
+    assert tiny_A.shape[1] == params.N, (tiny_A.shape, params.N)
+    if params.rlwe:
+        assert tiny_b.shape[1:] == (params.N//params.rlwe, num_secrets)
+    else:
+        assert tiny_b.shape[1:] == (num_secrets,)
 
-        # Compute RA and check if it's too big.
-        batch_RA = mod_mult_torch(R, A, params.Q)
+    # Rows of R already seen for the same A are dropped while streaming.
+    records = read_records(shard_paths, dedup=True)
+    for batch_RA, batch_Rb in reduce_records(records, tiny_A, tiny_b, params.Q, params.m):
         assert batch_RA.dtype == np.int64, (batch_RA.dtype, batch_RA[0][0])
+
+        # Check if it's too big.
         new_pairs, _ = batch_RA.shape
         end = n_pairs + new_pairs
         if (n_pairs > 0) and (end > params.max_samples):
             logger.info("About to exceed %d. Terminating.", params.max_samples)
             break
 
-        batch_Rb = mod_mult_torch(R, b, params.Q)
-        assert batch_Rb.dtype == np.int64, (batch_Rb.dtype, batch_Rb[0][0])
-    
         if True: #data_check(batch_RA, batch_Rb, secret, params.rlwe):
-            full_RA[n_pairs:end] = batch_RA
-            full_Rb[n_pairs:end] = batch_Rb
+            if params.streaming:
+                outputs.write(n_pairs, batch_RA, batch_Rb)
+            else:
+                full_RA[n_pairs:end] = batch_RA
+                full_Rb[n_pairs:end] = batch_Rb
         else:
             logger.debug("Error too large, ignoring this R")
             continue
@@ -402,16 +519,6 @@ def generate(test_size=10000):
                 human(n_matrices),
                 human(n_pairs),
             )
-    # Truncate arrays to n_pairs
-    full_RA = full_RA[:n_pairs]
-    full_Rb = full_Rb[:n_pairs]
-
-    if params.rlwe:
-        # Need at least N samples for RLWE in order to have a full circulant.
-        test_size = max(test_size//n, params.N + 1)
-
-    test_RA, train_RA = full_RA[:test_size], full_RA[test_size:]
-    test_Rb, train_Rb = full_Rb[:test_size], full_Rb[test_size:]
 
     def save_and_log(path, arr):
         np.save(path, arr)
@@ -422,16 +529,26 @@ def generate(test_size=10000):
     # We assume this is a unix system. I don't use os.path.join because of this.
     save_and_log(f"{params.dump_path}/orig_b.npy", tiny_b)
     save_and_log(f"{params.dump_path}/orig_A.npy", tiny_A)
-    save_and_log(f"{params.dump_path}/test_A.npy", test_RA)
-    save_and_log(f"{params.dump_path}/train_A.npy", train_RA)
+    if params.streaming:
+        outputs.close(n_pairs)
+    else:
+        # Truncate arrays to n_pairs
+        full_RA = full_RA[:n_pairs]
+        full_Rb = full_Rb[:n_pairs]
+
+        test_RA, train_RA = full_RA[:test_size], full_RA[test_size:]
+        test_Rb, train_Rb = full_Rb[:test_size], full_Rb[test_size:]
+        save_and_log(f"{params.dump_path}/test_A.npy", test_RA)
+        save_and_log(f"{params.dump_path}/train_A.npy", train_RA)
 
-    hamming_secret_pairs = itertools.product(h_range, range(params.num_secret_seeds))
     # Since we dump the secrets down a directory.
     save_and_log(f"{params.secret_dir}/secret.npy", secret)
-    for h, seed_i in tqdm(list(hamming_secret_pairs)):
+    for h, seed_i in tqdm(hamming_secret_pairs):
         secret_i = (h - params.min_hamming) * params.num_secret_seeds + seed_i
         np.save(f"{params.secret_dir}/secret_{h}_{seed_i}.npy", secret[..., secret_i])
         np.save(f"{params.secret_dir}/orig_b_{h}_{seed_i}.npy", tiny_b[..., secret_i])
+        if params.streaming:
+            continue
         np.save(f"{params.secret_dir}/test_b_{h}_{seed_i}.npy", test_Rb[..., secret_i])
         np.save(f"{params.secret_dir}/train_b_{h}_{seed_i}.npy", train_Rb[..., secret_i])
         np.save(f"{params.secret_dir}/reduced_b_{h}_{seed_i}.npy", full_Rb[..., secret_i])
@@ -60,21 +60,41 @@ def orthogonalize2(mat, i):
             count += 1
 
 
+def _size_reduce(a, mu, j):
+    """
+    Size-reduces a[j] against a[:j] using the Gram-Schmidt coefficients mu: only
+    the coefficients with a nonzero rounding are visited (from the last one down),
+    and a[j] is updated with a single product at the end.
+    """
+    coeffs = np.zeros(j, dtype=np.int64)
+    k = j
+    while True:
+        big = np.flatnonzero(np.abs(mu[j, :k]) > 0.5)
+        if len(big) == 0:
+            break
+        k = big[-1]
+        r = np.round(mu[j, k])
+        coeffs[k] = r
+        mu[j, : k + 1] -= r * mu[k, : k + 1]
+    if coeffs.any():
+        a[j] -= (coeffs @ a[:j]).astype(a.dtype)
+
+
 def lll(a, delta):
     b = a.astype(float)
     # Run Gram-Schmidt (without normalization) on b
     for j in range(1, b.shape[0]):
         orthogonalize2(b, j)
-    j = 1
     dot_prods = np.linalg.norm(b, axis=1) ** 2
+    # mu[i, k] = <a[i], b[k]> / |b[k]|^2, only used for k <= i
+    mu = (a @ b.T) / dot_prods
+    np.fill_diagonal(mu, 1)
+    j = 1
     while j < a.shape[0]:
         # Reduce the basis
-        for k in range(j - 1, -1, -1):
-            g = a[j] @ b[k]
-            a[j] -= a[k] * int(np.round(g / dot_prods[k]))
+        _size_reduce(a, mu, j)
         f = dot_prods[j - 1]
-        g = a[j] @ b[j - 1]
-        g /= f
+        g = mu[j, j - 1]
         if dot_prods[j] / f < delta - g * g:
             a[[j - 1, j]] = a[[j, j - 1]]
             # Recompute b[j] and b[j-1] from scratch for numerical stability
@@ -85,6 +105,10 @@ def lll(a, delta):
             b[j] = a[j].astype(float)
             orthogonalize2(b, j)
             dot_prods[j] = b[j] @ b[j]
+            # Only the rows of the swapped vectors and the columns of their b change.
+            mu[[j - 1, j]] = (a[[j - 1, j]] @ b.T) / dot_prods
+            mu[:, [j - 1, j]] = (a @ b[[j - 1, j]].T) / dot_prods[[j - 1, j]]
+            mu[[j - 1, j], [j - 1, j]] = 1
             if j > 1:
                 j -= 1
         else:
@@ -92,27 +116,86 @@ def lll(a, delta):
     return a
 
 
+def _polish_coeffs(g, d, rows):
+    """c[i, j] = round(g[i, j] / d[i]) for i in rows, 0 on the diagonal and where d[i] == 0."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        c = np.round(g[rows] / d[rows, None])
+    c[d[rows] == 0] = 0
+    c = c.astype(int)
+    c[np.arange(len(rows)), rows] = 0
+    return c
+
+
+def _polish_std(total, total_sq, size):
+    mean = float(total) / size
+    return np.sqrt(max(float(total_sq) / size - mean * mean, 0.0))
+
+
 def polish(X, longtype=False):
+    """
+    Greedy pairwise reduction: while std(X) decreases, subtract from every row its
+    rounded projection on the row that most reduces the total squared norm.
+    Each step only changes the rows with a nonzero coefficient (usually few), so
+    the Gram matrix, the coefficients and the candidate scores are only updated
+    for those rows and columns, and std(X) is tracked from the row sums and the
+    Gram diagonal.
+    """
     if longtype:
         X = X.astype(np.longdouble)
-    g, old = np.inner(X, X), np.inf  # Initialize the Gram matrix
-    while np.std(X) < old:
-        old = np.std(X)
-        # Calculate the projection coefficients
-        c = np.round(g / np.diag(g)).T.astype(int)
-        c[np.diag_indices(len(X))] = 0
-        c[np.diag(g) == 0] = 0
-
-        sq = np.diag(g) + c * ((c.T * np.diag(g)).T - 2 * g)  # doing l2 norm here
-        s = np.sum(sq, axis=1)  # Sum the squares. Can do other powers of norms
-        it = np.argmin(s)  # Determine which index minimizes the sum
-        X -= np.outer(c[it], X[it])  # Project off the it-th vector
-        g += np.outer(c[it], g[it][it] * c[it] - g[it]) - np.outer(
-            g[:, it], c[it]
-        )  # Update the Gram matrix
+    n = len(X)
+    g = np.inner(X, X)  # Initialize the Gram matrix
+    d = np.diag(g).copy()
+    # Calculate the projection coefficients
+    c = _polish_coeffs(g, d, np.arange(n))
+    # Sum of the squares after projecting off row i, minus the current sum of squares
+    t = np.sum(c * (c * d[:, None] - 2 * g), axis=1)
+    row_sums = X.sum(axis=1)
+
+    std, old = _polish_std(row_sums.sum(), d.sum(), X.size), np.inf
+    while std < old:
+        old = std
+        it = np.argmin(t)  # Determine which index minimizes the sum
+        c_it = c[it].copy()
+        J = np.flatnonzero(c_it)
+        if len(J) == 0:
+            break
+        other = np.ones(n, dtype=bool)
+        other[J] = False
+        other = np.flatnonzero(other)
+
+        X[J] -= np.outer(c_it[J], X[it])  # Project off the it-th vector
+        row_sums[J] -= c_it[J] * row_sums[it]
+
+        # Update the Gram matrix: only rows and columns J change.
+        c_oJ = c[np.ix_(other, J)]
+        old_terms = c_oJ * (c_oJ * d[other, None] - 2 * g[np.ix_(other, J)])
+        g_it = g[it].copy()
+        g[J] += np.outer(c_it[J], g_it[it] * c_it - g_it) - np.outer(g_it[J], c_it)
+        g[:, J] = g[J].T
+        d[J] = g[J, J]
+
+        # Rows J are recomputed, the other rows only in columns J.
+        c[J] = _polish_coeffs(g, d, J)
+        t[J] = np.sum(c[J] * (c[J] * d[J, None] - 2 * g[J]), axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            c_oJ = np.round(g[np.ix_(other, J)] / d[other, None])
+        c_oJ[d[other] == 0] = 0
+        c_oJ = c_oJ.astype(int)
+        c[np.ix_(other, J)] = c_oJ
+        t[other] += np.sum(c_oJ * (c_oJ * d[other, None] - 2 * g[np.ix_(other, J)]) - old_terms, axis=1)
+
+        std = _polish_std(row_sums.sum(), d.sum(), X.size)
     return X
 
 
+def polish_batch(Xs, longtype=False, n_workers=None):
+    """Polishes independent matrices in a pool of n_workers processes (default: one per core)."""
+    from multiprocessing import Pool
+
+    with Pool(n_workers) as pool:
+        return pool.starmap(polish, [(X, longtype) for X in Xs], chunksize=1)
+
+
 def calc_std_usvp(X, orig_std, Q, m, n):
     """For now, just assume A is in right half of matrix.
     Shape is either base shape = [I*w, A.T 0; 0, q*I 0; 0 b 1] or Verde shape = [0, q*I 0; I*w, A.T 0; 0 b 1]
@@ -132,23 +215,6 @@ def calc_std(X, Q, m):
     return np.sqrt(12) * np.std(mat[np.any(mat != 0, axis=1)]) / Q
 
 
-# flatter functions
-def encode_intmat(intmat):
-    """will put in expected format for flatter input."""
-    fplll_Ap_encode = "[" + intmat.__str__() + "]"
-    fplll_Ap_encode = fplll_Ap_encode.encode()
-    return fplll_Ap_encode
-
-
-def decode_intmat(out):
-    """Decodes output intmat from flatter and puts it back in np.array form."""
-    t_str = out.rstrip().decode()[1:-1]
-    Ap = np.array(
-        [np.array(line[1:-1].split(" ")).astype(int) for line in t_str.split("\n")[:-1]]
-    )
-    return Ap
-
-
 def centered(arr, q):
     try:
         return centered_arr(arr, q)
@@ -35,6 +35,12 @@ def get_parser():
     parser.add_argument(
         "--resume_path", type=str, default="", help="Path to load the checkpoints"
     )
+    parser.add_argument(
+        "--checkpoint_compress",
+        type=bool_flag,
+        default=False,
+        help="Save the worker matrix checkpoints as compressed .npz files",
+    )
     parser.add_argument("--exp_name", type=str, default="debug", help="Experiment name")
     parser.add_argument("--exp_id", type=str, default="", help="Experiment ID")
 
@@ -193,6 +199,7 @@ def get_data_one_worker(i, params):
     gen_more = True
     while gen_more:
         gen_more = sampleGen.generate()
+    sampleGen.checkpoint.flush()
 
 
 def main(params):
@@ -0,0 +1,203 @@
+""""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Append-only binary shards of (A-index, R-matrix) records, replacing the text
+data_*.prefix files written by the reduction workers.
+
+A shard starts with a 64 byte header: the magic, the index dtype and length,
+the R dtype and the R row length, fixed for the whole shard. Each record is a
+16 byte record header (magic, number of R rows) followed by the index vector
+and the R rows, so records of different heights can share a shard. Writers
+append a record with a single write under an exclusive flock, so many workers
+can safely write to the same shard; a record cut short by a crash is ignored
+by the reader. The reader memory-maps the shard and yields views, without
+parsing or copying.
+
+Convert existing text files with:
+python3 src/generate/records.py --prefix_paths /path/data_0.prefix,/path/data_1.prefix --m 100
+"""
+
+import argparse
+import fcntl
+import glob
+import os
+import struct
+import sys
+
+import numpy as np
+
+sys.path.append("./")
+from src.utils import read
+
+SHARD_EXT = ".rec"
+SHARD_MAGIC = b"LWERECS1"
+RECORD_MAGIC = 0x4C574552
+SHARD_HEADER = struct.Struct("<8s8sQ8sQ24x")  # magic, idx dtype, idx len, R dtype, R row len
+RECORD_HEADER = struct.Struct("<IIQ")  # magic, unused, number of R rows
+
+
+class RecordWriter:
+    """
+    Appends (idx, R) records to a shard. idx is a vector of idx_len indices into
+    the tiny A (or any other integer metadata), R a (n_rows, r_len) matrix. The
+    header of an existing shard is checked once per file (device and inode).
+    """
+
+    def __init__(self, path, idx_len, r_len, idx_dtype=np.int64, r_dtype=np.int64):
+        self.path = path
+        self.idx_dtype = np.dtype(idx_dtype).newbyteorder("<")
+        self.r_dtype = np.dtype(r_dtype).newbyteorder("<")
+        self.idx_len, self.r_len = idx_len, r_len
+        self.header = SHARD_HEADER.pack(
+            SHARD_MAGIC, self.idx_dtype.str.encode(), idx_len, self.r_dtype.str.encode(), r_len
+        )
+        self.checked = None  # (st_dev, st_ino) of the shard whose header matched
+
+    def write(self, idx, R):
+        idx = np.asarray(idx).reshape(-1)
+        R = np.asarray(R).reshape(-1, self.r_len)
+        assert len(idx) == self.idx_len, (len(idx), self.idx_len)
+        assert np.all(R.astype(self.r_dtype) == R), "R does not fit in the shard dtype"
+        record = b"".join(
+            [
+                RECORD_HEADER.pack(RECORD_MAGIC, 0, len(R)),
+                idx.astype(self.idx_dtype).tobytes(),
+                np.ascontiguousarray(R, dtype=self.r_dtype).tobytes(),
+            ]
+        )
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            st = os.fstat(fd)
+            if st.st_size == 0:
+                os.write(fd, self.header)
+            elif (st.st_dev, st.st_ino) != self.checked:
+                assert os.pread(fd, SHARD_HEADER.size, 0) == self.header, (
+                    f"{self.path} holds records of another shape or dtype"
+                )
+            self.checked = (st.st_dev, st.st_ino)
+            os.write(fd, record)
+        finally:
+            os.close(fd)
+
+
+def read_shard(path):
+    """Yields (idx, R) views into the memory-mapped shard, in write order."""
+    if os.path.getsize(path) < SHARD_HEADER.size:
+        return
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    magic, idx_dtype, idx_len, r_dtype, r_len = SHARD_HEADER.unpack_from(data, 0)
+    assert magic == SHARD_MAGIC, f"{path} is not a record shard"
+    idx_dtype = np.dtype(idx_dtype.rstrip(b"\0").decode())
+    r_dtype = np.dtype(r_dtype.rstrip(b"\0").decode())
+    idx_bytes = idx_len * idx_dtype.itemsize
+    row_bytes = r_len * r_dtype.itemsize
+
+    offset = SHARD_HEADER.size
+    while offset + RECORD_HEADER.size <= len(data):
+        magic, _, n_rows = RECORD_HEADER.unpack_from(data, offset)
+        assert magic == RECORD_MAGIC, f"{path} is corrupted at byte {offset}"
+        start = offset + RECORD_HEADER.size
+        end = start + idx_bytes + n_rows * row_bytes
+        if end > len(data):
+            break  # last record was cut short
+        idx = np.frombuffer(data, dtype=idx_dtype, count=idx_len, offset=start)
+        R = np.frombuffer(
+            data, dtype=r_dtype, count=n_rows * r_len, offset=start + idx_bytes
+        ).reshape(n_rows, r_len)
+        yield idx, R
+        offset = end
+
+
+def find_shards(path):
+    """Shards directly in path or one level down (e.g. one folder per slurm job)."""
+    return sorted(
+        glob.glob(os.path.join(path, f"*{SHARD_EXT}"))
+        + glob.glob(os.path.join(path, "*", f"*{SHARD_EXT}"))
+    )
+
+
+# Fixed odd multipliers for hashing int64 rows into 64 bits.
+_HASH_MULTIPLIERS = np.random.RandomState(0).randint(
+    1, 2**62, size=4096, dtype=np.int64
+).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+
+
+def _mix(h):
+    # splitmix64 finalizer
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+
+
+def hash_rows(x):
+    """64 bit hash of each row of an integer matrix."""
+    x = np.atleast_2d(x).astype(np.int64).view(np.uint64)
+    assert x.shape[1] <= len(_HASH_MULTIPLIERS)
+    with np.errstate(over="ignore"):
+        return _mix((x * _HASH_MULTIPLIERS[: x.shape[1]]).sum(axis=1, dtype=np.uint64))
+
+
+class RowDeduplicator:
+    """
+    Drops R rows already seen for the same idx, remembering 64 bit hashes of
+    (idx, row) instead of the rows themselves.
+    """
+
+    def __init__(self):
+        self.seen = set()
+
+    def new_rows(self, idx, R):
+        with np.errstate(over="ignore"):
+            hashes = _mix(hash_rows(R) ^ hash_rows(idx)[0])
+        _, first = np.unique(hashes, return_index=True)
+        keep = np.zeros(len(R), dtype=bool)
+        for i in first:
+            h = int(hashes[i])
+            if h not in self.seen:
+                self.seen.add(h)
+                keep[i] = True
+        return R[keep]
+
+
+def read_records(paths, dedup=True):
+    """
+    Streams (A, R) from shards like utils.read does from data.prefix: A is the (m, 1)
+    index column and R the (n_rows, m) matrix. With dedup, rows of R already seen for
+    the same A are dropped and records left empty are skipped.
+    """
+    deduplicator = RowDeduplicator() if dedup else None
+    for path in paths:
+        for idx, R in read_shard(path):
+            if deduplicator is not None:
+                R = deduplicator.new_rows(idx, R)
+                if len(R) == 0:
+                    continue
+            yield idx.reshape(-1, 1), R
+
+
+def convert_prefix(prefix_path, shard_path, m):
+    """Converts a text .prefix file (lines 'A ; R column', m lines per matrix) to a shard."""
+    writer = None
+    n_records = 0
+    for A, R in read(prefix_path, m):
+        if writer is None:
+            writer = RecordWriter(shard_path, m, R.shape[1])
+        writer.write(A.reshape(-1), R)
+        n_records += 1
+    return n_records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert data_*.prefix files to record shards")
+    parser.add_argument("--prefix_paths", type=str, required=True, help="comma separated .prefix files")
+    parser.add_argument("--m", type=int, required=True, help="number of rows of each reduced matrix")
+    args = parser.parse_args()
+    for prefix_path in args.prefix_paths.split(","):
+        shard_path = os.path.splitext(prefix_path)[0] + SHARD_EXT
+        n_records = convert_prefix(prefix_path, shard_path, args.m)
+        print(f"{prefix_path}: {n_records} records written to {shard_path}")
@@ -0,0 +1,85 @@
+""""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+
+Microbenchmark of the batched DigitEncoder against the original per-integer
+implementation (np.apply_along_axis over encode / decode_base). Also checks that
+both produce exactly the same ids and decoded values.
+
+python3 src/salsa/benchmark_encoding.py --N 10,64,256,512 --base 81,1024 --bucket_size 1,10
+"""
+
+import argparse
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+sys.path.append("./")
+from src.salsa.train.envs.lattice import DigitEncoder
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(allow_abbrev=False)
+    parser.add_argument("--N", type=str, default="10,32,128,256,512")
+    parser.add_argument("--Q", type=int, default=842779)
+    parser.add_argument("--base", type=str, default="81,1024")
+    parser.add_argument("--bucket_size", type=str, default="1,10")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def reference_encode(encoder, x):
+    return torch.LongTensor(np.apply_along_axis(encoder.encode, axis=-1, arr=x.numpy()))
+
+
+def reference_decode(encoder, ids):
+    words = [[encoder.id2word[_id] for _id in seq] for seq in ids.numpy()]
+    return torch.LongTensor([encoder.decode_base(seq) for seq in words]).squeeze()
+
+
+def timeit(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main(params):
+    rng = torch.Generator().manual_seed(params.seed)
+    print(f"{'N':>5} {'base':>6} {'bucket':>6} {'ref enc':>10} {'new enc':>10} {'speedup':>8} "
+          f"{'ref dec':>10} {'new dec':>10} {'speedup':>8}")
+    for base in [int(b) for b in params.base.split(",")]:
+        for bucket_size in [int(b) for b in params.bucket_size.split(",")]:
+            for N in [int(n) for n in params.N.split(",")]:
+                encoder = DigitEncoder(SimpleNamespace(base=base, bucket_size=bucket_size, N=N, Q=params.Q))
+                if params.Q - 1 >= encoder.n_words * base ** (encoder.int_len - 1):
+                    print(f"skipping base={base}, bucket_size={bucket_size}: high digit exceeds the vocabulary")
+                    break
+                x = torch.randint(0, params.Q, (params.batch_size, N), generator=rng)
+
+                t_ref_enc, ref_ids = timeit(lambda: reference_encode(encoder, x), params.repeats)
+                t_new_enc, new_ids = timeit(lambda: encoder(x), params.repeats)
+                assert torch.equal(ref_ids, new_ids), "encoded ids differ"
+
+                ids = torch.randint(0, encoder.n_words, (params.batch_size, N * encoder.int_len), generator=rng)
+                t_ref_dec, ref_vals = timeit(lambda: reference_decode(encoder, ids), params.repeats)
+                t_new_dec, new_vals = timeit(lambda: encoder.decode_ids(ids), params.repeats)
+                assert torch.equal(ref_vals, new_vals), "decoded values differ"
+
+                print(f"{N:>5} {base:>6} {bucket_size:>6} {t_ref_enc:>10.5f} {t_new_enc:>10.5f} "
+                      f"{t_ref_enc / t_new_enc:>7.1f}x {t_ref_dec:>10.5f} {t_new_dec:>10.5f} "
+                      f"{t_ref_dec / t_new_dec:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
@@ -8,30 +8,78 @@ LICENSE file in the root directory of this source tree.
 
 import torch
 from torch.utils.data.dataset import Dataset
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
+import hashlib
+import json
 import os
 import numpy as np
 from logging import getLogger
 
 from src.salsa.train.envs.lattice import AngularEncoder, DigitEncoder
+from src.salsa.train.perf import PhaseTimer
+from src.utils import narrowest_int_dtype
 
 logger = getLogger()
 
 
 ENCODER_CLS = [DigitEncoder, AngularEncoder]
+FEATURE_CACHE_CHUNK = 8192  # rows encoded at a time when building the feature cache
+
+
+class ContiguousBatchSampler(Sampler):
+    """
+    Yields batches as slice(start, stop) of consecutive samples, so that each batch
+    is read from the (memory-mapped) arrays with a single slice. With shuffle, the
+    batch boundaries move by a random offset every epoch and the batches are visited
+    in random order. With num_replicas > 1, rank gets every num_replicas-th batch,
+    and all ranks get the same number of batches. A leading or trailing batch of a
+    single sample is merged into its neighbour: AngularEncoder squeezes a batch of
+    one into the wrong shape.
+    """
+
+    def __init__(self, n_samples, batch_size, shuffle=True, seed=0, epoch=0, num_replicas=1, rank=0):
+        self.n_samples = n_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed, self.epoch = seed, epoch
+        self.num_replicas, self.rank = num_replicas, rank
+
+    def batches(self):
+        rng = np.random.RandomState([self.seed % 2**32, self.epoch])
+        offset = rng.randint(self.batch_size) if self.shuffle and self.n_samples > self.batch_size else 0
+        starts = ([0] if offset else []) + list(range(offset, self.n_samples, self.batch_size))
+        if len(starts) > 1 and starts[1] - starts[0] == 1:
+            del starts[1]
+        if len(starts) > 1 and self.n_samples - starts[-1] == 1:
+            del starts[-1]
+        bounds = np.array(list(zip(starts, starts[1:] + [self.n_samples])))
+        if self.shuffle:
+            bounds = bounds[rng.permutation(len(bounds))]
+        n_batches = len(bounds) // self.num_replicas * self.num_replicas if self.num_replicas > 1 else len(bounds)
+        return bounds[self.rank : n_batches : self.num_replicas]
+
+    def __iter__(self):
+        for start, stop in self.batches():
+            yield slice(int(start), int(stop))
+
+    def __len__(self):
+        return len(self.batches())
 
 
 class LWEDataset(Dataset):
     def __init__(self, params):
         self.params = params
         self.io_encoder = ENCODER_CLS[params.angular_emb](params)
+        self.timer = PhaseTimer()
         self.test_dataset = self.load_A_b(params, "test", params.distinguisher_size)
         self.orig_dataset = self.load_A_b(params, "orig")
 
         if params.recover_only:
             return
 
-        A, b = self.load_A_b(params, "train", params.max_samples)
+        # Training samples stay as (memory-mapped) arrays; batches are converted
+        # and encoded in collate_fn.
+        A, b = self.load_A_b(params, "train", params.max_samples, to_tensors=False)
 
         _, N = A.shape
         assert N == params.N, f"expected {params.N}; A had {N}"
@@ -40,43 +88,114 @@ class LWEDataset(Dataset):
         self.A = A
         self.b = b
 
+        self.A_features, self.b_features = None, None
+        if params.feature_cache_path:
+            self.A_features, self.b_features = self.load_feature_cache(params)
+
     def __getitem__(self, index):
+        """index is a sample or a slice of samples, as yielded by ContiguousBatchSampler."""
+        if self.A_features is not None:
+            return self.A_features[index], self.b_features[index]
         return self.A[index], self.b[index]
 
-    def build_train_dataloader(
-        self,
-    ):
-        sampler = None
-
+    def build_train_dataloader(self, epoch=0):
+        num_replicas, rank = 1, 0
         if self.params.multi_gpu:
-            sampler = torch.utils.data.distributed.DistributedSampler(
-                self,
-                drop_last=False,
-                shuffle=False,  # Dataset will shuffle it
-                num_replicas=self.params.world_size,
-                rank=self.params.global_rank,
-            )
+            num_replicas, rank = self.params.world_size, self.params.global_rank
 
+        sampler = ContiguousBatchSampler(
+            len(self),
+            self.params.train_batch_size,
+            shuffle=self.params.shuffle,
+            seed=self.params.seed,
+            epoch=epoch,
+            num_replicas=num_replicas,
+            rank=rank,
+        )
+
+        # The sampler yields whole batches, so automatic batching is disabled.
         return DataLoader(
             self,
-            batch_size=self.params.train_batch_size,
+            batch_size=None,
             sampler=sampler,
             num_workers=self.params.workers,
-            drop_last=False,
-            shuffle=self.params.shuffle,
             pin_memory=False,
             persistent_workers=(self.params.workers > 0),
             collate_fn=self.collate_fn,
         )
 
-    @classmethod
-    def load_A_b(cls, params, split, max_samples=None):
-        assert split in ("train", "test", "orig"), split
+    def feature_cache_key(self, params):
+        """Digest of everything the cached features depend on, including the size and mtime of the A and b files."""
+        sources = {}
+        for path in self.A_b_paths(params, "train"):
+            st = os.stat(path)
+            sources[os.path.abspath(path)] = [st.st_size, st.st_mtime_ns]
+        key = {
+            "data_path": os.path.abspath(params.data_path),
+            "sources": sources,
+            "class": type(self).__name__,
+            "n_samples": len(self.A),
+            **{
+                k: getattr(params, k, None)
+                for k in (
+                    "hamming", "secret_seed", "Q", "N", "rlwe", "stacked_circulants", "A_shift",
+                    "angular_emb", "base", "bucket_size", "feature_cache_dtype",
+                )
+            },
+        }
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+    def load_feature_cache(self, params):
+        """
+        Memory-maps the encoded training set from params.feature_cache_path, encoding
+        it first if no cache matches the data and encoder parameters. Angular features
+        are stored as params.feature_cache_dtype, digit ids in the narrowest int dtype.
+        """
+        os.makedirs(params.feature_cache_path, exist_ok=True)
+        prefix = os.path.join(params.feature_cache_path, f"features_{self.feature_cache_key(params)}")
+        A_path, b_path = f"{prefix}_A.npy", f"{prefix}_b.npy"
+
+        if not (os.path.isfile(A_path) and os.path.isfile(b_path)):
+            logger.info(f"Encoding the training set into {prefix}_*.npy ...")
+            if params.angular_emb:
+                dtype = np.dtype(params.feature_cache_dtype)
+            else:
+                dtype = narrowest_int_dtype(self.io_encoder.n_words)
+            # Two rows: AngularEncoder squeezes away a batch of one.
+            A_enc, b_enc = self.encode(self.A[:2], self.b[:2])
+            A_tmp, b_tmp = f"{A_path}.tmp{os.getpid()}", f"{b_path}.tmp{os.getpid()}"
+            A_cache = np.lib.format.open_memmap(A_tmp, "w+", dtype, (len(self), *A_enc.shape[1:]))
+            b_cache = np.lib.format.open_memmap(b_tmp, "w+", dtype, (len(self), *b_enc.shape[1:]))
+            for start in range(0, len(self), FEATURE_CACHE_CHUNK):
+                stop = min(start + FEATURE_CACHE_CHUNK, len(self))
+                A_enc, b_enc = self.encode(self.A[start:stop], self.b[start:stop])
+                A_cache[start:stop] = A_enc.numpy().reshape(A_cache[start:stop].shape)
+                b_cache[start:stop] = b_enc.numpy().reshape(b_cache[start:stop].shape)
+            A_cache.flush()
+            b_cache.flush()
+            del A_cache, b_cache
+            # b is renamed last: both files exist only once the cache is complete.
+            os.replace(A_tmp, A_path)
+            os.replace(b_tmp, b_path)
+
+        A_features = np.load(A_path, mmap_mode="r")
+        b_features = np.load(b_path, mmap_mode="r")
+        assert len(A_features) == len(b_features) == len(self), f"{prefix} does not match the dataset"
+        logger.info(f"Loaded encoded training set from {prefix}_*.npy")
+        return A_features, b_features
 
+    @classmethod
+    def A_b_paths(cls, params, split):
         h, s = params.hamming, params.secret_seed
-
         A_path = os.path.join(os.path.dirname(params.data_path), f"{split}_A.npy")
         b_path = os.path.join(params.data_path, f"{split}_b_{h}_{s}.npy")
+        return A_path, b_path
+
+    @classmethod
+    def load_A_b(cls, params, split, max_samples=None, to_tensors=True):
+        assert split in ("train", "test", "orig"), split
+
+        A_path, b_path = cls.A_b_paths(params, split)
 
         A = np.load(A_path, mmap_mode="c")
         b = np.load(b_path, mmap_mode="c")
@@ -100,28 +219,38 @@ class LWEDataset(Dataset):
         assert len(A) == len(b), f"A has {len(A)} elements but b has {len(b)}!"
 
         logger.info("Loaded data. [root: %s, count: %d]", params.data_path, len(A))
+        if to_tensors:
+            A, b = cls.to_tensors(A, b)
         return A, b
 
     @classmethod
     def transform(cls, A, b, params):
-        A = torch.from_numpy(A.astype(np.int64))
-        b = torch.from_numpy(b.astype(np.int64)).unsqueeze(-1)
+        """Returns A and b as (n, N) and (n, 1) arrays. Memory-mapped inputs are not copied."""
+        return A, b.reshape(-1, 1)
+
+    @classmethod
+    def to_tensors(cls, A, b):
+        A = torch.from_numpy(np.asarray(A, dtype=np.int64))
+        b = torch.from_numpy(np.asarray(b, dtype=np.int64))
         return A, b
 
-    def collate_fn(self, elements):
+    def encode(self, A, b):
+        A, b = self.to_tensors(A, b)
+        return self.io_encoder(A), self.io_encoder(b)
+
+    def collate_fn(self, batch):
         """
-        Collate samples into a batch. Because there are multiple y values for a single x
-        value, we split it up into many elements. So a single batch is actually
-            batch_size (cli arg) * params.n_unique_secrets
+        Turns a batch read by __getitem__ into model inputs: encodes it, or only converts
+        it when it comes from the feature cache.
         """
-        A, b = zip(*elements)
-
-        A = torch.stack(A)
-        b = torch.stack(b)
-
-        A = self.io_encoder(A)
-        b = self.io_encoder(b)
-        return A, b
+        A, b = batch
+        if self.A_features is None:
+            with self.timer.phase("encode"):
+                return self.encode(A, b)
+        if self.params.angular_emb:
+            # Copies out of the read-only cache.
+            return torch.from_numpy(np.array(A, dtype=np.float32)), torch.from_numpy(np.array(b, dtype=np.float32))
+        return self.to_tensors(A, b)
 
     def __len__(self):
         return len(self.A)
@@ -137,6 +266,58 @@ class LWEDataset(Dataset):
         return rng
 
 
+class CirculantRows(object):
+    """
+    Lazy (len(A) * n, k * n) view of the negacyclic rotations of compact RLWE/MLWE
+    rows A of shape (len(A), k * n), in the order RLWEDataset used to materialize them.
+    Global row g is rotation r of compact row l, with (l, r) = divmod(g, n) when the
+    circulants are stacked, (r, l) = divmod(g, len(A)) otherwise; it is the flipped
+    row shifted left n - 1 - r times, negating the wrapped entries, mod Q.
+    Slicing returns a view like a NumPy array; rows are computed when converted to an
+    array or indexed with an int or an index array.
+    """
+
+    def __init__(self, A, k, n, Q, stacked, start=0, stop=None):
+        self.A, self.k, self.n, self.Q, self.stacked = A, k, n, Q, stacked
+        self.start = start
+        self.stop = len(A) * n if stop is None else stop
+
+    @property
+    def shape(self):
+        return (self.stop - self.start, self.k * self.n)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert step == 1, "only contiguous slices are supported"
+            return CirculantRows(
+                self.A, self.k, self.n, self.Q, self.stacked, self.start + start, self.start + max(start, stop)
+            )
+        if np.ndim(index) == 0:
+            return self.rows(np.array([index]))[0]
+        return self.rows(np.asarray(index))
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self.rows(np.arange(len(self)))
+        return rows if dtype is None else rows.astype(dtype, copy=False)
+
+    def rows(self, index):
+        g = np.where(index < 0, index + len(self), index) + self.start
+        if self.stacked:
+            l, r = np.divmod(g, self.n)
+        else:
+            r, l = np.divmod(g, len(self.A))
+        k, n = self.k, self.n
+        flipped = np.asarray(self.A[l], dtype=np.int64).reshape(len(g), k, n)[..., ::-1]
+        cols = np.arange(n) + (n - 1 - r)[:, None]
+        sign = np.where(cols >= n, -1, 1)[:, None, :]
+        cols = np.broadcast_to((cols % n)[:, None, :], flipped.shape)
+        return (np.take_along_axis(flipped, cols, axis=2) * sign % self.Q).reshape(len(g), k * n)
+
+
 class RLWEDataset(LWEDataset):
     def __init__(self, params):
         super().__init__(params)
@@ -147,26 +328,19 @@ class RLWEDataset(LWEDataset):
 
     @classmethod
     def transform(cls, A, b, params):
-        """Will 'decompress' RLWE a,b data by column swapping/negating RA matrices to reconstruct original circulant matrices."""
+        """
+        Will 'decompress' RLWE a,b data by column swapping/negating RA matrices to reconstruct
+        original circulant matrices. Only the compact rows are kept: A becomes a CirculantRows
+        view and the rotations are computed when batches are read.
+        """
 
         k = params.rlwe
         n = params.N // k
         Q = params.Q
 
-        new_mat = np.flip(A.reshape((len(A), k, n)), axis=2)
-        circulated_mat = np.zeros((n, len(A), k, n), dtype=np.int32)
-        for i in range(n):
-            circulated_mat[~i] = new_mat
-            new_mat = cls.shift_negate(new_mat)
-
-        circulated_mat = circulated_mat % Q
-
-        if params.stacked_circulants:
-            circulated_mat = circulated_mat.swapaxes(0, 1)
-        else:
+        A = CirculantRows(A, k, n, Q, params.stacked_circulants)
+        if not params.stacked_circulants:
             b = b.T
-
-        A = circulated_mat.reshape((-1, k * n))
         b = b.flatten()
 
         b = b[: len(A)]
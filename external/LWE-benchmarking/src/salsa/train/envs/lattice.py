@@ -13,6 +13,7 @@ import math
 
 
 SPECIAL_WORDS = ["<eos>", "<pad>", "<mask>"]
+MAX_TABLE_SIZE = 2**16  # largest base**int_len for which DigitEncoder uses a lookup table
 logger = getLogger()
 
 
@@ -50,10 +51,37 @@ class DigitEncoder(object):
         if len(self.word2id) < 1000:
             logger.info(f"words: {self.word2id}")
 
+        # Place values of the digits, from high to low.
+        self.powers = self.int_base ** torch.arange(
+            self.int_len - 1, -1, -1, dtype=torch.int64
+        )
+        # Digits only depend on x mod base**int_len, so when that is small we
+        # precompute the ids of every residue and encode with a single gather.
+        self.table_mod = self.int_base**self.int_len
+        self.table = None
+        if self.table_mod <= MAX_TABLE_SIZE:
+            self.table = self.digits(torch.arange(self.table_mod, dtype=torch.int64))
+
     def __call__(self, x):
-        if isinstance(x, torch.Tensor):
-            x = x.numpy()
-        return torch.LongTensor(np.apply_along_axis(self.encode, axis=-1, arr=x))
+        """
+        Encodes a (..., N) array of integers into (..., N * int_len) token ids.
+        Same ids as applying `encode` to every row, but in a few tensor ops.
+        """
+        if not isinstance(x, torch.Tensor):
+            x = torch.from_numpy(np.asarray(x))
+        x = x.to(torch.int64)
+        if self.table is not None:
+            ids = self.table.to(x.device)[x % self.table_mod]
+        else:
+            ids = self.digits(x)
+        return ids.flatten(-2)
+
+    def digits(self, x):
+        """(...) integers -> (..., int_len) ids, high digit first, low digits bucketed."""
+        powers = self.powers.to(x.device)
+        digits = x.unsqueeze(-1).div(powers, rounding_mode="floor") % self.int_base
+        digits[..., 1:] //= self.bucket_size
+        return digits
 
     def encode(self, row):
         digits = self.encode_base(row)
@@ -71,18 +99,16 @@ class DigitEncoder(object):
         return lst
 
     def decode(self, logits):
-        device = logits.device
-        ids = logits.max(dim=1)[1].cpu().numpy()
+        ids = logits.max(dim=1)[1]
         assert ids.ndim == 2
-
-        words = [[self.id2word[_id] for _id in seq] for seq in ids]
-
-        b = (
-            torch.LongTensor([self.decode_base(seq) for seq in words])
-            .squeeze()
-            .to(device)
-        )
-        return b
+        return self.decode_ids(ids)
+
+    def decode_ids(self, ids):
+        """(batch, dim * int_len) token ids -> (batch, dim) integers, then squeezed."""
+        dim = ids.shape[1] // self.int_len
+        digits = ids[:, : dim * self.int_len].reshape(len(ids), dim, self.int_len)
+        powers = self.powers.to(ids.device)
+        return (digits.to(torch.int64) * powers).sum(-1).squeeze()
 
     def decode_base(self, lst):
         dim = len(lst) // self.int_len
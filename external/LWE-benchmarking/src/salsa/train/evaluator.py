@@ -7,23 +7,41 @@ LICENSE file in the root directory of this source tree.
 """
 
 from abc import abstractmethod
+import contextlib
 import json
 import os
 import pickle
 from logging import getLogger
 from functools import partial
+from types import SimpleNamespace
+import queue
 import numpy as np
 import torch
+import torch.multiprocessing as mp
 import itertools
 
-from scipy import stats
 from tqdm.auto import trange
 
-from src.utils import to_json, mod_diff
+from src.utils import to_json, mod_diff, pairwise_mod_diff, SecretVerifier, create_this_logger
+from src.salsa.train.perf import PhaseTimer, autocast, quantize_dynamic, set_cpu_threads
 
 
 logger = getLogger()
 
+RECOVERY_LOG = "recovery.jsonl"
+MAX_LOGGED_GUESSES = 64
+# Angular predictions agree when they are within this fraction of Q (mod Q).
+QUANTIZE_ANGULAR_TOLERANCE = 0.01
+
+
+def read_recovery_log(dump_path):
+    """The records appended by SecretRecovery.recover, oldest first."""
+    path = os.path.join(dump_path, RECOVERY_LOG)
+    if not os.path.isfile(path):
+        return []
+    with open(path) as fd:
+        return [json.loads(line) for line in fd if line.strip()]
+
 
 class SecretRecovery:
     def __init__(self, params, dataset, model, recover_metrics):
@@ -38,8 +56,9 @@ class SecretRecovery:
         self.secret_type = params.secret_type
 
         self.secret_log = SecretLog(epoch=0)
+        self.timer = PhaseTimer(sync_cuda=params.perf_sync_cuda)
 
-        secret_check = SecretCheck(self.params, self.orig_dataset)
+        self.secret_check = secret_check = SecretCheck(self.params, self.orig_dataset)
 
         if self.params.dxdistinguisher:
             self.dist = SlopeDistinguisher(self.params, secret_check, self.secret_log)
@@ -56,13 +75,24 @@ class SecretRecovery:
         else:
             raise ValueError(self.secret_type)
 
-        self.amp_ctx = torch.amp.autocast(
-            device_type="cuda", dtype=getattr(torch, self.params.dtype)
+        self.amp_ctx = autocast(self.params.device, self.params.dtype)
+        self.engine = PerturbationEngine(
+            self.params, self.model, self.io_encoder, self.amp_ctx
         )
+        if self.params.recover_quantize:
+            assert self.device.type == "cpu", "quantized recovery only runs on CPU"
+        self.quantize_checked = not self.params.recover_quantize_check
 
-    @torch.no_grad()
+    def quantized_engine(self):
+        """A PerturbationEngine on an int8 dynamically quantized copy of the current model."""
+        model = quantize_dynamic(self.model)
+        return PerturbationEngine(self.params, model, self.io_encoder, contextlib.nullcontext())
+
+    @torch.inference_mode()
     def recover(self, epoch):
         logger.info("Starting secret recovery.")
+        self.timer.reset()
+        self.secret_check.reset()
         # Recover secret. Higher difference => bit more likely nonzero
 
         self.secret_log["epoch"] = epoch
@@ -72,9 +102,22 @@ class SecretRecovery:
         A, b = self.test_dataset
         assert len(A) == self.params.distinguisher_size
 
-        f_a, f_ai, dx = self.compute_outputs(A, b)
+        engine = self.engine
+        if self.params.recover_quantize:
+            with self.timer.phase("quantize"):
+                engine = self.quantized_engine()
+
+        perturbations = self.dist.get_perturbations(A)
+        f_a, f_ai, dx = self.compute_outputs(A, b, engine, perturbations)
+
+        quantize_metrics = {}
+        if engine is not self.engine and not self.quantize_checked:
+            with self.timer.phase("quantize_check"):
+                quantize_metrics = self.compare_quantized(A, f_a, f_ai, perturbations)
+            self.quantize_checked = True
 
-        matched = self.dist.run(f_a, f_ai, dx)
+        with self.timer.phase("distinguish"):
+            matched = self.dist.run(f_a, f_ai, dx)
 
         if matched:
             logger.info("Predicted secret.")
@@ -86,41 +129,229 @@ class SecretRecovery:
                 **{k: v.item() for k, v in self.recover_metrics.compute().items()},
                 "recover/matched": matched,
                 "recover/epoch": epoch,
+                **quantize_metrics,
+                **self.timer.summary("recover/time/"),
             }
             logger.info("%s", json.dumps(metrics))
             self.secret_log.dump(self.params.dump_path, epoch)
+            self.log_result(epoch, matched)
 
         return matched
 
-    def compute_outputs(self, A, b):
+    def log_result(self, epoch, matched):
+        """Appends the outcome of a recovery, with the guesses checked, to RECOVERY_LOG."""
+        record = {
+            "epoch": epoch,
+            "matched": bool(matched),
+            "secret": self.secret_check.secret,
+            "guesses": self.secret_check.guesses,
+            **self.timer.summary("time/"),
+        }
+        with open(os.path.join(self.params.dump_path, RECOVERY_LOG), "a") as fd:
+            fd.write(json.dumps(record) + "\n")
+
+    def compute_outputs(self, A, b, engine, perturbations):
+        """
+        Returns the predictions of engine on A, the (N, distinguisher_size) predictions
+        with each coordinate of A perturbed in turn, and the matching perturbations dx.
+        """
         self.recover_metrics.reset()
 
-        f_a, logits = self.inference(A, True)
-        self.recover_metrics(logits, self.io_encoder(b).to(self.params.device))
-        self.recover_metrics.compute()
+        with self.timer.phase("forward"):
+            A_enc = self.io_encoder(A)
+            f_a, logits = engine.forward(A_enc)
+            self.recover_metrics(logits, self.io_encoder(b).to(self.params.device))
+            self.recover_metrics.compute()
 
-        f_ai = []
-        dx = []
-        for Ai, dxi in self.dist.get_inputs(A):
-            preds = self.inference(Ai)
-            f_ai.append(preds)
-            dx.append(dxi)
+        with self.timer.phase("perturbed_forward"):
+            columns, dx = perturbations
+            f_ai = engine.run(A_enc, columns)
 
         return f_a, f_ai, dx
 
-    def inference(self, A, return_logits=False):
-        self.model.eval()
+    def compare_quantized(self, A, f_a, f_ai, perturbations):
+        """
+        Runs the model in float32 (no autocast) on the same perturbations as the quantized
+        one and returns how much the predictions and the distinguisher scores differ. Digit
+        predictions agree when equal; angular ones, which are continuous, when their mod Q
+        distance is at most QUANTIZE_ANGULAR_TOLERANCE * Q.
+        """
+        full_engine = PerturbationEngine(self.params, self.model, self.io_encoder, contextlib.nullcontext())
         A_enc = self.io_encoder(A)
-        A_enc = A_enc.to(self.device)
-        with self.amp_ctx:
-            logits = self.model(A_enc)
+        f_a_full, _ = full_engine.forward(A_enc)
+        f_ai_full = full_engine.run(A_enc, perturbations[0])
+        dx = perturbations[1]
+
+        def coord_scores(y0, y1s):
+            scores = np.asarray(self.dist.compute_scores(y0, y1s, dx), dtype=float)
+            return np.nanmean(scores, axis=1) if scores.ndim == 2 else scores
+
+        full, quant = coord_scores(f_a_full, f_ai_full), coord_scores(f_a, f_ai)
+        diff = np.abs(full - quant)
+        pred_dist = torch.abs(f_ai - f_ai_full) % self.Q
+        pred_dist = torch.minimum(pred_dist, self.Q - pred_dist)
+        tolerance = QUANTIZE_ANGULAR_TOLERANCE * self.Q if self.params.angular_emb else 0
+        h = self.params.hamming
+        top_full, top_quant = np.argsort(-full, kind="stable")[:h], np.argsort(-quant, kind="stable")[:h]
+        return {
+            "recover/quantize/pred_agreement": (pred_dist <= tolerance).float().mean().item(),
+            "recover/quantize/pred_mean_mod_dist": pred_dist.float().mean().item(),
+            "recover/quantize/score_max_abs_diff": float(np.nanmax(diff)),
+            "recover/quantize/score_mean_abs_diff": float(np.nanmean(diff)),
+            "recover/quantize/top_h_overlap": len(set(top_full) & set(top_quant)) / h,
+        }
 
-        preds = self.io_encoder.decode(logits)
+    def inference(self, A, return_logits=False):
+        preds, logits = self.engine.forward(self.io_encoder(A))
         if return_logits:
             return preds, logits
         return preds
 
 
+def _recovery_worker(params, dataset, snapshots, results):
+    """Runs SecretRecovery on each (step, epoch, state_dict) snapshot until it gets None."""
+    from src.salsa.train import get_model, get_metrics
+
+    create_this_logger(params)
+    set_cpu_threads(params.cpu_threads, params.cpu_interop_threads)
+    model = get_model(params).to(params.device)
+    _, recover_metrics = get_metrics(params)
+    secret_recovery = SecretRecovery(params, dataset, model, recover_metrics)
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            return
+        step, epoch, state_dict = snapshot
+        model.load_state_dict(state_dict)
+        logger.info(f"Secret recovery on the weights of step {step}.")
+        results.put((step, epoch, secret_recovery.recover(epoch)))
+
+
+class AsyncSecretRecovery:
+    """
+    Runs secret recovery in a separate process, on CPU snapshots of the model weights,
+    while training continues. At most one snapshot waits while a recovery runs: a newer
+    snapshot replaces it, so recovery skips steps when it falls behind.
+    """
+
+    def __init__(self, params, dataset):
+        assert not params.multi_gpu, "asynchronous recovery only supports single-process training"
+        ctx = mp.get_context("spawn")
+        self.snapshots = ctx.Queue(maxsize=1)
+        self.results = ctx.Queue()
+        # Only what SecretRecovery reads from the dataset, not the training set.
+        recovery_data = SimpleNamespace(
+            io_encoder=dataset.io_encoder,
+            test_dataset=dataset.test_dataset,
+            orig_dataset=dataset.orig_dataset,
+        )
+        self.worker = ctx.Process(
+            target=_recovery_worker,
+            args=(params, recovery_data, self.snapshots, self.results),
+            daemon=True,
+        )
+        self.worker.start()
+
+    def submit(self, step, epoch, model):
+        model = getattr(model, "module", model)  # unwrap DistributedDataParallel
+        state_dict = {k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()}
+        try:
+            stale_step = self.snapshots.get_nowait()[0]
+            logger.info(f"Secret recovery is behind: dropping the snapshot of step {stale_step}.")
+        except queue.Empty:
+            pass
+        self.snapshots.put((step, epoch, state_dict))
+
+    def drain(self):
+        """Logs the finished recoveries, True if one of them found the secret."""
+        recovered = False
+        while True:
+            try:
+                step, epoch, matched = self.results.get_nowait()
+            except queue.Empty:
+                return recovered
+            logger.info(f"Secret recovery on step {step} (epoch {epoch}): matched = {matched}")
+            recovered = recovered or matched
+
+    def poll(self):
+        """True if a finished recovery found the secret."""
+        recovered = self.drain()
+        if not recovered and not self.worker.is_alive():
+            raise RuntimeError(f"Secret recovery worker died with exit code {self.worker.exitcode}")
+        return recovered
+
+    def close(self, wait=False):
+        """Stops the worker, after the queued snapshot if wait. Returns drain()."""
+        if wait:
+            self.snapshots.put(None)
+            self.worker.join()
+        else:
+            self.worker.terminate()
+            self.worker.join()
+        return self.drain()
+
+
+class PerturbationEngine:
+    """
+    Runs the model on N copies of the test matrix, the i-th one with column i
+    replaced. The matrix is encoded once; only the replaced columns are encoded
+    and written into copies of the base encoding, and as many coordinates as fit
+    in params.recover_memory_budget (MB) are packed into each forward pass.
+    Each sample is predicted independently, so the predictions match running the
+    N perturbed matrices one at a time.
+    """
+
+    def __init__(self, params, model, io_encoder, amp_ctx):
+        self.params = params
+        self.model = model
+        self.io_encoder = io_encoder
+        self.amp_ctx = amp_ctx
+        self.device = params.device
+        self.memory_budget = params.recover_memory_budget * 1024**2
+
+    def forward(self, enc):
+        self.model.eval()
+        with self.amp_ctx:
+            logits = self.model(enc.to(self.device))
+        preds = self.io_encoder.decode(logits)
+        return preds, logits
+
+    def coords_per_batch(self, n_samples, seq_len):
+        """How many perturbed matrices fit in the memory budget at once."""
+        # Per sample, inference keeps about one block of float32 activations alive:
+        # the qkv and MLP projections (~8 * emb_dim per token) and the attention
+        # scores of every head (twice, before and after the softmax).
+        per_token = 8 * self.params.enc_emb_dim + 2 * self.params.n_enc_heads * seq_len
+        per_sample = 4 * seq_len * per_token
+        return max(1, int(self.memory_budget // (per_sample * n_samples)))
+
+    @torch.inference_mode()
+    def run(self, A_enc, columns):
+        """
+        A_enc: encoding of the (distinguisher_size, N) test matrix.
+        columns: (N, distinguisher_size) tensor, columns[i] replaces column i.
+        Returns the (N, distinguisher_size) predictions.
+        """
+        n_coords, n_samples = columns.shape
+        # View encodings as (samples, N, width): `width` entries per coordinate,
+        # i.e. the digits of a DigitEncoder or the (cos, sin) of an AngularEncoder.
+        base = A_enc.to(self.device).view(n_samples, n_coords, -1)
+        col_enc = self.io_encoder(columns.reshape(-1, 1))
+        col_enc = col_enc.to(self.device).view(n_coords, n_samples, -1)
+
+        step = self.coords_per_batch(n_samples, A_enc.shape[1])
+        preds = []
+        for start in trange(0, n_coords, step):
+            idx = torch.arange(start, min(start + step, n_coords), device=self.device)
+            batch = base.unsqueeze(0).repeat(len(idx), 1, 1, 1)
+            batch[torch.arange(len(idx), device=self.device), :, idx] = col_enc[idx]
+            batch = batch.view(len(idx) * n_samples, *A_enc.shape[1:])
+            batch_preds, _ = self.forward(batch)
+            preds.append(batch_preds.view(len(idx), n_samples))
+
+        return torch.cat(preds)
+
+
 class SecretLog:
     success_key = "success"
 
@@ -164,35 +395,53 @@ class SecretCheck:
         self.sigma = params.sigma
 
         A, b = orig_dataset
-        self.A = A.squeeze().numpy()
-        self.b = b.squeeze().numpy()
+        self.verifier = SecretVerifier(A.squeeze(), b.squeeze(), self.Q, self.sigma)
 
         # Only need this for gaussian secret; eventually we won't need it.
         self.secret_type = params.secret_type
+        self.reset()
+
+    def reset(self):
+        """Forgets the guesses checked so far (only the first MAX_LOGGED_GUESSES are kept) and the matching one."""
+        self.guesses = []
+        self.secret = None
 
     def match_secret(self, guess):
         """Takes an int or bool (binary) list or array as secret guess and check against
         the original tiny dataset.
         """
-        guess = np.array(guess).astype(int)
-
-        err_pred = (self.A @ guess - self.b) % self.Q
-        err_pred[err_pred > self.Q // 2] -= self.Q
-        return (np.std(err_pred) < 2 * self.sigma).item()
+        return self.match_secrets(np.array(guess).reshape(1, -1))
+
+    def match_secrets(self, guesses):
+        """Takes a (K, N) batch of guesses, True if any of them is the secret."""
+        guesses = np.array(guesses).astype(int)
+        n_kept = MAX_LOGGED_GUESSES - len(self.guesses)
+        if n_kept > 0:
+            self.guesses += guesses[:n_kept].tolist()
+        first = self.verifier.first_match(guesses)
+        if first is None:
+            return False
+        self.secret = guesses[first].tolist()
+        return True
 
     def match_secret_iter(self, idx_list, sorted_idx_with_scores, method_name):
         """
         Takes a list of indices sorted by scores (descending, high score means more likely to be 1)
         and iteratively matches the secret.
         """
-        guess = np.zeros(self.N)
-        for i in range(min(self.N // 5, len(idx_list))):  # sparse assumption
-            guess[idx_list[i]] = 1
-            if self.match_secret(guess):
-                return True
+        n_guesses = min(self.N // 5, len(idx_list))  # sparse assumption
+        if self.match_secrets(self.cumulative_guesses(idx_list[:n_guesses])):
+            return True
         logger.info(f"{method_name}: secret not predicted.")
         return False
 
+    def cumulative_guesses(self, idx_list):
+        """Row i is the binary guess with the bits idx_list[: i + 1] set."""
+        guesses = np.zeros((len(idx_list), self.N), dtype=int)
+        rows = np.arange(len(idx_list))
+        guesses[rows, np.asarray(idx_list, dtype=int)] = 1
+        return np.maximum.accumulate(guesses, axis=0)
+
 
 class BaseDistinguisher(object):
     def __init__(self, params, secret_check, secret_log) -> None:
@@ -202,7 +451,11 @@ class BaseDistinguisher(object):
         self.secret_check = secret_check
         self.secret_log = secret_log
 
-    def get_inputs(self, A):
+    def get_perturbations(self, A):
+        """
+        Returns (columns, dx), both (N, distinguisher_size): columns[i] is the new
+        ith "bit" of A, dx[i] what was added to it.
+        """
         # Prepare the random values to add to each coordinate of A. The first half in
         # (0.3q, 0.4q), the second half in (0.6q, 0.7q)
         add_rand = torch.randint(
@@ -213,15 +466,11 @@ class BaseDistinguisher(object):
         )
         add_rand = torch.concat((add_rand, -add_rand))
 
-        for i in trange(self.params.N):
-            # Modify ith "bit" of A
-            Ai = A.clone()
-            Ai[:, i] += add_rand
-            Ai[:, i] %= self.Q
-            yield Ai, add_rand
+        columns = (A.T + add_rand) % self.Q
+        return columns, add_rand.expand(self.params.N, -1)
 
     def compute_scores(self, y0, y1s, dx=None):
-        scores = [mod_diff(y0, mod_pred, Q=self.Q) for mod_pred in y1s]
+        scores = list(mod_diff(y0.expand_as(y1s), y1s, Q=self.Q, dim=1))
         self.secret_log[mod_diff.__name__] = scores
         return scores
 
@@ -263,19 +512,20 @@ class TwoBitDistinguisher(BaseDistinguisher):
             for e in itertools.product(s_i, repeat=len(cliques))
             if len(np.unique(e)) > 1 and e[0] not in range(min(s_i), 0)
         ]
-        for values in secret_elements:  # All combos of clique length.
-            guess = np.zeros(self.params.N)
-            for i, c in enumerate(cliques):
-                guess[nonzeros[list(c)]] = values[i]
-
-            method_name = "Distinguisher Method"
-
-            if self.secret_check.match_secret(guess) or self.secret_check.match_secret(
-                guess * -1
-            ):
-                logger.info("%s: all bits in secret recovered!", method_name)
-                self.secret_log.add_success(method_name)
-                return True
+        if not secret_elements:
+            return False
+        # All combos of clique length, each followed by its negation.
+        guesses = np.zeros((len(secret_elements), 2, self.params.N))
+        for i, c in enumerate(cliques):
+            guesses[:, 0, nonzeros[list(c)]] = np.array(secret_elements)[:, [i]]
+        guesses[:, 1] = -guesses[:, 0]
+
+        method_name = "Distinguisher Method"
+
+        if self.secret_check.match_secrets(guesses.reshape(-1, self.params.N)):
+            logger.info("%s: all bits in secret recovered!", method_name)
+            self.secret_log.add_success(method_name)
+            return True
 
         return False
 
@@ -287,7 +537,7 @@ class TwoBitDistinguisher(BaseDistinguisher):
         - Split second clique, test with three cliques.
         - Test with all four splits.
         """
-        func1, diff_func = self.func1
+        func1, _ = self.func1
         self.secret_log_name = f"{self.params.secret_type}_{self.func0}_{func1}"
 
         diffs = self.compute_scores(base_pred, lwe_preds)
@@ -306,27 +556,20 @@ class TwoBitDistinguisher(BaseDistinguisher):
         ) or self.check_cliques([[0], [1]], nonzeros=idx_sorted[-2:]):
             return True
 
-        # compute the dist matrices and run.
-        dists = np.zeros((self.params.N, self.params.N))
+        # compute the dist matrices and run. Below the diagonal: mod_diff on the
+        # second half of the samples, above: on the first half.
         half = self.params.distinguisher_size // 2  # TODO is 128 samples enough?
-        for i in range(self.params.N):
-            for j in range(i):
-                dists[i, j] = diff_func(lwe_preds[i][half:], lwe_preds[j][half:])
-                dists[j, i] = diff_func(lwe_preds[i][:half], lwe_preds[j][:half])
+        dists = np.tril(pairwise_mod_diff(lwe_preds[:, half:], self.Q).numpy(), -1)
+        dists = dists + np.triu(pairwise_mod_diff(lwe_preds[:, :half], self.Q).numpy(), 1)
+        dists = dists.astype(np.float64)
 
         # for each hamming weight, make secret guesses by forming partitions of the nonzero bits.
         for h in [
             self.params.hamming
         ]:  ##range(5, self.params.N // 5): # sparse assumption
             self.nonzeros = idx_sorted[-h:]
-            dist_mats = [np.zeros((h, h)), np.zeros((h, h))]
-            for i in range(h):
-                for j in range(i):
-                    idx1, idx2 = self.nonzeros[i], self.nonzeros[j]
-                    dist_mats[0][i, j], dist_mats[1][i, j] = (
-                        dists[idx1, idx2],
-                        dists[idx2, idx1],
-                    )
+            sub = dists[np.ix_(self.nonzeros, self.nonzeros)]
+            dist_mats = [np.tril(sub, -1), np.tril(sub.T, -1)]
 
             dist_mats.append(dist_mats[0] + dist_mats[1])
             for i, dist_mat in enumerate(dist_mats):
@@ -672,14 +915,9 @@ class BinaryDistinguisher(BaseDistinguisher):
         # Only need to flip at most h = N/2 bits to 1.
         sorted_i_score = sorted_i_score[: self.N // 2 + 1]
 
-        guess = np.zeros(self.N)
-        for i, score in sorted_i_score:
-            # Set another bit in the guess and check if it's the secret
-            guess[i] = 1
-            if self.secret_check.match_secret(guess):
-                return True
-
-        return False
+        # Set one more bit in each guess and check if any is the secret
+        guesses = self.secret_check.cumulative_guesses([i for i, _ in sorted_i_score])
+        return self.secret_check.match_secrets(guesses)
 
 
 class SlopeDistinguisher(BaseDistinguisher):
@@ -692,43 +930,58 @@ class SlopeDistinguisher(BaseDistinguisher):
         self.device = params.device
 
     def run(self, base_pred, modified_preds, dx):
-        derivative_samples = self.compute_scores(base_pred, modified_preds, dx)
-
-        guesses = np.zeros((4, self.N), dtype=int)
-        for i, sample in enumerate(derivative_samples):
-            guesses[0, i] = int(stats.mode(sample).mode.round())
-            guesses[1, i] = int(stats.mode(sample.round()).mode)
-            guesses[2, i] = int(np.mean(sample).round())
-            guesses[3, i] = int(np.median(sample).round())
-
-        return bool(
-            np.any([self.secret_check.match_secret(guess) for guess in guesses])
-        )
-
-    def get_inputs(self, A):
-        for i in range(self.N):
-            Ai = A.clone()
-            dxi = Ai[:, i].clone()
-            dxi[dxi > self.Q // 2] -= self.Q
-            dxi //= 2
-            Ai[:, i] -= dxi
-            yield Ai, dxi
+        # (N, distinguisher_size) slopes, nan where dx == 0.
+        slopes = self.compute_scores(base_pred, modified_preds, dx)
+
+        guesses = np.stack(
+            [
+                self.row_mode(slopes).round(),
+                self.row_mode(slopes.round()),
+                np.nanmean(slopes, axis=1).round(),
+                np.nanmedian(slopes, axis=1).round(),
+            ]
+        ).astype(int)
+
+        return self.secret_check.match_secrets(guesses)
+
+    def get_perturbations(self, A):
+        # Move each coordinate halfway towards 0 (centered mod Q).
+        dx = A.T.clone()
+        dx[dx > self.Q // 2] -= self.Q
+        dx //= 2
+        return A.T - dx, dx
 
     def compute_scores(self, fa, fai, dx):
         # Compute the slopes: (f(x1)-f(x0))/dx where the diff is modQ.
-        derivatives = [
-            self.mod_derivative(fai[i], fa, dx[i].to(self.device), self.Q)
-            for i in range(self.N)
-        ]
-        return derivatives
+        return self.mod_derivative(fai, fa.expand_as(fai), dx.to(self.device), self.Q)
 
     def mod_derivative(self, Y0, Y1, dx, modulus):
-        mask = dx != 0
-        Y0 = Y0[mask]
-        Y1 = Y1[mask]
-        dx = dx[mask]
-        assert Y0.shape == Y1.shape
+        """Row-wise slopes of (N, distinguisher_size) inputs; nan where dx == 0."""
+        assert Y0.shape == Y1.shape == dx.shape
         diff = torch.abs(Y1 - Y0)
         diff = torch.minimum(diff, modulus - diff)
         dfdx = torch.sign(Y1 - Y0).to(float) * diff / dx
+        dfdx[dx == 0] = torch.nan
         return dfdx.cpu().numpy()
+
+    @staticmethod
+    def row_mode(x):
+        """
+        Per-row equivalent of stats.mode on the non-nan entries of a 2D array: the
+        most frequent value, the smallest one on ties.
+        """
+        x = np.sort(x, axis=1)  # nans go last, each counts as its own run
+        n_rows, n_cols = x.shape
+        starts = np.ones(x.shape, dtype=bool)
+        starts[:, 1:] = x[:, 1:] != x[:, :-1]
+        pos = np.broadcast_to(np.arange(n_cols), x.shape)
+        # Index of the first element of each element's run of equal values.
+        first = np.maximum.accumulate(np.where(starts, pos, 0), axis=1)
+        # Index of the last element of each element's run, via the next run start.
+        ends = np.ones(x.shape, dtype=bool)
+        ends[:, :-1] = starts[:, 1:]
+        last = np.minimum.accumulate(np.where(ends, pos, n_cols)[:, ::-1], axis=1)[
+            :, ::-1
+        ]
+        counts = np.where(np.isnan(x), 0, last - first + 1)
+        return x[np.arange(n_rows), counts.argmax(axis=1)]
@@ -0,0 +1,137 @@
+""""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import copy
+import os
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from logging import getLogger
+
+import torch
+
+
+logger = getLogger()
+
+
+class PhaseTimer(object):
+    """
+    Accumulates wall time per named phase since the last reset. Phases may nest
+    (e.g. encode inside data); each one is also labelled in torch.profiler traces.
+    With sync_cuda, CUDA is synchronized around each phase so that the timings
+    include the kernels it launched, not only their launch.
+    """
+
+    def __init__(self, sync_cuda=False):
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.reset()
+
+    def reset(self):
+        self.times = defaultdict(float)
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+        finally:
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            self.times[name] += time.perf_counter() - start
+
+    def timed(self, iterable, name):
+        """Iterates over iterable, timing each next() as phase name."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def summary(self, prefix):
+        """{prefix}{phase}_s for each phase, and {prefix}wall_s since the last reset."""
+        summary = {f"{prefix}{name}_s": t for name, t in self.times.items()}
+        summary[f"{prefix}wall_s"] = self.elapsed()
+        return summary
+
+
+def autocast(device, dtype):
+    """
+    Mixed precision context for --dtype on device. On CPU only bfloat16 is used
+    (float16 CPU kernels are slower than float32), other dtypes run in float32.
+    """
+    if device.type == "cuda":
+        return torch.amp.autocast(device_type="cuda", dtype=getattr(torch, dtype))
+    return torch.amp.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=dtype == "bfloat16")
+
+
+def set_cpu_threads(intra_op, inter_op):
+    """Sets torch's intra-op and inter-op thread counts, 0 keeps the default."""
+    if intra_op > 0:
+        torch.set_num_threads(intra_op)
+    if inter_op > 0:
+        # Only allowed before any inter-op parallel work has started.
+        torch.set_num_interop_threads(inter_op)
+
+
+def quantize_dynamic(model):
+    """Copy of model for CPU inference, with the nn.Linear layers dynamically quantized to int8."""
+    model = copy.deepcopy(model).cpu().eval()
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process, in MB (ru_maxrss is in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ProfilerWindow(object):
+    """
+    Records a torch.profiler trace of the n_steps steps after step start and exports
+    it to dump_path as a Chrome trace. Disabled if start < 0.
+    """
+
+    def __init__(self, start, n_steps, dump_path, rank=0, cuda=False):
+        self.start, self.n_steps = start, n_steps
+        self.dump_path, self.rank, self.cuda = dump_path, rank, cuda
+        self.profiler = None
+
+    def step(self, step):
+        if self.start < 0:
+            return
+        if self.profiler is None and step == self.start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(
+                activities=activities, record_shapes=True, profile_memory=True
+            )
+            self.profiler.start()
+            logger.info(f"Profiling steps {step + 1} to {step + self.n_steps} ...")
+        elif self.profiler is not None and step >= self.start + self.n_steps:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        path = os.path.join(self.dump_path, f"trace_{self.start}_{self.rank}.json")
+        self.profiler.export_chrome_trace(path)
+        logger.info(f"Saved profiler trace to {path}")
+        self.profiler = None
+        self.start = -1  # one window per run
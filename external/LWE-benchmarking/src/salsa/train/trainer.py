@@ -13,6 +13,8 @@ from logging import getLogger
 import torch
 from torch.nn.utils import clip_grad_norm_
 from src.salsa.train.optim import get_optimizer
+from src.salsa.train.perf import PhaseTimer, ProfilerWindow, autocast, peak_rss_mb
+from src.salsa.train.evaluator import AsyncSecretRecovery
 from src.utils import hour
 
 
@@ -34,6 +36,9 @@ class Trainer(object):
         self.model = model.to(params.device)
         self.train_metrics = train_metrics
         self.secret_recovery = secret_recovery
+        self.async_recovery = None
+        if params.async_recovery and not params.recover_only:
+            self.async_recovery = AsyncSecretRecovery(params, dataset)
 
         # float16 / distributed (no AMP)
         if params.multi_gpu:
@@ -54,6 +59,18 @@ class Trainer(object):
         self.start_time = datetime.datetime.now()
         self.should_stop_training = False
 
+        # throughput statistics, logged every log_every batches
+        self.timer = PhaseTimer(sync_cuda=params.perf_sync_cuda)
+        self.dataset.timer = self.timer  # times the encoding of batches built in this process
+        self.interval_examples = 0
+        self.profiler = ProfilerWindow(
+            params.profile_start,
+            params.profile_steps,
+            params.dump_path,
+            rank=params.global_rank,
+            cuda=params.device.type == "cuda",
+        )
+
         # reload potential checkpoints
         self.try_reload_checkpoint()
 
@@ -77,9 +94,7 @@ class Trainer(object):
         """
         enabled = self.params.dtype == "float16" and self.params.device.type == "cuda"
         self.scaler = torch.cuda.amp.GradScaler(enabled=enabled)
-        self.amp_ctx = torch.amp.autocast(
-            device_type="cuda", dtype=getattr(torch, self.params.dtype)
-        )
+        self.amp_ctx = autocast(self.params.device, self.params.dtype)
 
     def optimize(self, loss):
         """
@@ -131,6 +146,26 @@ class Trainer(object):
                 "learning_rate": current_lr
             }
             logger.info("%s", json.dumps(metrics))
+            logger.info("%s", json.dumps(self.perf_metrics()))
+
+        if batch_num % (self.params.log_every) == 0:
+            self.timer.reset()
+            self.interval_examples = 0
+
+    def perf_metrics(self):
+        """Time spent in each phase since the last log, throughput and peak memory."""
+        # data includes encode when the batches are built in this process (workers == 0)
+        metrics = {
+            "perf/step": self.step,
+            **self.timer.summary("perf/"),
+            "perf/examples_per_sec": self.interval_examples
+            * self.params.world_size
+            / max(self.timer.elapsed(), 1e-9),
+            "perf/peak_rss_mb": peak_rss_mb(),
+        }
+        if self.params.device.type == "cuda":
+            metrics["perf/peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 1024**2
+        return metrics
 
     def save_checkpoint(self, name="checkpoint", include_optimizer=True):
         """
@@ -196,22 +231,27 @@ class Trainer(object):
         params = self.params
         self.model.train()
 
-        dataloader = self.dataset.build_train_dataloader()
+        dataloader = self.dataset.build_train_dataloader(self.epoch)
 
-        for batch_num, (A, b) in enumerate(dataloader):
-            b = b.to(params.device, non_blocking=True)
-            A = A.to(params.device, non_blocking=True)
+        for batch_num, (A, b) in enumerate(self.timer.timed(dataloader, "data")):
+            with self.timer.phase("transfer"):
+                b = b.to(params.device, non_blocking=True)
+                A = A.to(params.device, non_blocking=True)
 
-            with self.amp_ctx:
+            with self.timer.phase("forward"), self.amp_ctx:
                 logits = self.model(A)
                 loss = self.loss_fn(logits, b)
 
                 self.train_metrics(logits, b)
 
-            grad = self.optimize(loss)
+            with self.timer.phase("backward"):
+                grad = self.optimize(loss)
             self.step += 1
+            self.interval_examples += len(A)
+            self.profiler.step(self.step)
             self.iter(batch_num, loss, grad)
-            self.should_stop_training = self.eval(self.step)
+            with self.timer.phase("recover"):
+                self.should_stop_training = self.eval(self.step)
             if self.should_stop_training:
                 self.end_train()
                 return
@@ -226,7 +266,9 @@ class Trainer(object):
         ):
             self.save_checkpoint(f"checkpoint_{self.epoch}")
 
-        self.should_stop_training = self.eval(self.step, end_epoch=True)
+        if not self.should_stop_training:
+            with self.timer.phase("recover"):
+                self.should_stop_training = self.eval(self.step, end_epoch=True)
         self.save_checkpoint()
         self.epoch += 1
 
@@ -234,10 +276,19 @@ class Trainer(object):
         """
         Run secret recovery.
         """
-        if end_epoch or (
+        due = end_epoch or (
             self.params.check_secret_every > 0
             and step % self.params.check_secret_every == 0
-        ):
+        )
+        if self.async_recovery is not None:
+            if due:
+                self.async_recovery.submit(step, self.epoch, self.uncompiled_model)
+            recovered = self.async_recovery.poll()
+            if recovered:
+                logger.info("Recovered secret!")
+            # poll() reports each match once: keep it once training has stopped
+            return recovered or self.should_stop_training
+        if due:
             self.model.eval()
             recovered = self.secret_recovery.recover(self.epoch)
             self.model.train()
@@ -251,8 +302,18 @@ class Trainer(object):
         Checkpoint before ending training.
         """
         logger.info("Checkpointing before ending the training!")
+        self.profiler.stop()
         self.save_checkpoint()
 
+    def close(self, wait_recovery=True):
+        """Stops the recovery worker, letting it finish the last snapshot if wait_recovery, and the profiler."""
+        self.profiler.stop()
+        if self.async_recovery is not None:
+            if self.async_recovery.close(wait=wait_recovery and not self.should_stop_training):
+                logger.info("Recovered secret!")
+                self.should_stop_training = True
+            self.async_recovery = None
+
     def check_time_limit(self):
         """
         Check if training time has exceeded time limit.
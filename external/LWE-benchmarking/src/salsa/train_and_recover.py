@@ -8,15 +8,17 @@ LICENSE file in the root directory of this source tree.
 
 import argparse
 import getpass
+import json
 import os
 import sys
 import time
 sys.path.append("./")
 
 from src.slurm import init_distributed_mode, init_signal_handler
-from src.salsa.train.evaluator import SecretRecovery
+from src.salsa.train.evaluator import SecretRecovery, read_recovery_log
 from src.salsa.train import get_dataset, get_model, get_metrics
 from src.salsa.train.trainer import Trainer
+from src.salsa.train.perf import set_cpu_threads
 from src.utils import bool_flag, initialize_exp, load_params
 
 
@@ -33,6 +35,27 @@ def get_parser():
         "--save_periodic", type=int, default=0, help="Save every n epochs"
     )
     parser.add_argument("--check_secret_every", type=int, default=2000)
+    parser.add_argument(
+        "--async_recovery",
+        type=bool_flag,
+        default=False,
+        help="Run secret recovery in a separate process on weight snapshots while training continues",
+    )
+    parser.add_argument(
+        "--perf_sync_cuda",
+        type=bool_flag,
+        default=False,
+        help="Synchronize CUDA around timed phases, for exact per-phase GPU timings (slower)",
+    )
+    parser.add_argument(
+        "--profile_start",
+        type=int,
+        default=-1,
+        help="Record a torch.profiler trace of the steps after this one, -1 to disable",
+    )
+    parser.add_argument(
+        "--profile_steps", type=int, default=10, help="Number of steps in the profiler trace"
+    )
     user = getpass.getuser()
     parser.add_argument("--dump_path", default=f"/checkpoint/{user}/dumped")
     parser.add_argument("--exp_name", default="debug_recover")
@@ -82,7 +105,7 @@ def get_parser():
     )
 
     # Training args
-    parser.add_argument("--epochs", type=int, default=120)
+    parser.add_argument("--epochs", type=int, default=120, help="Maximum number of epochs")
     parser.add_argument("--clip_grad_norm", type=float, default=5.0)
     parser.add_argument("--train_batch_size", type=int, default=256)
     parser.add_argument("--val_batch_size", type=int, default=512)
@@ -109,6 +132,18 @@ def get_parser():
     )
     parser.add_argument("--shuffle", type=bool_flag, default=True)
     parser.add_argument("--workers", type=int, default=8, help="CPU workers for data")
+    parser.add_argument(
+        "--feature_cache_path",
+        type=str,
+        default="",
+        help="Directory to cache the encoded training set in, reused across epochs and runs. Empty to disable.",
+    )
+    parser.add_argument(
+        "--feature_cache_dtype",
+        default="float16",
+        choices=["float16", "float32"],
+        help="Storage dtype of cached angular features (digit ids use the smallest int dtype)",
+    )
 
     # Slurm args
     parser.add_argument(
@@ -124,6 +159,12 @@ def get_parser():
         help="Debug multi-GPU / multi-node within a SLURM job",
     )
     parser.add_argument("--cpu", type=bool_flag, default=False, help="Run on CPU")
+    parser.add_argument(
+        "--cpu_threads", type=int, default=0, help="Intra-op threads of torch (0: torch default)"
+    )
+    parser.add_argument(
+        "--cpu_interop_threads", type=int, default=0, help="Inter-op threads of torch (0: torch default)"
+    )
 
     # Experiment args
     parser.add_argument("--max_samples", type=int, default=None)
@@ -150,6 +191,24 @@ def get_parser():
         default=128,
         help="Sample count for distinguishing. Must fit in one inference-only batch.",
     )
+    parser.add_argument(
+        "--recover_quantize",
+        type=bool_flag,
+        default=False,
+        help="Run secret recovery on an int8 dynamically quantized copy of the model (CPU only)",
+    )
+    parser.add_argument(
+        "--recover_quantize_check",
+        type=bool_flag,
+        default=True,
+        help="With --recover_quantize, log how the full-precision scores differ on the first recovery",
+    )
+    parser.add_argument(
+        "--recover_memory_budget",
+        type=int,
+        default=2048,
+        help="Memory (MB) for packing perturbed test matrices into recovery forward passes.",
+    )
     parser.add_argument(
         "--task",
         type=str,
@@ -167,9 +226,31 @@ def get_parser():
 
     return parser
 
+
+def dump_results(params, trainer, start_time):
+    """Writes results.json to the dump path: the outcome of the run and every recovery attempt."""
+    if not params.is_master:
+        return
+    recoveries = read_recovery_log(params.dump_path)
+    matched = [r for r in recoveries if r["matched"]]
+    results = {
+        "recovered": len(matched) > 0,
+        "recovery_epoch": matched[0]["epoch"] if matched else None,
+        "secret": matched[0]["secret"] if matched else None,
+        "epochs": trainer.epoch,
+        "steps": trainer.step,
+        "wall_time_s": time.time() - start_time,
+        "recoveries": recoveries,
+    }
+    with open(os.path.join(params.dump_path, "results.json"), "w") as fd:
+        json.dump(results, fd)
+
+
 def main(params):
     # initialize the multi-GPU / multi-node training
     # initialize experiment / SLURM signal handler for time limit / pre-emption
+    start_time = time.time()
+    set_cpu_threads(params.cpu_threads, params.cpu_interop_threads)
     init_distributed_mode(params)
     if params.is_slurm_job:
         init_signal_handler()
@@ -185,9 +266,10 @@ def main(params):
 
     if params.recover_only:
         recovered = secret_recovery.recover(trainer.epoch)
+        dump_results(params, trainer, start_time)
         sys.exit()
 
-    while not trainer.should_stop_training:
+    while not trainer.should_stop_training and trainer.epoch < params.epochs:
         logger.info("============ Starting epoch %i ... ============" % trainer.epoch)
         trainer.train()
         logger.info("============ End of epoch %i ============" % trainer.epoch)
@@ -198,6 +280,9 @@ def main(params):
             logger.warning("Quitting because over time limit.")
             break
 
+    trainer.close()
+    dump_results(params, trainer, start_time)
+
 
 if __name__ == "__main__":
     # generate parser / parse parameters
@@ -17,7 +17,8 @@ sys.path.append("./")
 
 from src import utils
 from src.slurm import init_signal_handler, init_distributed_mode
-from src.utils import initialize_exp, create_this_logger
+from src.utils import bool_flag, initialize_exp, create_this_logger
+from src.generate.checkpoint import read_results
 from usvp_benchmark import (
     BenchmarkUSVPInterleave,
     BenchmarkUSVPFlatter,
@@ -42,6 +43,12 @@ def get_parser():
     parser.add_argument(
         "--resume_path", type=str, default="", help="Path to load the checkpoints"
     )
+    parser.add_argument(
+        "--checkpoint_compress",
+        type=bool_flag,
+        default=False,
+        help="Save the worker matrix checkpoints as compressed .npz files",
+    )
     parser.add_argument("--exp_name", type=str, default="debug", help="Experiment name")
     parser.add_argument("--exp_id", type=str, default="", help="Experiment ID")
 
@@ -167,16 +174,27 @@ def get_parser():
     return parser
 
 
+def merge_results(params):
+    """
+    Merges the per-worker results_{thread}.jsonl logs into results.pkl:
+    {(expNum, hamming): [time, success, time, success, ...]}.
+    """
+    keys = []
+    for expNum in range(10):  # fixed 5 experiments per hamming weight for now
+        keys += [(expNum, params.hamming), (expNum, params.hamming - 1)]
+    results = dict([(key, []) for key in keys])
+    for result in read_results(params.dump_path):
+        key = (result["expNum"], result["hamming"])
+        results.setdefault(key, []).extend([result["time"], result["success"]])
+    path = os.path.join(params.dump_path, "results.pkl")
+    with open(path + ".tmp", "wb") as fd:
+        pickle.dump(results, fd)
+    os.replace(path + ".tmp", path)
+    return results
+
+
 def get_data_one_worker(i, params):
     logger = create_this_logger(params)
-    if not os.path.isfile(os.path.join(params.dump_path, "results.pkl")):
-        keys = []
-        for expNum in range(10):  # fixed 5 experiments per hamming weight for now
-            keys += [(expNum, params.hamming), (expNum, params.hamming - 1)]
-        pickle.dump(
-            dict([(key, []) for key in keys]),
-            open(os.path.join(params.dump_path, "results.pkl"), "wb"),
-        )
     if params.algo != params.algo2:
         sampleGen = BenchmarkUSVPInterleave(params, i, logger)
     else:
@@ -188,6 +206,7 @@ def get_data_one_worker(i, params):
     gen_more = True
     while gen_more:
         gen_more = sampleGen.generate()
+    sampleGen.checkpoint.flush()
 
 
 def main(params):
@@ -210,6 +229,8 @@ def main(params):
     Parallel(n_jobs=n_jobs)(
         delayed(get_data_one_worker)(n, params) for n in range(n_jobs)
     )
+    results = merge_results(params)
+    logger.info(f"Results: {results}")
 
 
 if __name__ == "__main__":
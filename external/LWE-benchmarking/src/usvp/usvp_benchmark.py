@@ -7,17 +7,17 @@ LICENSE file in the root directory of this source tree.
 """
 
 import os
-import pickle
 import numpy as np
 from time import time
 from fpylll import FPLLL, BKZ, GSO, IntegerMatrix
 from fpylll.algorithms.bkz2 import BKZReduction as BKZ2
 import sys
 sys.path.append("./")
-from src.generate.lllbkz import encode_intmat, decode_intmat, calc_std_usvp, usvp_params
-from subprocess import Popen, PIPE
-import io
+from src.generate.lllbkz import calc_std_usvp, usvp_params
+from src.generate.flatter_io import run_intmat_command
 from src.generate.genSamples import MAX_TIME_BKZ, FLOAT_UPGRADE
+from src.generate.records import RecordWriter, SHARD_EXT
+from src.generate.checkpoint import MatrixCheckpoint, ResultLog
 
 
 ### Runs USVP benchmark: define generic class and then subclasses based on setup.
@@ -52,11 +52,12 @@ class BenchmarkUSVP(object):
         self.s = (secrets[:, cols[self.expNum]]).reshape((self.N, 1))
         assert sum(self.s != 0) == self.hamming
 
-        self.results_path = os.path.join(params.dump_path, "results.pkl")
+        # Each worker logs its own results, merged into results.pkl at the end of the run.
+        self.results = ResultLog(os.path.join(params.dump_path, f"results_{thread}.jsonl"))
         self.matrix_filename = os.path.join(params.dump_path, f"matrix_{thread}.npy")
-        self.export_path_prefix = os.path.join(
-            params.dump_path, f"data_{thread}.prefix"
-        )
+        self.checkpoint = MatrixCheckpoint(self.matrix_filename, params.checkpoint_compress)
+        self.export_path = os.path.join(params.dump_path, f"data_{thread}{SHARD_EXT}")
+        self.writer = None
 
         self.seed = [params.global_rank, params.env_base_seed, thread]
         self.logger.info(
@@ -88,8 +89,8 @@ class BenchmarkUSVP(object):
             FPLLL.set_precision(int(precision))
 
     def get_secret_Ap(self):
-        if os.path.isfile(self.matrix_filename):
-            secret_Ap = np.load(self.matrix_filename)
+        secret_Ap = self.checkpoint.load()
+        if secret_Ap is not None:
             secret, Ap = secret_Ap[:1, : self.N], secret_Ap[:, self.N :]
             self.start = secret_Ap[-1, 0]
         else:
@@ -97,15 +98,11 @@ class BenchmarkUSVP(object):
         return secret, Ap
 
     def write(self, X, Y):
+        """Appends a record: the reduced basis X, indexed by the padded secret column Y."""
         assert X.shape[0] == Y.shape[0]
-        file_handler_prefix = io.open(
-            self.export_path_prefix, mode="a", encoding="utf-8"
-        )
-        for i in range(X.shape[0]):
-            prefix1_str = " ".join(X[i].astype(str))
-            prefix2_str = " ".join(Y[i].astype(str))
-            file_handler_prefix.write(f"{prefix1_str} ; {prefix2_str}\n")
-        file_handler_prefix.flush()
+        if self.writer is None:
+            self.writer = RecordWriter(self.export_path, Y.shape[0], X.shape[1])
+        self.writer.write(Y[:, 0], X)
 
     def save_mat(self, X, Y):
         """
@@ -119,7 +116,7 @@ class BenchmarkUSVP(object):
         mat_to_save[: len(X), : self.N] = X
         mat_to_save[-1, 0] = int(np.round(self.start))
         mat_to_save[:, self.N :] = Y
-        np.save(self.matrix_filename, mat_to_save)
+        self.checkpoint.save(mat_to_save)
 
     def check_for_upgrade(self, Ap, orig_std):
         # Run checks.
@@ -149,11 +146,12 @@ class BenchmarkUSVP(object):
         success = np.all(secret.flatten().astype(bool) == guessed_secret.astype(bool))
         if success:
             self.logger.info(f"Found secret for {self.matrix_filename}")
-            results = pickle.load(open(self.results_path, "rb"))
-            if type(results) != dict:
-                results = results.__dict__
-            results[(self.expNum, self.hamming)] += (time() - self.start, success)
-            pickle.dump(results, open(self.results_path, "wb"))
+            self.results.append(
+                expNum=int(self.expNum),
+                hamming=int(self.hamming),
+                time=time() - self.start,
+                success=bool(success),
+            )
             return True  # just end here, don't restart
         return False
 
@@ -198,19 +196,13 @@ class BenchmarkUSVPInterleave(BenchmarkUSVP):
         while True:
             ## Flatter first
             self.logger.info(f"Worker {self.thread} starting new flatter run.")
-            fplll_Ap = IntegerMatrix.from_matrix(Ap.tolist())
-            fplll_Ap_encoded = encode_intmat(fplll_Ap)
             try:
-                p = Popen(
-                    ["flatter", "-alpha", str(self.alpha)], stdin=PIPE, stdout=PIPE
-                )
-                out, _ = p.communicate(
-                    input=fplll_Ap_encoded
+                Ap = run_intmat_command(
+                    ["flatter", "-alpha", str(self.alpha)], Ap
                 )  # output from the flatter run.
             except Exception as e:
                 self.logger.info(f"flatter failed with error {e}")
                 return False
-            Ap = decode_intmat(out)
             self.check_for_upgrade(Ap, orig_std)
             if self.check_usvp_success(Ap, secret):
                 return False  # Attack succeeded, end the experiment
@@ -252,17 +244,13 @@ class BenchmarkUSVPFlatter(BenchmarkUSVP):
 
         # THIS VERSION RUNS FLATTER ONCE ON MATRIX
         self.logger.info(f"Worker {self.thread} starting new flatter run.")
-        fplll_Ap = IntegerMatrix.from_matrix(Ap.tolist())
-        fplll_Ap_encoded = encode_intmat(fplll_Ap)
         try:
-            p = Popen(["flatter", "-alpha", str(self.alpha)], stdin=PIPE, stdout=PIPE)
-            out, _ = p.communicate(
-                input=fplll_Ap_encoded
+            Ap = run_intmat_command(
+                ["flatter", "-alpha", str(self.alpha)], Ap
             )  # output from the flatter run.
         except Exception as e:
             self.logger.info(f"flatter failed with error {e}")
             return False
-        Ap = decode_intmat(out)
         self.check_for_upgrade(Ap, orig_std)
         if self.check_usvp_success(
             Ap, secret
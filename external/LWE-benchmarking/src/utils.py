@@ -22,6 +22,7 @@ import subprocess
 import numpy as np
 import errno
 import signal
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps, partial
 
 from tqdm import tqdm
@@ -210,48 +211,200 @@ class SimpleMovingAverage:
         return np.nanmean(self.history)
 
 
-# def mod_mult(mat1, mat2, Q, longtype=False):
-#     if not longtype:
-#         return (mat1 @ mat2) % Q
-#     mat1 = mat1.astype(np.longdouble)
-#     return ((mat1 // 10000) @ (mat2 * 10000 % Q) + (mat1 % 10000) @ mat2) % Q
+def _limb_plan(Q, m):
+    """
+    Limb width w and number of limbs so that a length-m dot product of w-bit limbs
+    stays below 2^53, i.e. is computed exactly by a float64 (BLAS) matmul.
+    """
+    q_bits = max((Q - 1).bit_length(), 1)
+    w = q_bits
+    while m * (2**w - 1) ** 2 >= 2**53:
+        w -= 1
+    assert w > 0, f"dot products of length {m} are too long"
+    return w, -(-q_bits // w)
 
-def mod_mult(mat1, mat2, Q):
-    if np.log2(Q) <= 30:
-        return np.tensordot(mat1, mat2, 1) % Q
 
-    # Use 128-bit floats and scale the matrix slightly
-    frac = 10_000
-    mat1 = mat1.astype(np.float128)
-    out = np.tensordot((mat1 // frac), (mat2 * frac % Q), 1) 
-    out += np.tensordot((mat1 % frac), mat2, 1)
-    out %= Q
-    return out.astype(np.int64)
+def _mod_shift(x, bits, Q):
+    """x * 2^bits % Q for x in [0, Q), shifting by as much as int64 allows at a time."""
+    step = 63 - (Q - 1).bit_length()
+    while bits > 0:
+        x = (x << min(step, bits)) % Q
+        bits -= step
+    return x
 
 
-def mod_mult_torch(mat1, mat2, Q):
-    import torch
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    mat1 = torch.from_numpy(mat1).double().to(device)
-    mat2 = torch.from_numpy(mat2).double().to(device)
-    if np.log2(Q) <= 30:
-        out = torch.tensordot(mat1, mat2, dims=1) % Q
-    
+def _mod_matmul(X, Y, Q):
+    """
+    Exact (X @ Y) % Q for int64 X (..., r, m) and Y (..., m, n) with np.matmul
+    broadcasting. Both are split into w-bit limbs, every limb product is an exact
+    float64 matmul, and the products are recombined mod Q in int64.
+    """
+    X, Y = X % Q, Y % Q
+    w, n_limbs = _limb_plan(Q, X.shape[-1])
+    if n_limbs == 1:
+        return np.matmul(X.astype(np.float64), Y.astype(np.float64)).astype(np.int64) % Q
+
+    mask = (1 << w) - 1
+    n = Y.shape[-1]
+    # All limbs of Y side by side, so each limb of X needs a single matmul.
+    Y_limbs = np.concatenate(
+        [((Y >> (w * j)) & mask).astype(np.float64) for j in range(n_limbs)], axis=-1
+    )
+    # sums[d]: sum over i + j = d of X_i @ Y_j, the coefficient of 2^(w * d).
+    sums = [0] * (2 * n_limbs - 1)
+    for i in range(n_limbs):
+        X_i = ((X >> (w * i)) & mask).astype(np.float64)
+        P = np.matmul(X_i, Y_limbs).astype(np.int64)
+        for j in range(n_limbs):
+            sums[i + j] = sums[i + j] + P[..., j * n : (j + 1) * n]
+
+    out = sums[-1] % Q
+    for d in range(len(sums) - 2, -1, -1):
+        out = (_mod_shift(out, w, Q) + sums[d] % Q) % Q
+    return out
+
+
+def mod_mult(mat1, mat2, Q):
+    """
+    Exact tensordot(mat1, mat2, 1) % Q as int64, for integer matrices and any Q up
+    to 2^62. mat1 is (r, m), mat2 is (m, ...).
+    """
+    assert Q <= 2**62, f"Q = {Q} is too large for exact int64 arithmetic"
+    mat1 = np.asarray(mat1, dtype=np.int64)
+    mat2 = np.asarray(mat2, dtype=np.int64)
+    out = _mod_matmul(mat1, mat2.reshape(len(mat2), -1), Q)
+    return out.reshape(mat1.shape[:-1] + mat2.shape[1:])
+
+
+def mod_mult_batched(Rs, A, idxs, Q, n_threads=None, chunk_size=64, executor=None):
+    """
+    Exact (Rs[i] @ A[idxs[i]]) % Q for a batch of R matrices multiplied with rows
+    gathered from A, e.g. reduction matrices against the rows of the original A
+    they were computed from. Rs is a (k, r, m) array, returning a (k, r, ...)
+    array, or a list of (r_i, m) matrices, returning a list. Chunks of chunk_size
+    matrices run on executor, or on a pool of at most n_threads threads (default:
+    one per core) and one per chunk. Callers multiplying many batches should pass
+    one executor rather than start a pool per call.
+    """
+    assert Q <= 2**62, f"Q = {Q} is too large for exact int64 arithmetic"
+    A = np.asarray(A, dtype=np.int64)
+    tail = A.shape[1:]
+    A = A.reshape(len(A), -1) % Q
+    stacked = isinstance(Rs, np.ndarray)
+
+    def run(start):
+        stop = min(start + chunk_size, len(Rs))
+        if stacked:
+            chunk_idxs = np.asarray(idxs[start:stop])
+            return [_mod_matmul(Rs[start:stop].astype(np.int64), A[chunk_idxs], Q)]
+        return [
+            _mod_matmul(np.asarray(Rs[i], dtype=np.int64), A[np.asarray(idxs[i])], Q)
+            for i in range(start, stop)
+        ]
+
+    starts = range(0, len(Rs), chunk_size)
+    if executor is not None:
+        outs = [out for chunk in executor.map(run, starts) for out in chunk]
+    elif len(starts) <= 1:
+        outs = [out for start in starts for out in run(start)]
     else:
-        # Use 64-bit floats and scale the matrix slightly
-        frac = 10_000
-        out = torch.tensordot((mat1 // frac), (mat2 * frac % Q), dims=1)
-        out += torch.tensordot((mat1 % frac), mat2, dims=1)
-        out %= Q
-    return out.to(torch.int64).cpu().numpy()
+        with ThreadPoolExecutor(max_workers=min(len(starts), n_threads or os.cpu_count())) as pool:
+            outs = [out for chunk in pool.map(run, starts) for out in chunk]
+    if stacked:
+        if not outs:
+            return np.zeros(Rs.shape[:2] + tail, dtype=np.int64)
+        return np.concatenate(outs).reshape(Rs.shape[:2] + tail)
+    return [out.reshape(out.shape[:1] + tail) for out in outs]
 
 
-def mod_diff(base_pred, mod_pred, Q):
+class SecretVerifier:
+    """
+    Checks secret guesses against LWE samples (A, b): a guess s matches when the
+    errors A @ s - b, centered mod Q, have std < 2 * sigma. Guesses are checked in
+    batches with one matmul per chunk of candidates; the products are exact for
+    any Q (float64 while they fit 53 bits, then int64, then Python ints).
+    """
+
+    def __init__(self, A, b, Q, sigma, chunk_size=1024):
+        self.Q = int(Q)
+        self.sigma = sigma
+        self.chunk_size = chunk_size
+        self.A = self._as_int(A).reshape(-1, np.shape(A)[-1]) % self.Q
+        self.A[self.A > self.Q // 2] -= self.Q
+        self.b = self._as_int(b).reshape(-1) % self.Q
+
+    @staticmethod
+    def _as_int(x):
+        if hasattr(x, "numpy"):
+            x = x.detach().cpu().numpy()
+        x = np.asarray(x)
+        if x.dtype == object:
+            return x
+        if x.dtype.kind == "f":
+            x = np.rint(x)
+        return x.astype(np.int64)
+
+    def _mod_errors(self, guesses):
+        bound = (self.Q // 2 + 1) * int(np.abs(guesses).max(initial=0)) * self.A.shape[1]
+        if bound < 2**53 and self.A.dtype != object:
+            err = self.A.astype(np.float64) @ guesses.T.astype(np.float64)
+            err = err.astype(np.int64) - self.b[:, None]
+        elif bound + self.Q < 2**63 and self.A.dtype != object:
+            err = self.A @ guesses.T - self.b[:, None]
+        else:
+            err = self.A.astype(object) @ guesses.T.astype(object) - self.b[:, None]
+        err %= self.Q
+        err[err > self.Q // 2] -= self.Q
+        return err.astype(np.float64)
+
+    def __call__(self, guesses, stop_at_first=False):
+        """
+        guesses: (K, N) array or tensor, or a single (N,) guess. Returns a (K,) bool
+        array of matches. With stop_at_first, chunks after the first match are skipped
+        and reported as False.
+        """
+        guesses = self._as_int(guesses)
+        guesses = guesses.reshape(-1, guesses.shape[-1])
+        matches = np.zeros(len(guesses), dtype=bool)
+        for start in range(0, len(guesses), self.chunk_size):
+            err = self._mod_errors(guesses[start : start + self.chunk_size])
+            matches[start : start + len(err.T)] = err.std(axis=0) < 2 * self.sigma
+            if stop_at_first and matches.any():
+                break
+        return matches
+
+    def first_match(self, guesses):
+        """Index of the first matching guess, or None."""
+        hits = np.flatnonzero(self(guesses, stop_at_first=True))
+        return hits[0] if len(hits) else None
+
+
+def mod_diff(base_pred, mod_pred, Q, dim=None):
+    """
+    Sum of centered modular distances between two predictions. With dim set,
+    only that dimension is reduced, so whole batches can be compared at once.
+    """
     import torch
     assert base_pred.shape == mod_pred.shape
     diff = torch.abs(base_pred - mod_pred)
     diff = torch.minimum(diff, Q - diff)
-    return diff.sum().cpu()
+    if dim is None:
+        return diff.sum().cpu()
+    return diff.sum(dim).cpu()
+
+
+def pairwise_mod_diff(preds, Q, chunk_size=64):
+    """
+    preds: (N, M) tensor. Returns the (N, N) matrix of mod_diff(preds[i], preds[j]),
+    computed chunk_size rows at a time to bound the (chunk_size, N, M) intermediate.
+    """
+    import torch
+    out = []
+    for start in range(0, len(preds), chunk_size):
+        rows = preds[start : start + chunk_size].unsqueeze(1)
+        rows, cols = torch.broadcast_tensors(rows, preds.unsqueeze(0))
+        out.append(mod_diff(rows, cols, Q, dim=-1))
+    return torch.cat(out)
 
 
 # Encode various things in this project to JSON
@@ -330,6 +483,40 @@ def shift_negate(tnsor):
     return np.concatenate((tnsor[..., 1:], -tnsor[..., :1]), axis=-1)
 
 
+def narrowest_int_dtype(Q):
+    """Smallest signed integer dtype holding residues mod Q and their negations."""
+    for dtype in (np.int8, np.int16, np.int32):
+        if Q - 1 <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def truncate_npy(path, n_rows):
+    """Shrinks a C-ordered .npy file to its first n_rows in place, rewriting the header."""
+    with open(path, "r+b") as fd:
+        version = np.lib.format.read_magic(fd)
+        header_start = fd.tell() + (2 if version == (1, 0) else 4)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fd)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fd)
+        assert not fortran_order and n_rows <= shape[0], (path, shape, n_rows)
+        data_start = fd.tell()
+
+        # A shorter shape never needs more room, so the header keeps its length.
+        header = repr(
+            {
+                "descr": np.lib.format.dtype_to_descr(dtype),
+                "fortran_order": False,
+                "shape": (n_rows,) + tuple(shape[1:]),
+            }
+        )
+        fd.seek(header_start)
+        fd.write((header.ljust(data_start - header_start - 1) + "\n").encode("latin1"))
+        row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize
+        fd.truncate(data_start + n_rows * row_bytes)
+
+
 def read(data_prefix_path, m):
     with open(data_prefix_path) as fd:
         A, RT = [], []
@@ -0,0 +1,84 @@
+""""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from src.salsa.train.envs.datasets import ContiguousBatchSampler, LWEDataset
+from src.salsa.train.envs.lattice import AngularEncoder
+from src.salsa.train.perf import PhaseTimer
+
+
+def angular_dataset(n_samples, N, Q):
+    """An LWEDataset on random samples, without loading files."""
+    rng = np.random.default_rng(0)
+    dataset = LWEDataset.__new__(LWEDataset)
+    dataset.params = SimpleNamespace(Q=Q, angular_emb=True)
+    dataset.io_encoder = AngularEncoder(dataset.params)
+    dataset.timer = PhaseTimer()
+    dataset.A = rng.integers(0, Q, (n_samples, N))
+    dataset.b = rng.integers(0, Q, (n_samples, 1))
+    dataset.A_features, dataset.b_features = None, None
+    return dataset
+
+
+def test_angular_epoch_has_no_batch_of_one():
+    n_samples, N, Q, batch_size = 500, 10, 3329, 32
+    dataset = angular_dataset(n_samples, N, Q)
+    for seed in range(50):
+        for epoch in range(4):
+            sampler = ContiguousBatchSampler(n_samples, batch_size, shuffle=True, seed=seed, epoch=epoch)
+            seen = np.zeros(n_samples, dtype=int)
+            for batch in sampler:
+                A, b = dataset.collate_fn(dataset[batch])
+                size = batch.stop - batch.start
+                assert size > 1
+                assert A.shape == (size, N, 2) and b.shape == (size, 2)
+                seen[batch] += 1
+            assert (seen == 1).all()
+
+
+def dataset_on_disk(tmp_path, angular, n_samples=100, N=10, Q=3329, seed=0):
+    """An LWEDataset read from train/test/orig files written under tmp_path, with a feature cache."""
+    rng = np.random.default_rng(seed)
+    data_path = tmp_path / "data" / "secret"
+    data_path.mkdir(parents=True, exist_ok=True)
+    for split in ("train", "test", "orig"):
+        np.save(tmp_path / "data" / f"{split}_A.npy", rng.integers(0, Q, (n_samples, N)))
+        np.save(data_path / f"{split}_b_3_0.npy", rng.integers(0, Q, n_samples))
+    params = SimpleNamespace(
+        data_path=str(data_path), hamming=3, secret_seed=0, Q=Q, N=N, angular_emb=angular,
+        base=81, bucket_size=1, distinguisher_size=16, max_samples=0, recover_only=False,
+        feature_cache_path=str(tmp_path / "cache"), feature_cache_dtype="float32",
+    )
+    return LWEDataset(params)
+
+
+def test_feature_cache_matches_live_encoding(tmp_path):
+    for angular in (True, False):
+        dataset = dataset_on_disk(tmp_path / str(angular), angular)
+        assert dataset.A_features is not None
+        cached = dataset.collate_fn(dataset[10:42])
+        dataset.A_features, dataset.b_features = None, None
+        live = dataset.collate_fn(dataset[10:42])
+        for x, y in zip(cached, live):
+            assert x.dtype == y.dtype and x.shape == y.shape
+            assert torch.equal(x, y)
+
+
+def test_feature_cache_follows_regenerated_data(tmp_path):
+    dataset = dataset_on_disk(tmp_path, True, seed=0)
+    first = dataset.feature_cache_key(dataset.params)
+    # Same shapes, new samples: the cache of the old files must not be reused.
+    dataset = dataset_on_disk(tmp_path, True, seed=1)
+    assert dataset.feature_cache_key(dataset.params) != first
+    cached = dataset.collate_fn(dataset[:32])
+    dataset.A_features, dataset.b_features = None, None
+    assert all(torch.equal(x, y) for x, y in zip(cached, dataset.collate_fn(dataset[:32])))
@@ -0,0 +1,78 @@
+""""
+Copyright (c) Meta Platforms, Inc. and affiliates.
+All rights reserved.
+
+This source code is licensed under the license found in the
+LICENSE file in the root directory of this source tree.
+"""
+
+import contextlib
+from types import SimpleNamespace
+
+import torch
+
+from src.salsa.train.perf import PhaseTimer, ProfilerWindow
+from src.salsa.train.trainer import Trainer
+
+
+class StubRecovery(object):
+    """Stands in for AsyncSecretRecovery: the first poll after submit_to_match submits reports a match, once."""
+
+    def __init__(self, submit_to_match):
+        self.submit_to_match = submit_to_match
+        self.n_submitted = 0
+        self.pending = False
+
+    def submit(self, step, epoch, model):
+        self.n_submitted += 1
+        self.pending = self.pending or self.n_submitted == self.submit_to_match
+
+    def poll(self):
+        recovered, self.pending = self.pending, False
+        return recovered
+
+    def close(self, wait=False):
+        return self.poll()
+
+
+def stub_trainer(recovery, n_batches=4):
+    """A Trainer on a parameter-free model, without dataset files or checkpoints."""
+    trainer = Trainer.__new__(Trainer)
+    trainer.params = SimpleNamespace(device=torch.device("cpu"), check_secret_every=1, save_periodic=0)
+    batches = [(torch.zeros(2, 3), torch.zeros(2, 3)) for _ in range(n_batches)]
+    trainer.dataset = SimpleNamespace(build_train_dataloader=lambda epoch: batches)
+    trainer.model = trainer.uncompiled_model = torch.nn.Identity()
+    trainer.loss_fn = torch.nn.MSELoss()
+    trainer.train_metrics = lambda logits, b: None
+    trainer.amp_ctx = contextlib.nullcontext()
+    trainer.optimize = lambda loss: 0.0
+    trainer.iter = lambda batch_num, loss, grad: None
+    trainer.save_checkpoint = lambda name="checkpoint": None
+    trainer.timer = PhaseTimer()
+    trainer.profiler = ProfilerWindow(-1, 0, None)
+    trainer.secret_recovery = None
+    trainer.async_recovery = recovery
+    trainer.epoch, trainer.step, trainer.interval_examples = 0, 0, 0
+    trainer.should_stop_training = False
+    return trainer
+
+
+def test_match_during_epoch_stops_training():
+    recovery = StubRecovery(submit_to_match=2)
+    trainer = stub_trainer(recovery)
+    trainer.train()
+    assert trainer.should_stop_training and trainer.step == 2
+    trainer.end_epoch()
+    assert trainer.should_stop_training
+    assert recovery.n_submitted == 2  # no end-of-epoch snapshot once stopped
+    trainer.close()
+    assert trainer.should_stop_training
+
+
+def test_match_at_end_of_epoch_stops_training():
+    recovery = StubRecovery(submit_to_match=5)
+    trainer = stub_trainer(recovery)
+    trainer.train()
+    assert not trainer.should_stop_training and trainer.step == 4
+    trainer.end_epoch()
+    assert trainer.should_stop_training and recovery.n_submitted == 5
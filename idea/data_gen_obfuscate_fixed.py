@@ -1,7 +1,6 @@
 # 데이터 생성
 import numpy as np
-from scipy.signal import fftconvolve
-import os, json, csv
+import os, json, csv, argparse
 from tqdm import tqdm
 from pathlib import Path
 
@@ -21,23 +20,82 @@ def circular_wrap(conv_result, n, q): # 원형으로 래핑
     b = conv_result[n:2*n] if conv_result.shape[0] >= 2*n else np.zeros(n, dtype=np.int64) #컨볼루션 결과의 n번째 부터 2n번째 원소까지 추출, 만약 길이가 2n보다 작으면 0으로 채워진 길이 n짜리 배열 생성
     return (a + b) % q  # a와 b를 원소별로 더한 후 q로 나눈 나머지를 반환
 
+# NTT용 소수 (p = c * 2^k + 1 < 2^31, 원시근 g): 곱이 2^62 미만이라 int64로 정확히 계산됨
+NTT_PRIMES = [(2013265921, 31), (469762049, 3), (754974721, 11), (998244353, 3)]
+
+def _ntt(a, p, g, invert=False): # (K, L) 배열의 각 행을 mod p로 NTT, L은 2의 거듭제곱
+    K, L = a.shape
+    bits = L.bit_length() - 1
+    rev = np.zeros(L, dtype=np.int64) # 비트 역순 인덱스
+    for i in range(bits):
+        rev |= ((np.arange(L) >> i) & 1) << (bits - 1 - i)
+    a = a[:, rev] % p
+    length = 2
+    while length <= L: # 길이 2, 4, ..., L 블록 단위 나비 연산을 모든 행에 한 번에 수행
+        half = length // 2
+        w = pow(g, (p - 1) // length, p)
+        if invert:
+            w = pow(w, p - 2, p)
+        ws = np.ones(1, dtype=np.int64) # w^0 ... w^(half-1)
+        while len(ws) < half:
+            ws = np.concatenate([ws, ws * pow(w, len(ws), p) % p])
+        a = a.reshape(K, L // length, 2, half)
+        u, v = a[:, :, 0], a[:, :, 1] * ws % p
+        a = np.stack([(u + v) % p, (u - v) % p], axis=2).reshape(K, L)
+        length *= 2
+    if invert:
+        a = a * pow(L, p - 2, p) % p
+    return a
+
+def polymul_trunc(a, b, q): # (K, n) 다항식들의 곱을 정확히 계산 (mod q, 차수 n 이상 버림)
+    # circular_wrap과 같은 결과: full 컨볼루션 길이가 2n-1이라 conv_result[n:2*n]은 항상 0으로 대체됨
+    assert q < 2**31, q
+    a, b = np.atleast_2d(a) % q, np.atleast_2d(b) % q
+    n = a.shape[1]
+    L = 1 << (2 * n - 2).bit_length() # 선형 컨볼루션이 들어가는 2의 거듭제곱 길이
+    bound = n * (q - 1) ** 2 # 컨볼루션 계수의 최댓값, 소수들의 곱이 이보다 커야 CRT가 정확함
+    primes, prod = [], 1
+    for p, g in NTT_PRIMES:
+        if prod > bound:
+            break
+        primes.append((p, g)); prod *= p
+    assert prod > bound, f'n={n}, q={q}: need more NTT primes'
+    assert L <= 1 << 23, f'n={n} too large for the NTT primes'
+    pad = lambda x: np.pad(x, ((0, 0), (0, L - n)))
+    # 각 소수에서 컨볼루션 후 Garner 알고리즘으로 mod q 값을 복원
+    ys, out, scale = [], 0, 1
+    for p, g in primes:
+        r = _ntt(_ntt(pad(a), p, g) * _ntt(pad(b), p, g) % p, p, g, invert=True)[:, :n]
+        for (pj, _), yj in zip(primes, ys):
+            r = (r - yj) % p * pow(pj, p - 2, p) % p
+        ys.append(r)
+        out = (out + r % q * scale) % q
+        scale = scale * p % q
+    return out
+
+def polypow_trunc(S, d, q): # S^d을 반복 제곱으로 계산 (곱셈 O(log d)번)
+    result, base = None, S % q
+    while d > 0:
+        if d & 1:
+            result = base if result is None else polymul_trunc(result, base, q)
+        d >>= 1
+        if d:
+            base = polymul_trunc(base, base, q)
+    return result
+
+def obfuscate_maclaurin_batch(S, q, degrees, coeffs): # (K, n) 비밀키 K개를 한 번에 obfuscation
+    S = np.atleast_2d(S).astype(np.int64)
+    s_prime = np.zeros_like(S)
+    for d in degrees:
+        s_prime = (s_prime + coeffs[d] * polypow_trunc(S, d, q)) % q # 계수를 곱한 항을 누적하여 s' 계산
+    return s_prime
+
 def obfuscate_maclaurin(s, q, degrees=[1,3,5], coeffs=None, coeff_choices=[-1,1]): # 원본 비밀키, 모듈로 연산 10나누기 2가 2보다 커질 수 없으니까 이 원리, 
-    n = len(s) # 비밀키의 길이를 n에 저장
     rng = np.random.RandomState(0) #reg 변수를 랜덤시드 0으로 고정
     if coeffs is None: # 계수가 주어지지 않을 경우
         coeffs = {d: int(rng.choice(coeff_choices)) for d in degrees} # -1 1 중에 랜덤 시드가 적용된걸로 적용
-    s = s.astype(np.int64) # s를 int64 타입으로 변환
-    s_prime = np.zeros(n, dtype=np.int64) # s'은 0으로 채워진 길이 n짜리 배열 생성, 누적 계산을 위함, 
-    for d in degrees: # 각 차수에 대해
-        if d == 1: # 1차항일 경우
-            term = s.copy() # 원본 비밀키 복사
-        else: # 2차항 이상일 경우
-            term = s.copy() # 원본 비밀키 복사
-            for _ in range(d-1): # 차수-1 만큼 반복
-                conv = fftconvolve(term, s, mode='full').astype(np.int64) #푸리에 변환을 이용한 컨볼루션 연산
-                term = circular_wrap(conv, n, 842779) # 원형 래핑을 통해 길이 n로 조정
-        s_prime = (s_prime + coeffs[d] * term) % 842779 # 계수를 곱한 항을 누적하여 s' 계산
-    return s_prime % 842779, coeffs # 최종 obfuscated 비밀키와 사용된 계수 반환
+    s_prime = obfuscate_maclaurin_batch(s, q, degrees, coeffs)[0] # s^d를 정확한 정수 연산(NTT)으로 계산
+    return s_prime, coeffs # 최종 obfuscated 비밀키와 사용된 계수 반환
 
 def gen_lwe_samples(n, q, m, sigma, s, seed=None): #lwe 샘플 생성
     rng = np.random.RandomState(seed) #난수생성기
@@ -46,13 +104,44 @@ def gen_lwe_samples(n, q, m, sigma, s, seed=None): #lwe 샘플 생성
     b = (A.dot(s) + e) % q #벡터 내적
     return A, b, e #행렬 A와 비밀키 s의 내적에 잡음 e를 더한 후 q로 나눈 나머지 반환
 
+def matmul_mod(A, S, q): # (A @ S) % q를 int64 오버플로 없이 계산
+    if A.shape[1] * (q - 1) * int(np.abs(S).max(initial=0)) < 2**63:
+        return (A @ S) % q
+    lo, hi = A & 0xFFFF, A >> 16 # A를 16비트씩 나눠 곱이 2^63을 넘지 않게 함
+    S = S % q
+    return ((hi @ S) % q * (2**16 % q) + (lo @ S) % q) % q
+
+def gen_lwe_samples_stream(outdir, n, q, m, sigma, S, seed=None, chunk_rows=65536): # 같은 A를 공유하는 비밀키 여러 개의 LWE 샘플을 파일로 스트리밍
+    # A.npy (m, n), b.npy / e.npy (m, K)를 chunk_rows 행씩 메모리 맵 파일에 씀 (S가 1차원이면 (m,))
+    # 비밀키 하나일 때 gen_lwe_samples와 같은 난수열: A를 먼저 전부 뽑고, 그 다음 e를 뽑음
+    outdir = Path(outdir); outdir.mkdir(parents=True, exist_ok=True)
+    S = np.asarray(S, dtype=np.int64)
+    shape = (m,) if S.ndim == 1 else (m, S.shape[0])
+    S_T = S.reshape(-1, n).T # (n, K)
+    rng = np.random.RandomState(seed) #난수생성기
+    A = np.lib.format.open_memmap(outdir / 'A.npy', 'w+', np.int64, (m, n))
+    for start in range(0, m, chunk_rows):
+        stop = min(start + chunk_rows, m)
+        A[start:stop] = rng.randint(low=0, high=q, size=(stop - start, n), dtype=np.int64)
+    A.flush()
+    b = np.lib.format.open_memmap(outdir / 'b.npy', 'w+', np.int64, shape)
+    e = np.lib.format.open_memmap(outdir / 'e.npy', 'w+', np.int64, shape)
+    for start in range(0, m, chunk_rows):
+        stop = min(start + chunk_rows, m)
+        e_chunk = np.round(rng.normal(loc=0.0, scale=sigma, size=(stop - start, S_T.shape[1]))).astype(np.int64) % q
+        b[start:stop] = ((matmul_mod(np.asarray(A[start:stop]), S_T, q) + e_chunk) % q).reshape(b[start:stop].shape)
+        e[start:stop] = e_chunk.reshape(e[start:stop].shape)
+    b.flush(); e.flush()
+    del A, b, e
+    return [np.load(outdir / f, mmap_mode='r') for f in ('A.npy', 'b.npy', 'e.npy')]
+
 def save_npy(obj, path):
     Path(path).parent.mkdir(parents=True, exist_ok=True)
     np.save(path, obj)
 
 def write_csv(rows, path):
     Path(path).parent.mkdir(parents=True, exist_ok=True)
-    header = sorted(rows[0].keys())
+    header = sorted(set().union(*rows)) # idea 행에만 있는 degrees/coeffs 포함
     import csv
     with open(path, 'w', newline='') as f:
         writer = csv.DictWriter(f, fieldnames=header)
@@ -60,31 +149,40 @@ def write_csv(rows, path):
         for r in rows:
             writer.writerow(r)
 
-def main():
-    cfg = json.load(open('configs/light_params.json')) #데이터셋 파라미터 불러오기
+def main(args):
+    cfg = json.load(open(args.config)) #데이터셋 파라미터 불러오기
     rows = [] #생성된 데이터셋 정보를 저장할 리스트
-    print('Generating precomputed datasets (n=10 and n=30)...') #데이터셋 생성 시작
+    print('Generating precomputed datasets...') #데이터셋 생성 시작
     for ds in tqdm(cfg['datasets'], desc='datasets'): #각 데이터셋 파라미터에 대해 반복
         name = ds['name'] #데이터셋 이름
         n = ds['n']; q = ds['q']; m = ds['m']; sigma = ds['sigma']; hamming = ds['hamming']; seed = ds['seed'] #각 파라미터 추출
-        s = sample_secret(n, hamming=hamming, seed=seed) #비밀키 생성
-        A,b,e = gen_lwe_samples(n,q,m,sigma,s,seed=seed+1) #LWE 샘플 생성 함수 참고
-        outdir = OUT / f'baseline_{name}' #기본 데이터셋 저장 경로 설정
-        outdir.mkdir(parents=True, exist_ok=True) #디렉토리 생성
-        save_npy(A, outdir / 'A.npy'); save_npy(b, outdir / 'b.npy'); save_npy(e, outdir / 'e.npy') #행렬 A, 벡터 b, 잡음 e 저장
-        json.dump({'s': s.tolist(), 'params': ds}, open(outdir / 'meta.json','w'), indent=2) #메타데이터 저장
+        num_secrets = ds.get('num_secrets', 1) # 같은 A를 공유하는 비밀키 개수, 1이면 기존 형식 (b.npy가 (m,))
+        S = np.stack([sample_secret(n, hamming=hamming, seed=seed + k) for k in range(num_secrets)]) #비밀키 생성, k번째 비밀키는 seed+k
+        secrets = S[0] if num_secrets == 1 else S
+        outdir = OUT / f'baseline_{name}' #기본 데이터셋 저장 경로
+        gen_lwe_samples_stream(outdir, n, q, m, sigma, secrets, seed=seed+1, chunk_rows=args.chunk_rows) #A, b, e를 파일로 스트리밍
+        meta = {'s': S[0].tolist(), 'params': ds}
+        if num_secrets > 1:
+            meta['secrets'] = S.tolist() # b.npy의 k번째 열이 secrets[k]
+        json.dump(meta, open(outdir / 'meta.json','w'), indent=2) #메타데이터 저장
         rows.append({'type':'baseline','name':name,'n':n,'m':m,'path':str(outdir)}) #생성된 데이터셋 정보 기록
 
-        s_prime, coeffs = obfuscate_maclaurin(s, q, degrees=cfg['idea_params']['degrees'], coeff_choices=cfg['idea_params']['coeff_choices']) #obfuscation 함수 참고
-        A2,b2,e2 = gen_lwe_samples(n,q,m,sigma,s_prime,seed=seed+2) #obfuscated 비밀키로 LWE 샘플 생성
-        outdir2 = OUT / f'idea_{name}' #obfuscated 데이터셋 저장 경로 설정
-        outdir2.mkdir(parents=True, exist_ok=True) #디렉토리 생성
-        save_npy(A2, outdir2 / 'A.npy'); save_npy(b2, outdir2 / 'b.npy'); save_npy(e2, outdir2 / 'e.npy') #행렬 A, 벡터 b, 잡음 e 저장
-        json.dump({'s': s.tolist(), 's_prime': s_prime.tolist(), 'coeffs': coeffs, 'params': ds}, open(outdir2 / 'meta.json','w'), indent=2) #메타데이터 저장 
+        _, coeffs = obfuscate_maclaurin(S[0], q, degrees=cfg['idea_params']['degrees'], coeff_choices=cfg['idea_params']['coeff_choices']) #계수 선택 (모든 비밀키에 같은 계수)
+        S_prime = obfuscate_maclaurin_batch(S, q, cfg['idea_params']['degrees'], coeffs) #비밀키 전부를 한 번에 obfuscation
+        secrets_prime = S_prime[0] if num_secrets == 1 else S_prime
+        outdir2 = OUT / f'idea_{name}' #obfuscated 데이터셋 저장 경로
+        gen_lwe_samples_stream(outdir2, n, q, m, sigma, secrets_prime, seed=seed+2, chunk_rows=args.chunk_rows) #obfuscated 비밀키로 LWE 샘플 생성
+        meta = {'s': S[0].tolist(), 's_prime': S_prime[0].tolist(), 'coeffs': coeffs, 'params': ds}
+        if num_secrets > 1:
+            meta['secrets'] = S.tolist(); meta['secrets_prime'] = S_prime.tolist()
+        json.dump(meta, open(outdir2 / 'meta.json','w'), indent=2) #메타데이터 저장
         rows.append({'type':'idea','name':name,'n':n,'m':m,'degrees':str(cfg['idea_params']['degrees']),'coeffs':str(coeffs),'path':str(outdir2)}) #생성된 데이터셋 정보 기록
 
     write_csv(rows, OUT / 'generated_datasets_params.csv')
     print('Saved precomputed datasets in', OUT)
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Generate baseline/idea LWE datasets')
+    parser.add_argument('--config', type=str, default='configs/light_params.json', help='datasets (n, q, m, sigma, hamming, seed, num_secrets) and idea_params')
+    parser.add_argument('--chunk_rows', type=int, default=65536, help='rows of A generated and written at a time')
+    main(parser.parse_args())
@@ -1,84 +1,185 @@
-import os, subprocess, json, re, time
+"""
+Runs SALSA (external/LWE-benchmarking) on the precomputed datasets.
+
+Every (dataset folder, secret seed, model config) job is a train_and_recover.py
+subprocess; --slots jobs run at once. A job whose inputs did not change since
+it last ran is not run again: its result is cached under a key built from the
+hashes of the data files it reads and from its parameters (--force reruns it).
+Results are read from the results.json / recovery.jsonl written by the training
+run, not parsed from its output.
+
+python3 idea/run_salsa_connected.py --slots 4 --seeds 0,1 --configs small
+"""
+import argparse, hashlib, json, os, shutil, subprocess, sys, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from tqdm import tqdm
-from src.utils import ensure_dir, save_json
+from utils import ensure_dir, save_json, load_json
+
 ROOT = Path(__file__).resolve().parents[1]
 EXTERNAL = ROOT / 'external' / 'LWE-benchmarking'   # must clone here
+EXTERNAL_TRAIN_SCRIPT = EXTERNAL / 'src' / 'salsa' / 'train_and_recover.py'
+PRECOMPUTED = ROOT / 'data' / 'precomputed'
 RESULTS = ROOT / 'results' / 'salsa_runs'
-ensure_dir(str(RESULTS))
-
-# Update this path if the external repo layout differs
-EXTERNAL_TRAIN_SCRIPT = EXTERNAL / 'src' / 'salsa' / 'train_and_recover.py' 
-# fallback path based on README example
-if not EXTERNAL_TRAIN_SCRIPT.exists():
-    EXTERNAL_TRAIN_SCRIPT = EXTERNAL / 'src' / 'salsa' / 'train_and_recover.py'
-
-if not EXTERNAL_TRAIN_SCRIPT.exists():
-    print('ERROR: Could not find train_and_recover.py in external/LWE-benchmarking repo. Please clone the repo and check path.')
-    print('Expected at:', EXTERNAL_TRAIN_SCRIPT)
-    raise SystemExit(1)
-
-# dataset configs (hardcoded)
-datasets = [
-    {'name': 'n10', 'n': 10, 'q': 842779, 'm': 500, 'sigma': 3.0, 'hamming': 3, 'seed': 111},
-    {'name': 'n30', 'n': 30, 'q': 842779, 'm': 2000, 'sigma': 3.0, 'hamming': 3, 'seed': 222}
-]
-
-def build_cmd(data_path, exp_name, seed):
-    flags = {}
-    cmd = ['python3', str(EXTERNAL_TRAIN_SCRIPT),
+CACHE = ROOT / 'results' / 'salsa_cache'   # outside RESULTS: evaluate_and_plot.py reads every folder in RESULTS
+
+# model configs: flags passed to train_and_recover.py
+CONFIGS = {
+    'small': {'angular_emb': 'true', 'dxdistinguisher': 'true',
+              'train_batch_size': 32, 'val_batch_size': 64,
+              'n_enc_heads': 4, 'n_enc_layers': 2, 'enc_emb_dim': 512,
+              'epochs': 5, 'cpu': 'true', 'compile': 'false', 'dtype': 'float32'},
+    'tiny': {'angular_emb': 'true', 'dxdistinguisher': 'true',
+             'train_batch_size': 32, 'val_batch_size': 64,
+             'n_enc_heads': 2, 'n_enc_layers': 1, 'enc_emb_dim': 64,
+             'epochs': 1, 'cpu': 'true', 'compile': 'false', 'dtype': 'float32'},
+}
+
+SPLITS = ('train', 'test', 'orig')
+
+
+def file_digest(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def data_files(folder, hamming, seed):
+    """The files a job reads: {name in the staged data dir: source path}."""
+    files = {}
+    for split in SPLITS:
+        # each folder has its own A (the shared one in data/precomputed only fits n10),
+        # and its splits share the same samples: A.npy stands in for a missing split
+        A = folder / f'{split}_A.npy'
+        files[f'{split}_A.npy'] = A if A.exists() else folder / 'A.npy'
+        files[f'secret/{split}_b_{hamming}_{seed}.npy'] = folder / f'{split}_b_{hamming}_{seed}.npy'
+    files['secret/params.pkl'] = folder / 'params.pkl'
+    return files
+
+
+def stage_data(files, data_dir):
+    """Links the job's files in data_dir: train_and_recover.py reads A from the parent of --data_path."""
+    if data_dir.exists():
+        shutil.rmtree(data_dir)
+    ensure_dir(str(data_dir / 'secret'))
+    for name, src in files.items():
+        os.symlink(src.resolve(), data_dir / name)
+    return data_dir / 'secret'
+
+
+def cache_key(files, seed, config, hamming):
+    key = {'files': {name: file_digest(src) for name, src in sorted(files.items())},
+           'seed': seed, 'hamming': hamming, 'config': CONFIGS[config]}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:24]
+
+
+def build_cmd(data_path, dump_path, exp_name, seed, hamming, config, threads):
+    # each job stays within its slot: data loading in the training process, `threads` torch threads
+    cmd = [sys.executable, str(EXTERNAL_TRAIN_SCRIPT),
            '--data_path', str(data_path),
+           '--dump_path', str(dump_path),
            '--exp_name', exp_name,
+           '--exp_id', 'run',
            '--secret_seed', str(seed),
-           '--rlwe', '0',
-           '--task', 'mlwe-i',
-           '--angular_emb', 'true',
-           '--dxdistinguisher', 'true',
-           '--hamming', '3']
-    # add simple model flags (small for fast runs)
-    cmd += ['--train_batch_size', str(flags.get('train_batch_size',32)),
-            '--val_batch_size', str(flags.get('val_batch_size',64)),
-            '--n_enc_heads', str(flags.get('n_enc_heads',4)),
-            '--n_enc_layers', str(flags.get('n_enc_layers',2)),
-            '--enc_emb_dim', str(flags.get('enc_emb_dim',512)),
-            '--max_epoch', str(flags.get('epochs',5))]
+           '--hamming', str(hamming),
+           '--task', 'lwe',
+           '--workers', '0',
+           '--cpu_threads', str(threads)]
+    for k, v in CONFIGS[config].items():
+        cmd += [f'--{k}', str(v)]
     return cmd
 
-# find precomputed dataset folders
-pre_dir = ROOT / 'data' / 'precomputed'
-folders = sorted([p for p in pre_dir.iterdir() if p.is_dir()])
-
-# run SALSA on each folder containing baseline_*/idea_*
-for f in tqdm(folders, desc='salsa_folders'):
-    # set experiment name
-    exp_name = f.name + '_exp'
-    out_dir = RESULTS / f.name
-    out_dir.mkdir(parents=True, exist_ok=True)
-    cmd = build_cmd(f, exp_name, seed=0)
-    print('Running SALSA with command:', ' '.join(cmd))
-    # run and capture stdout/stderr
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
-    stdout_lines = []
-    for line in p.stdout:
-        print(line, end='')
-        stdout_lines.append(line)
-    ret = p.wait()
-    save_json(out_dir / 'run_stdout.json', {'returncode': ret, 'stdout': stdout_lines})
-    # try to parse predicted secret(s) from stdout (simple regex)
-    joined = ''.join(stdout_lines)
-    # look for "Best secret guess" patterns and extract numbers in brackets
-    guesses = re.findall(r'Best secret guess[^\[]*\[([^\]]+)\]', joined)
-    parsed = []
-    for g in guesses:
-        # split numbers, convert to ints
-        parts = re.findall(r'-?\d+', g)
-        parsed.append([int(x) for x in parts])
-    if parsed:
-        save_json(out_dir / 'predicted_secrets.json', {'guesses': parsed})
+
+def ordered_guesses(result, hamming):
+    """The matched secret first, then the guesses with the right hamming weight, then the rest."""
+    guesses = [g for r in result.get('recoveries', []) for g in r['guesses'] if g != result.get('secret')]
+    first = [result['secret']] if result.get('secret') else []
+    right_weight = [g for g in guesses if sum(x != 0 for x in g) == hamming]
+    rest = [g for g in guesses if sum(x != 0 for x in g) != hamming]
+    return first + right_weight + rest
+
+
+def run_job(job, threads, force):
+    folder, seed, config = job['folder'], job['seed'], job['config']
+    out_dir = RESULTS / job['name']
+    ensure_dir(str(out_dir))
+    hamming = job['hamming']
+    files = data_files(folder, hamming, seed)
+    missing = [str(p) for p in files.values() if not p.exists()]
+    if missing:
+        meta = {'folder': str(folder), 'seed': seed, 'config': config, 'returncode': None, 'missing': missing}
+        save_json(out_dir / 'run_meta.json', meta)
+        return meta
+
+    key = cache_key(files, seed, config, hamming)
+    cached = CACHE / f'{key}.json'
+    dump_path = out_dir / 'dump'
+    cmd = build_cmd(out_dir / 'data' / 'secret', dump_path, job['name'], seed, hamming, config, threads)
+    start = time.time()
+    hit = cached.exists() and not force
+    if hit:
+        result = load_json(cached)
+        returncode = 0
     else:
-        # no parsed guesses; save raw stdout for manual inspection
-        save_json(out_dir / 'parsed_guess_error.json', {'note': 'no guesses parsed', 'inspect_stdout': str(out_dir / 'run_stdout.json')})
-    # also save a small metadata file
-    save_json(out_dir / 'run_meta.json', {'folder': str(f), 'cmd': ' '.join(cmd), 'returncode': ret})
+        stage_data(files, out_dir / 'data')
+        if dump_path.exists():
+            shutil.rmtree(dump_path)
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads))
+        with open(out_dir / 'run.log', 'w') as log:
+            returncode = subprocess.run(cmd, cwd=EXTERNAL, env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+        results_path = dump_path / job['name'] / 'run' / 'results.json'
+        result = load_json(results_path) if results_path.exists() else None
+        if returncode == 0 and result is not None:
+            save_json(cached, result)
+
+    meta = {'folder': str(folder), 'seed': seed, 'config': config, 'cmd': ' '.join(cmd),
+            'returncode': returncode, 'key': key, 'cached': hit,
+            'wall_time': time.time() - start}
+    if result is not None:
+        meta.update({k: result[k] for k in ('recovered', 'recovery_epoch', 'epochs', 'steps', 'wall_time_s')})
+        save_json(out_dir / 'result.json', result)
+        save_json(out_dir / 'predicted_secrets.json', {'guesses': ordered_guesses(result, hamming)})
+    save_json(out_dir / 'run_meta.json', meta)
+    return meta
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Parallel, cached SALSA runs on data/precomputed')
+    parser.add_argument('--slots', type=int, default=os.cpu_count(), help='Jobs run at once')
+    parser.add_argument('--threads_per_job', type=int, default=1, help='OMP/MKL and torch threads of each job')
+    parser.add_argument('--datasets', type=str, default='', help='Comma-separated folder names (default: all)')
+    parser.add_argument('--seeds', type=str, default='0', help='Comma-separated secret seeds')
+    parser.add_argument('--configs', type=str, default='small', help=f'Comma-separated configs among {list(CONFIGS)}')
+    parser.add_argument('--hamming', type=int, default=3)
+    parser.add_argument('--force', action='store_true', help='Rerun cached jobs')
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    if not EXTERNAL_TRAIN_SCRIPT.exists():
+        print('ERROR: Could not find train_and_recover.py in external/LWE-benchmarking repo. Please clone the repo and check path.')
+        print('Expected at:', EXTERNAL_TRAIN_SCRIPT)
+        raise SystemExit(1)
+    configs = args.configs.split(',')
+    assert all(c in CONFIGS for c in configs), f'unknown config in {configs}, expected {list(CONFIGS)}'
+    names = set(args.datasets.split(',')) if args.datasets else None
+    folders = sorted(p for p in PRECOMPUTED.iterdir() if p.is_dir() and (names is None or p.name in names))
+    jobs = [{'folder': f, 'seed': int(s), 'config': c, 'hamming': args.hamming, 'name': f'{f.name}_{c}_s{s}'}
+            for f in folders for s in args.seeds.split(',') for c in configs]
+    ensure_dir(str(RESULTS))
+    ensure_dir(str(CACHE))
 
-print('All SALSA runs completed. Results under results/salsa_runs/')
+    summary = []
+    with ThreadPoolExecutor(max_workers=max(1, args.slots)) as pool:
+        futures = {pool.submit(run_job, job, args.threads_per_job, args.force): job for job in jobs}
+        for fut in tqdm(as_completed(futures), total=len(futures), desc='salsa_jobs'):
+            job = futures[fut]
+            meta = {'job': job['name'], **fut.result()}
+            summary.append(meta)
+            status = 'cached' if meta.get('cached') else f"returncode {meta['returncode']}"
+            tqdm.write(f"{job['name']}: {status}, recovered={meta.get('recovered')}")
+    save_json(RESULTS.parent / 'salsa_runs_summary.json', sorted(summary, key=lambda m: m['job']))
+    print('All SALSA runs completed. Results under results/salsa_runs/')